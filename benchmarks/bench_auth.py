@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-request cost of HTTP basic auth in the context server.
+
+Times CredentialStore.verify() for a stream of requests from a few context sources that keep sending the same
+credentials, and reports the percentiles of the cost per request for:
+
+    sha512     the previous scheme, one salted SHA-512 per request
+    scrypt     the scrypt hash on every request (csrv_auth_cache_ttl: 0)
+    cached     scrypt on the first request per source, then the verified-credential cache
+
+    python benchmarks/bench_auth.py -n 5000 -k 4
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials import CredentialStore  # noqa: E402
+
+
+def percentile(values: list, p: float) -> float:
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def measure(verify, requests: list) -> list:
+    timings = []
+    for username, password in requests:
+        start = time.perf_counter()
+        assert verify(username, password)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)
+
+
+def report(name: str, timings: list):
+    print(f"{name:>7} | mean {sum(timings) / len(timings) * 1e6:9.1f} us | p50 {percentile(timings, 50) * 1e6:9.1f} us"
+          f" | p99 {percentile(timings, 99) * 1e6:9.1f} us | max {timings[-1] * 1e6:9.1f} us")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-n', '--requests', type=int, default=5000, help='Number of requests to authenticate')
+    arg_parser.add_argument('-k', '--sources', type=int, default=4, help='Number of distinct users (context sources)')
+    parsed_args = arg_parser.parse_args()
+
+    users = {f"source{i}": f"password{i}" for i in range(parsed_args.sources)}
+    requests = [(f"source{i % parsed_args.sources}", f"password{i % parsed_args.sources}")
+                for i in range(parsed_args.requests)]
+
+    salt = '5dbab1e4-acef-11ea-9dda-acde48001122'
+    sha512_users = {u: hashlib.sha512((p + salt).encode('utf8')).hexdigest() for u, p in users.items()}
+    report('sha512', measure(
+        lambda u, p: sha512_users.get(u) == hashlib.sha512((p + salt).encode('utf8')).hexdigest(), requests))
+
+    # The uncached KDF is slow, time fewer requests for it
+    uncached = CredentialStore(users, cache_ttl=0)
+    report('scrypt', measure(uncached.verify, requests[:max(parsed_args.sources, parsed_args.requests // 20)]))
+
+    cached = CredentialStore(users)
+    report('cached', measure(cached.verify, requests))
+    print(f"cache: {cached.counters}")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of decoding pxGrid session messages.
+
+Compares the bytes codec (StompFrame.decode_all, json.loads on the bytes body) against the previous path
+(decode the websocket message to str, StompFrame.parse over a StringIO, json.loads on the str body) for bulk
+session messages of 1, 100 and 1000 sessions.
+
+    python benchmarks/bench_stomp.py
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stomp import StompFrame  # noqa: E402
+
+
+def generate_message(sessions: int, seed: int = 42) -> bytes:
+    rng = random.Random(seed)
+    body = {'sessions': [{
+        'timestamp': '2021-01-01T00:00:00.000Z',
+        'state': 'STARTED',
+        'userName': f"user{i}@example.com",
+        'callingStationId': ':'.join(f"{rng.getrandbits(8):02X}" for _ in range(6)),
+        'macAddress': ':'.join(f"{rng.getrandbits(8):02X}" for _ in range(6)),
+        'ipAddresses': [f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"],
+        'nasIpAddress': '10.0.0.1',
+        'selectedAuthzProfiles': ['Employee'],
+        'adNormalizedUser': f"user{i}",
+        'ctsSecurityGroup': 'Employees',
+    } for i in range(sessions)]}
+    frame = StompFrame()
+    frame.set_command('MESSAGE')
+    frame.set_header('destination', '/topic/com.cisco.ise.session')
+    frame.set_header('message-id', '1')
+    frame.set_header('subscription', 'my-id')
+    frame.set_content(json.dumps(body))
+    return frame.encode()
+
+
+def legacy_decode(message: bytes):
+    frame = StompFrame.parse(StringIO(message.decode('utf-8')))
+    return json.loads(frame.get_content())
+
+
+def bytes_decode(message: bytes):
+    frame = StompFrame.decode_all(message)[0]
+    return json.loads(frame.get_content())
+
+
+def bench(sessions: int, repeat: int):
+    message = generate_message(sessions)
+    assert legacy_decode(message) == bytes_decode(message)
+
+    legacy_time = timeit.timeit(lambda: legacy_decode(message), number=repeat) / repeat
+    bytes_time = timeit.timeit(lambda: bytes_decode(message), number=repeat) / repeat
+    frame_only = timeit.timeit(lambda: StompFrame.decode_all(message), number=repeat) / repeat
+    legacy_frame_only = timeit.timeit(lambda: StompFrame.parse(StringIO(message.decode('utf-8'))),
+                                      number=repeat) / repeat
+
+    print(f"{sessions:>6} sessions ({len(message) / 1024:8.1f} KiB) | "
+          f"frame: legacy {legacy_frame_only * 1e6:9.1f} us, bytes {frame_only * 1e6:9.1f} us | "
+          f"frame+json: legacy {legacy_time * 1e6:9.1f} us, bytes {bytes_time * 1e6:9.1f} us | "
+          f"speedup {legacy_time / bytes_time:5.2f}x")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-s', '--sizes', default='1,100,1000', help='Comma separated sessions per message')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=200, help='Number of decodes per size')
+    parsed_args = arg_parser.parse_args()
+
+    for size in (int(s) for s in parsed_args.sizes.split(',')):
+        bench(size, parsed_args.repeat)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the subnet to network ID lookup.
+
+Compares the SubnetIndex longest-prefix-match lookup against the linear scan over networks.csv rows that
+map_to_networkid used to do, for 1k, 10k and 100k subnets.
+
+    python benchmarks/bench_subnet_index.py
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from ipaddress import IPv4Network, IPv6Network, ip_address, ip_network
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network_index import SubnetIndex  # noqa: E402
+
+
+def generate_networks(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    networks = []
+    seen = set()
+    while len(networks) < count:
+        if rng.random() < 0.9:
+            # Mostly IPv4 site VLANs between /22 and /28
+            prefixlen = rng.randint(22, 28)
+            subnet = IPv4Network((rng.getrandbits(32), prefixlen), strict=False)
+        else:
+            subnet = IPv6Network((rng.getrandbits(128), 64), strict=False)
+        if subnet in seen:
+            continue
+        seen.add(subnet)
+        networks.append({'Network ID': f"L_{len(networks):018d}", 'subnet': str(subnet)})
+    return networks
+
+
+def sample_ips(networks: list, count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    ips = []
+    for network in rng.choices(networks, k=count):
+        subnet = ip_network(network['subnet'])
+        ips.append(str(subnet.network_address + rng.randrange(subnet.num_addresses)))
+    return ips
+
+
+def linear_lookup(networks: list, ip: str):
+    for network in networks:
+        if ip_address(ip) in ip_network(network['subnet']):
+            return network['Network ID']
+
+
+def bench(size: int, lookups: int, linear_lookups: int):
+    networks = generate_networks(size)
+    ips = sample_ips(networks, lookups)
+
+    build_time = timeit.timeit(lambda: SubnetIndex(networks), number=1)
+    index = SubnetIndex(networks)
+    index_time = timeit.timeit(lambda: [index.lookup(ip) for ip in ips], number=1) / len(ips)
+
+    linear_ips = ips[:linear_lookups]
+    linear_time = timeit.timeit(lambda: [linear_lookup(networks, ip) for ip in linear_ips], number=1) / len(linear_ips)
+
+    # Every sampled address comes from a subnet in the table, so the index must map all of them
+    unmapped = sum(1 for ip in ips if index.lookup(ip) is None)
+
+    print(f"{size:>8} subnets | build {build_time * 1e3:9.1f} ms | index {index_time * 1e6:8.2f} us/lookup | "
+          f"linear {linear_time * 1e6:12.2f} us/lookup | speedup {linear_time / index_time:10.0f}x"
+          + (f" | {unmapped} unmapped" if unmapped else ""))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-s', '--sizes', default='1000,10000,100000', help='Comma separated table sizes')
+    arg_parser.add_argument('-l', '--lookups', type=int, default=20000, help='Number of index lookups per size')
+    arg_parser.add_argument('--linear-lookups', type=int, default=20, help='Number of linear scan lookups per size')
+    parsed_args = arg_parser.parse_args()
+
+    for size in (int(s) for s in parsed_args.sizes.split(',')):
+        bench(size, parsed_args.lookups, parsed_args.linear_lookups)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Load generator for the context server (meraki-csrv.py).
+
+Posts user-login messages for random clients with a fixed number of concurrent connections and reports the
+throughput, the latency percentiles and the response status codes.
+
+    python benchmarks/load_csrv.py -u http://localhost:8080 --user admin1 --password password -c 50 -n 5000
+
+The IP addresses are drawn from the subnets in networks.csv (-N), and the roles from the profile_map in config.yaml
+(-C), so the requests map to real networks and group policies. Run it once against the previous version and once
+against the current one, with the same Redis and Dashboard (or mock Dashboard), to compare.
+"""
+import argparse
+import asyncio
+import base64
+import csv
+import os
+import random
+import sys
+import time
+from ipaddress import ip_network
+
+import aiohttp
+import yaml
+
+
+def load_subnets(networks_file_path: str) -> list:
+    subnets = []
+    with open(networks_file_path, newline='') as networks_file:
+        for row in csv.DictReader(networks_file):
+            try:
+                subnet = ip_network(row['subnet'], strict=False)
+            except ValueError:
+                continue
+            if subnet.version == 4 and subnet.num_addresses > 2:
+                subnets.append(subnet)
+    return subnets
+
+
+def generate_messages(count: int, clients: int, subnets: list, roles: list, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    macs = [':'.join(f"{rng.getrandbits(8):02X}" for _ in range(6)) for _ in range(clients)]
+    messages = []
+    for _ in range(count):
+        client = rng.randrange(clients)
+        if subnets:
+            subnet = subnets[client % len(subnets)]
+            ip = str(subnet.network_address + 1 + client % (subnet.num_addresses - 2))
+        else:
+            ip = f"10.{client >> 16 & 255}.{client >> 8 & 255}.{client & 255}"
+        messages.append({'macAddress': macs[client], 'ipAddress': ip, 'userName': f"user{client}",
+                         'role': rng.choice(roles) if roles else 'Employee'})
+    return messages
+
+
+def percentile(values: list, p: float) -> float:
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run(url: str, user: str, password: str, messages: list, concurrency: int) -> tuple:
+    latencies = []
+    statuses = {}
+    pending = iter(messages)
+
+    async def worker(session: aiohttp.ClientSession):
+        for message in pending:
+            start = time.perf_counter()
+            try:
+                async with session.post(url, json=message) as r:
+                    await r.read()
+                    status = r.status
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    headers = {'Authorization': 'Basic ' + base64.b64encode(f"{user}:{password}".encode()).decode()}
+    connector = aiohttp.TCPConnector(limit=concurrency, ssl=False)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return elapsed, sorted(latencies), statuses
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-u', '--url', default='http://localhost:8080', help='Base URL of the context server')
+    arg_parser.add_argument('--user', default='admin1', help='HTTP basic auth user')
+    arg_parser.add_argument('--password', default='password', help='HTTP basic auth password')
+    arg_parser.add_argument('-c', '--concurrency', type=int, default=50, help='Number of concurrent connections')
+    arg_parser.add_argument('-n', '--requests', type=int, default=5000, help='Number of requests to send')
+    arg_parser.add_argument('-k', '--clients', type=int, default=1000, help='Number of distinct clients (MACs)')
+    arg_parser.add_argument('-s', '--seed', type=int, default=42,
+                            help='Random seed, use a new one to send clients that are not cached yet')
+    arg_parser.add_argument('-C', '--config', default='config/config.yaml', help='Path to configuration file')
+    arg_parser.add_argument('-N', '--networks', default='config/networks.csv', help='Path to networks.csv')
+    parsed_args = arg_parser.parse_args()
+
+    roles = []
+    if os.path.exists(parsed_args.config):
+        with open(parsed_args.config, 'r') as config_file:
+            roles = [str(role) for role in (yaml.safe_load(config_file).get('profile_map') or {})
+                     if not str(role).startswith('re:') and not any(c in str(role) for c in '*?[')]
+    subnets = load_subnets(parsed_args.networks) if os.path.exists(parsed_args.networks) else []
+    if not subnets:
+        print(f"No subnets found in {parsed_args.networks}, clients will not map to networks", file=sys.stderr)
+
+    messages = generate_messages(parsed_args.requests, parsed_args.clients, subnets, roles, parsed_args.seed)
+    elapsed, latencies, statuses = asyncio.run(
+        run(parsed_args.url.rstrip('/') + '/api/user-login', parsed_args.user, parsed_args.password, messages,
+            parsed_args.concurrency))
+
+    print(f"{len(latencies)} requests in {elapsed:.2f}s: {len(latencies) / elapsed:.1f} requests/s")
+    print(f"latency p50 {percentile(latencies, 50) * 1e3:.1f} ms | p95 {percentile(latencies, 95) * 1e3:.1f} ms | "
+          f"p99 {percentile(latencies, 99) * 1e3:.1f} ms | max {latencies[-1] * 1e3:.1f} ms")
+    print("status codes: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of meraki-ise.py: replays pxGrid session messages through the real intake, mapping and
+provisioning path against local stand-ins, so it needs neither ISE nor a Meraki organization.
+
+    fake pxGrid pubsub (websocket, STOMP) -> PxgridSessionPubsub.read_message() -> SessionPipeline
+        -> AuthzProfileMapper (Redis cache, subnet index, profile map) -> ProvisioningQueue -> mock Dashboard
+
+The fake pubsub and the mock Dashboard run in a separate process, so they do not compete with the code under test
+for the event loop. The mock Dashboard answers provisionNetworkClients after a configurable latency and refuses a
+configurable share of calls with 429. Redis is a fakeredis server in its own process (pip install fakeredis), or a
+real one with --redis. The benchmark uses a separate database (--redis-db) and only removes the keys it writes.
+
+The pxGrid REST calls (account activation, service lookup, secrets) are not part of the replay, the pubsub client
+connects straight to the fake websocket.
+
+Reports the end-to-end throughput in sessions per second, the latency percentiles of every stage (the stages of the
+Prometheus metrics, see metrics.py) and the end-to-end latency per client, from the message that first carried it
+leaving the fake pubsub to its provisioning call reaching the mock Dashboard.
+
+    python benchmarks/replay.py -n 20000 --per-message 10 --dashboard-latency 200 --dashboard-429 0.05
+
+Sessions are synthetic by default (-n, --clients), or replayed from a file of recorded pxGrid messages (-i), one JSON
+message ({"sessions": [...]}) per line. Settings from a config file (-C) and --set key=value overrides apply to the
+pipeline, e.g. --set provision_batch_size=1. Unless set there, the Dashboard budget (meraki_rate_limit) is raised
+to 1000 calls/s, use --set meraki_rate_limit=10 to include the real pacing. For CI, --json writes the results to a file and --min-rate fails the
+run when the throughput drops below a number of sessions per second.
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from stomp import StompFrame  # noqa: E402
+
+SESSION_TOPIC = '/topic/com.cisco.ise.session'
+DEFAULT_PROFILE_MAP = {'Employee': 100, 'Contractor': 101, 'Guest': 102, 'IoT': 103}
+# Stage recorders, by metrics module attribute and stage name
+STAGES = (('STOMP_DECODE', 'stomp_decode'), ('JSON_DECODE', 'json_decode'), ('MAP_NETWORK', 'map_to_networkid'),
+          ('MAP_GROUP', 'map_to_groupid'), ('REDIS_GET', 'redis_get'), ('REDIS_SET', 'redis_set'),
+          ('DASHBOARD_WAIT', 'dashboard_wait'), ('PROVISION', 'provision_network_clients'))
+
+
+def percentile(values: list, p: float) -> float:
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95),
+            'p99': percentile(values, 99), 'max': values[-1]}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def generate_networks(path: str, count: int = 16):
+    with open(path, 'w', newline='') as networks_file:
+        writer = csv.writer(networks_file)
+        writer.writerow(['Network ID', 'subnet'])
+        for i in range(count):
+            writer.writerow([f"L_{i:04d}", f"10.{i >> 8 & 255}.{i & 255}.0/24"])
+
+
+def load_subnets(networks_file_path: str) -> list:
+    from ipaddress import ip_network
+    subnets = []
+    with open(networks_file_path, newline='') as networks_file:
+        for row in csv.DictReader(networks_file):
+            try:
+                subnet = ip_network(row['subnet'], strict=False)
+            except ValueError:
+                continue
+            if subnet.version == 4 and subnet.num_addresses > 2:
+                subnets.append(subnet)
+    return subnets
+
+
+def generate_messages(count: int, clients: int, per_message: int, subnets: list, roles: list,
+                      seed: int = 42) -> list:
+    """
+    Synthetic pxGrid session messages. Every client keeps its IP address and profile, so repeat sessions of a client
+    are cache hits, like the accounting updates ISE sends for a connected endpoint.
+    """
+    rng = random.Random(seed)
+    macs = [':'.join(f"{rng.getrandbits(8):02X}" for _ in range(6)) for _ in range(clients)]
+    profiles = [rng.choice(roles) for _ in range(clients)]
+    sessions = []
+    for i in range(count):
+        client = i if i < clients else rng.randrange(clients)
+        subnet = subnets[client % len(subnets)]
+        sessions.append({
+            'timestamp': f"2021-01-01T00:{i // 60000 % 60:02d}:{i // 1000 % 60:02d}.{i % 1000:03d}Z",
+            'state': 'STARTED' if i < clients else 'AUTHENTICATED',
+            'userName': f"user{client}@example.com",
+            'callingStationId': macs[client],
+            'macAddress': macs[client],
+            'ipAddresses': [str(subnet.network_address + 1 + client % (subnet.num_addresses - 2))],
+            'nasIpAddress': '10.255.0.1',
+            'selectedAuthzProfiles': [profiles[client]],
+            'adNormalizedUser': f"user{client}",
+        })
+    return [{'sessions': sessions[i:i + per_message]} for i in range(0, len(sessions), per_message)]
+
+
+def load_messages(path: str) -> list:
+    messages = []
+    with open(path, 'r') as messages_file:
+        for line in messages_file:
+            line = line.strip()
+            if line:
+                message = json.loads(line)
+                messages.append(message if 'sessions' in message else {'sessions': [message]})
+    return messages
+
+
+def encode_message(message: dict, message_id: int) -> bytes:
+    frame = StompFrame()
+    frame.set_command('MESSAGE')
+    frame.set_header('destination', SESSION_TOPIC)
+    frame.set_header('message-id', str(message_id))
+    frame.set_header('subscription', 'my-id')
+    frame.set_content(json.dumps(message))
+    return frame.encode()
+
+
+def serve_redis(port: int):
+    from fakeredis import TcpFakeServer
+    # The default listen backlog of 5 refuses connections when the pipeline opens its pool
+    TcpFakeServer.request_queue_size = 256
+    TcpFakeServer(('127.0.0.1', port), server_type='redis').serve_forever()
+
+
+def run_stand_ins(conn, frames: list, frame_macs: list, rate: float, latency: float, jitter: float,
+                  rate_limited_share: float, retry_after: float, seed: int):
+    """
+    Stand-in process: the fake pxGrid pubsub websocket and the mock Dashboard API.
+    """
+    asyncio.run(_stand_ins(conn, frames, frame_macs, rate, latency, jitter, rate_limited_share, retry_after, seed))
+
+
+async def _stand_ins(conn, frames, frame_macs, rate, latency, jitter, rate_limited_share, retry_after, seed):
+    import websockets
+    from aiohttp import web
+
+    rng = random.Random(seed)
+    first_sent = {}
+    provisioned = {}
+    counters = {'calls': 0, 'rate_limited': 0, 'clients': 0}
+
+    async def pubsub(ws, path=None):
+        connect = StompFrame.decode_all(await ws.recv())[0]
+        connected = StompFrame()
+        connected.set_command('CONNECTED')
+        connected.set_header('version', connect.headers.get('accept-version', '1.2'))
+        await ws.send(connected.encode())
+        await ws.recv()  # SUBSCRIBE
+        start = time.monotonic()
+        for index, (frame, macs) in enumerate(zip(frames, frame_macs)):
+            if rate > 0:
+                await asyncio.sleep(max(0.0, start + index / rate - time.monotonic()))
+            now = time.monotonic()
+            for mac in macs:
+                first_sent.setdefault(mac, now)
+            await ws.send(frame)
+        await ws.wait_closed()
+
+    async def provision(request):
+        body = await request.json()
+        counters['calls'] += 1
+        await asyncio.sleep(max(0.0, rng.gauss(latency, jitter)))
+        if rng.random() < rate_limited_share:
+            counters['rate_limited'] += 1
+            return web.json_response({'errors': ['API rate limit exceeded for organization']}, status=429,
+                                     headers={'Retry-After': str(retry_after)})
+        now = time.monotonic()
+        for client in body.get('clients', []):
+            provisioned.setdefault(client['mac'], now)
+        counters['clients'] += len(body.get('clients', []))
+        return web.json_response({**body, 'clients': [{**client, 'clientId': f"k{i}"}
+                                                      for i, client in enumerate(body.get('clients', []))]},
+                                 status=201)
+
+    ws_server = await websockets.serve(pubsub, '127.0.0.1', 0)
+    app = web.Application(client_max_size=16 * 1024 ** 2)
+    app.router.add_post('/api/v1/networks/{network_id}/clients/provision', provision)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    dashboard_socket = socket.socket()
+    dashboard_socket.bind(('127.0.0.1', 0))
+    await web.SockSite(runner, dashboard_socket).start()
+
+    loop = asyncio.get_running_loop()
+    conn.send((ws_server.sockets[0].getsockname()[1], dashboard_socket.getsockname()[1]))
+    await loop.run_in_executor(None, conn.recv)
+
+    e2e = [provisioned[mac] - first_sent[mac] for mac in provisioned if mac in first_sent]
+    conn.send({'e2e': e2e, **counters})
+    ws_server.close()
+    await runner.cleanup()
+
+
+class StageRecorder:
+    """
+    Stands in for a stage histogram of the metrics module and keeps every observation, for exact percentiles.
+    """
+
+    def __init__(self):
+        self.samples = []
+
+    def observe(self, value: float):
+        self.samples.append(value)
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+
+def load_app():
+    """
+    Import meraki-ise.py, whose name is not a valid module name, for its mapper and build_pipeline().
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'meraki-ise.py')
+    spec = importlib.util.spec_from_file_location('meraki_ise_app', path)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+
+def replay_pubsub_class():
+    from pxgrid import PxgridSessionPubsub
+    from ws_stomp import WebSocketStomp
+
+    class ReplayPubsub(PxgridSessionPubsub):
+        """
+        PxgridSessionPubsub connected straight to the fake pubsub, without the pxGrid REST service lookups.
+        """
+
+        def __init__(self, ws_url: str):
+            WebSocketStomp.__init__(self, ws_url, 'replay', 'replay', None)
+            self.last_timestamp = None
+            self._last_seen = None
+            self.reconnects = 0
+            self._failed_attempts = 0
+
+        async def connect(self):
+            await WebSocketStomp.connect(self)
+            await self.stomp_connect('localhost')
+            await self.stomp_subscribe(SESSION_TOPIC)
+
+    return ReplayPubsub
+
+
+async def replay(app, config: dict, ws_url: str, message_count: int, drain_timeout: float) -> dict:
+    pubsub = replay_pubsub_class()(ws_url)
+    pipeline = app.build_pipeline(config)
+    await pubsub.connect()
+    pipeline.start()
+    start = None
+    sessions = 0
+    for _ in range(message_count):
+        message = await pubsub.read_message()
+        if start is None:
+            start = time.monotonic()
+        sessions += len(message.get('sessions', ()))
+        await pipeline.put(message)
+    read_done = time.monotonic()
+    await pipeline.close(timeout=drain_timeout)
+    end = time.monotonic()
+    await pubsub.disconnect()
+    pipeline.mapper.networks.close()
+    return {'sessions': sessions, 'messages': message_count, 'read_seconds': read_done - start,
+            'seconds': end - start, 'pipeline': pipeline.stats()}
+
+
+def build_config(parsed_args, redis_host: str, redis_port: int, dashboard_port: int, networks_file_path: str) -> dict:
+    config = {}
+    if parsed_args.config:
+        with open(parsed_args.config, 'r') as config_file:
+            config = yaml.safe_load(config_file) or {}
+    config.setdefault('profile_map', DEFAULT_PROFILE_MAP)
+    # The mock Dashboard has no organization budget, measure our own code rather than the pacing to 10 calls/s
+    config.setdefault('meraki_rate_limit', 1000)
+    config.setdefault('meraki_rate_burst', 100)
+    for setting in parsed_args.set:
+        key, _, value = setting.partition('=')
+        config[key.strip()] = yaml.safe_load(value)
+    config.update({
+        'meraki_api_key': '0' * 40,
+        'meraki_base_url': f"http://127.0.0.1:{dashboard_port}/api/v1",
+        'redis_host': redis_host,
+        'redis_port': redis_port,
+        'redis_db': parsed_args.redis_db,
+        'networks_file_path': networks_file_path,
+        'pipeline_stats_interval': 0,
+        'durable_queue': False,
+    })
+    # Don't reload the profile map from the file while replaying
+    config.pop('config_file_path', None)
+    return config
+
+
+def clear_redis(config: dict, messages: list):
+    import redis
+    client = redis.Redis(host=config['redis_host'], port=config['redis_port'], db=config['redis_db'])
+    macs = {str(session.get('macAddress', '')) for message in messages for session in message['sessions']}
+    keys = [f"client.{mac.replace(':', '')}" for mac in macs] + ['networks', 'networks.version']
+    for i in range(0, len(keys), 1000):
+        client.delete(*keys[i:i + 1000])
+    client.close()
+
+
+def report(results: dict):
+    print(f"{results['sessions']} sessions in {results['messages']} messages, "
+          f"{results['clients_provisioned']} clients provisioned in {results['dashboard_calls']} Dashboard calls "
+          f"({results['dashboard_rate_limited']} answered 429)")
+    print(f"end-to-end: {results['sessions_per_second']:.1f} sessions/s over {results['seconds']:.2f}s "
+          f"(intake {results['intake_sessions_per_second']:.1f} sessions/s)")
+    print(f"{'stage':>26} {'count':>8} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for stage, summary in list(results['stages'].items()) + [('end_to_end_per_client', results['end_to_end'])]:
+        if not summary['count']:
+            print(f"{stage:>26} {0:>8}")
+            continue
+        print(f"{stage:>26} {summary['count']:>8} " + ' '.join(
+            f"{summary[p] * 1e3:>8.3f}ms" for p in ('p50', 'p95', 'p99', 'max')))
+    print(f"pipeline: {results['pipeline']}")
+
+
+def main(parsed_args) -> int:
+    logging.getLogger().setLevel(logging.INFO if parsed_args.verbose else logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix='meraki-ise-replay-')
+
+    networks_file_path = parsed_args.networks
+    if not networks_file_path:
+        networks_file_path = os.path.join(work_dir, 'networks.csv')
+        generate_networks(networks_file_path)
+    if parsed_args.input:
+        messages = load_messages(parsed_args.input)
+    else:
+        roles = list(DEFAULT_PROFILE_MAP)
+        if parsed_args.config:
+            with open(parsed_args.config, 'r') as config_file:
+                profile_map = (yaml.safe_load(config_file) or {}).get('profile_map') or {}
+            roles = [str(role) for role in profile_map
+                     if not str(role).startswith('re:') and not any(c in str(role) for c in '*?[')] or roles
+        messages = generate_messages(parsed_args.sessions, parsed_args.clients or parsed_args.sessions,
+                                     parsed_args.per_message, load_subnets(networks_file_path), roles,
+                                     parsed_args.seed)
+    frames = [encode_message(message, index) for index, message in enumerate(messages)]
+    frame_macs = [[session.get('macAddress') for session in message['sessions']] for message in messages]
+
+    context = multiprocessing.get_context('spawn')
+    redis_process = None
+    if parsed_args.redis:
+        redis_host, _, redis_port = parsed_args.redis.partition(':')
+        redis_port = int(redis_port or 6379)
+    else:
+        redis_host, redis_port = '127.0.0.1', free_port()
+        redis_process = context.Process(target=serve_redis, args=(redis_port,), daemon=True)
+        redis_process.start()
+
+    conn, child_conn = context.Pipe()
+    stand_ins = context.Process(target=run_stand_ins, daemon=True, args=(
+        child_conn, frames, frame_macs, parsed_args.rate, parsed_args.dashboard_latency / 1e3,
+        parsed_args.dashboard_jitter / 1e3, parsed_args.dashboard_429, parsed_args.retry_after, parsed_args.seed))
+    stand_ins.start()
+    ws_port, dashboard_port = conn.recv()
+
+    config = build_config(parsed_args, redis_host, redis_port, dashboard_port, networks_file_path)
+    for _ in range(50):
+        try:
+            clear_redis(config, messages)
+            break
+        except OSError:
+            # The Redis server is still starting
+            time.sleep(0.1)
+    else:
+        clear_redis(config, messages)
+
+    recorders = {}
+    for attribute, stage in STAGES:
+        recorders[stage] = StageRecorder()
+        setattr(metrics, attribute, recorders[stage])
+
+    app = load_app()
+    logging.getLogger().setLevel(logging.INFO if parsed_args.verbose else logging.WARNING)
+    results = asyncio.run(replay(app, config, f"ws://127.0.0.1:{ws_port}", len(frames), parsed_args.drain_timeout))
+
+    conn.send('stop')
+    dashboard = conn.recv()
+    stand_ins.join(5)
+    if redis_process is not None:
+        redis_process.terminate()
+
+    results.update({
+        'sessions_per_second': results['sessions'] / results['seconds'],
+        'intake_sessions_per_second': results['sessions'] / results['read_seconds'],
+        'clients_provisioned': dashboard['clients'],
+        'dashboard_calls': dashboard['calls'],
+        'dashboard_rate_limited': dashboard['rate_limited'],
+        'stages': {stage: summarize(recorder.samples) for stage, recorder in recorders.items()},
+        'end_to_end': summarize(dashboard['e2e']),
+    })
+    report(results)
+    if parsed_args.json:
+        with open(parsed_args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, default=str)
+    if parsed_args.min_rate and results['sessions_per_second'] < parsed_args.min_rate:
+        print(f"FAIL: {results['sessions_per_second']:.1f} sessions/s is below --min-rate {parsed_args.min_rate}",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-n', '--sessions', type=int, default=5000, help='Number of synthetic sessions')
+    arg_parser.add_argument('-k', '--clients', type=int, default=0,
+                            help='Number of distinct clients (MACs), default one per session. Repeat sessions of a '
+                                 'client are cache hits')
+    arg_parser.add_argument('-m', '--per-message', type=int, default=1, help='Sessions per pxGrid message')
+    arg_parser.add_argument('-s', '--seed', type=int, default=42, help='Random seed')
+    arg_parser.add_argument('-i', '--input', help='Replay recorded pxGrid messages, one JSON message per line')
+    arg_parser.add_argument('-r', '--rate', type=float, default=0,
+                            help='Messages per second sent by the fake pubsub, 0 for as fast as possible')
+    arg_parser.add_argument('-C', '--config', help='config.yaml to take the profile map and tuning settings from')
+    arg_parser.add_argument('-N', '--networks', help='networks.csv to map against, default 16 generated /24s')
+    arg_parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                            help='Override a config setting, may be repeated')
+    arg_parser.add_argument('--redis', help='host:port of a Redis server to use instead of fakeredis')
+    arg_parser.add_argument('--redis-db', type=int, default=15, help='Redis database to use')
+    arg_parser.add_argument('--dashboard-latency', type=float, default=100,
+                            help='Mean mock Dashboard latency in milliseconds')
+    arg_parser.add_argument('--dashboard-jitter', type=float, default=20,
+                            help='Standard deviation of the mock Dashboard latency in milliseconds')
+    arg_parser.add_argument('--dashboard-429', type=float, default=0,
+                            help='Share of Dashboard calls answered with 429 (0 to 1)')
+    arg_parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of the 429 answers in seconds')
+    arg_parser.add_argument('--drain-timeout', type=float, default=300,
+                            help='Seconds to wait for provisioning to finish after the last message')
+    arg_parser.add_argument('--json', help='Write the results to this file')
+    arg_parser.add_argument('--min-rate', type=float, default=0,
+                            help='Exit with status 1 if fewer sessions per second were processed')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='Log at INFO level')
+    sys.exit(main(arg_parser.parse_args()))
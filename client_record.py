@@ -0,0 +1,70 @@
+"""
+Compact encoding of the client.<mac> cache records.
+
+A record is a version byte, a 16 byte BLAKE2b digest of the mapping and the mapping's fields separated by the ASCII
+unit separator:
+
+    b'\\x01' + digest + b'network_id\\x1fmac\\x1fip\\x1fname\\x1fgroup'
+
+Changes are detected by comparing digests, so neither key order nor formatting take part in the comparison, and
+the record is roughly half the size of the JSON it replaces. Records written by older versions (JSON objects) are
+still understood, which lets the cache migrate in place.
+"""
+import hashlib
+import json
+from typing import Optional
+
+VERSION = b'\x01'
+DIGEST_SIZE = 16
+FIELDS = ('network_id', 'mac', 'ip', 'name', 'group')
+SEPARATOR = b'\x1f'
+# Distinguishes None from an empty string
+NONE = b'\x00'
+
+
+def _encode_fields(mapping: dict) -> bytes:
+    return SEPARATOR.join(NONE if mapping.get(field) is None else str(mapping[field]).encode()
+                          for field in FIELDS)
+
+
+def digest(mapping: dict) -> bytes:
+    """
+    :param mapping: Dict with the network_id, mac, ip, name and group of a client
+    :return: Digest of the mapping's fields
+    """
+    return hashlib.blake2b(_encode_fields(mapping), digest_size=DIGEST_SIZE).digest()
+
+
+def pack(mapping: dict) -> bytes:
+    fields = _encode_fields(mapping)
+    return VERSION + hashlib.blake2b(fields, digest_size=DIGEST_SIZE).digest() + fields
+
+
+def is_legacy(record: bytes) -> bool:
+    return record[:1] == b'{'
+
+
+def unpack(record: bytes) -> dict:
+    """
+    Decode a cache record, either compact or legacy JSON.
+    """
+    if is_legacy(record):
+        return json.loads(record)
+    if record[:1] != VERSION:
+        raise ValueError(f"Unknown client record version {record[:1]!r}")
+    values = record[1 + DIGEST_SIZE:].split(SEPARATOR)
+    return {field: None if value == NONE else value.decode() for field, value in zip(FIELDS, values)}
+
+
+def record_digest(record: Optional[bytes]) -> Optional[bytes]:
+    """
+    :return: The digest of a cache record without decoding its fields (except for legacy records), or None
+    """
+    if not record:
+        return None
+    if record[:1] == VERSION:
+        return record[1:1 + DIGEST_SIZE]
+    try:
+        return digest(unpack(record))
+    except ValueError:
+        return None
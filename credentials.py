@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Password hashing and verification for the context server's HTTP basic auth.
+
+Stored credentials are scrypt hashes with a random salt per user, encoded as
+
+    scrypt$<n>$<r>$<p>$<base64 salt>$<base64 hash>
+
+http_users in config.yaml may hold either such a hash or a plain password, which is hashed at startup. To generate a
+hash for the config file run:
+
+    python credentials.py <password>
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+SCHEME = 'scrypt'
+# Roughly 50ms and 16 MiB per hash on current hardware
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+
+def hash_password(password: str, salt: Optional[bytes] = None, n: int = SCRYPT_N, r: int = SCRYPT_R,
+                  p: int = SCRYPT_P) -> str:
+    """
+    :return: The encoded scrypt hash of a password
+    """
+    salt = salt if salt is not None else os.urandom(SALT_SIZE)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * r * n,
+                            dklen=HASH_SIZE)
+    return '$'.join((SCHEME, str(n), str(r), str(p), base64.b64encode(salt).decode(),
+                     base64.b64encode(digest).decode()))
+
+
+def is_hash(value: str) -> bool:
+    return str(value).startswith(SCHEME + '$')
+
+
+def check_password(password: str, encoded: str) -> bool:
+    """
+    Check a password against an encoded hash, in constant time.
+    """
+    try:
+        scheme, n, r, p, salt, digest = encoded.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+    except ValueError:
+        return False
+    if scheme != SCHEME:
+        return False
+    candidate = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * r * n,
+                               dklen=len(digest))
+    return hmac.compare_digest(candidate, digest)
+
+
+class CredentialStore:
+    """
+    Verifies basic auth credentials against scrypt hashes, remembering recent successes.
+
+    The KDF is deliberately slow, and context sources send the same credentials with every request. A successful
+    verification is therefore remembered for cache_ttl seconds, keyed by an HMAC of the username and password under
+    a random per-process key: repeat requests cost one HMAC instead of one scrypt, and neither the password nor an
+    unkeyed digest of it is kept in memory. Failed attempts are never cached, so guessing still pays the full KDF.
+
+    Unknown usernames are checked against a dummy hash, so they take as long to reject as a wrong password.
+    verify_async() runs the KDF on a small thread pool, which keeps the event loop responsive and bounds the CPU and
+    memory a stream of bad credentials can take.
+    """
+
+    def __init__(self, users: dict, cache_ttl: float = 300, cache_size: int = 1024, workers: int = 4):
+        self.users = {str(username): value if is_hash(value) else hash_password(str(value))
+                      for username, value in (users or {}).items()}
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._key = os.urandom(32)
+        self._verified = {}
+        self._lock = threading.Lock()
+        self._dummy = hash_password(base64.b64encode(os.urandom(SALT_SIZE)).decode())
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self.counters = {'cache_hits': 0, 'cache_misses': 0, 'failures': 0}
+
+    def _cache_key(self, username: str, password: str) -> bytes:
+        return hmac.new(self._key, f"{username}:{password}".encode('utf-8'), hashlib.sha256).digest()
+
+    def _cached(self, username: str, password: str) -> Optional[bytes]:
+        """
+        :return: None if the credentials were verified recently, else the cache key to remember them under
+        """
+        key = self._cache_key(username, password)
+        with self._lock:
+            expires = self._verified.get(key)
+            if expires is not None and expires > time.monotonic():
+                self.counters['cache_hits'] += 1
+                return None
+        self.counters['cache_misses'] += 1
+        return key
+
+    def _check(self, username: str, password: str, key: bytes) -> bool:
+        encoded = self.users.get(username)
+        # Pay for one KDF run either way, so an unknown username can't be told apart by the response time
+        valid = check_password(password, encoded if encoded is not None else self._dummy) and encoded is not None
+        if not valid:
+            self.counters['failures'] += 1
+            return False
+        if self.cache_ttl > 0:
+            now = time.monotonic()
+            with self._lock:
+                if len(self._verified) >= self.cache_size:
+                    # Drop expired entries, or everything if they are all still valid
+                    self._verified = {k: v for k, v in self._verified.items() if v > now}
+                    if len(self._verified) >= self.cache_size:
+                        self._verified.clear()
+                self._verified[key] = now + self.cache_ttl
+        return True
+
+    def verify(self, username: str, password: str) -> bool:
+        if username is None or password is None:
+            self.counters['failures'] += 1
+            return False
+        key = self._cached(username, password)
+        return key is None or self._check(username, password, key)
+
+    async def verify_async(self, username: str, password: str) -> bool:
+        """
+        Same as verify(), with the KDF run on the thread pool instead of the calling event loop.
+        """
+        if username is None or password is None:
+            self.counters['failures'] += 1
+            return False
+        key = self._cached(username, password)
+        if key is None:
+            return True
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._check, username, password, key)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <password>", file=sys.stderr)
+        sys.exit(1)
+    print(hash_password(sys.argv[1]))
@@ -1,16 +1,26 @@
 import csv
-from datetime import datetime
+import hashlib
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 import os
 from ipaddress import ip_network, ip_address
 import meraki
 import argparse
+import redis
 import yaml
 
+import provisioner
+from network_index import NetworkTable
+from rate_limiter import BULK, get_rate_limiter
+
 subnetMapList = []
 
-class MerakiConfig:
+class MerakiConfig(provisioner.MerakiConfig):
+    # Same Dashboard settings (and rate limit) as the provisioning side, plus the organization to read
     def __init__(self, config):
-        self.api_key = config['meraki_api_key']
+        super().__init__(config)
         self.org_name = config['meraki_org_name']
 
 def getNetworkId(ipaddr):
@@ -19,11 +29,14 @@ def getNetworkId(ipaddr):
             print(f'\n{ipaddr} is in {x["networkId"]}')
             return x["networkId"]
 
-def main():
+def main(workers: int = 8, incremental: bool = False, publish: bool = False):
     # Instantiate a Meraki dashboard API session
     dashboard = meraki.DashboardAPI(
         api_key=meraki_config.api_key,
-        output_log=False
+        base_url=meraki_config.base_url,
+        output_log=False,
+        # 429s are handled by the rate limiter
+        wait_on_rate_limit=False
         #log_file_prefix=os.path.basename(__file__)[:-3],
         #log_path='',
         #print_console=False
@@ -33,7 +46,8 @@ def main():
     # ORG_NAME = 'rylatorr'
     # ORG_NAME = 'Canadian Customer Corp'
     ORG_NAME = meraki_config.org_name
-    organizations = dashboard.organizations.getOrganizations()
+    rate_limiter = get_rate_limiter(meraki_config)
+    organizations = rate_limiter.call(dashboard.organizations.getOrganizations, priority=BULK)
 
     # Iterate through list of orgs to get the one I want
     for org in organizations:
@@ -45,42 +59,160 @@ def main():
 
     # Get list of devices in organization
     try:
-        devices = dashboard.organizations.getOrganizationDevices(org_id)
+        devices = rate_limiter.call(dashboard.organizations.getOrganizationDevices, org_id, priority=BULK)
     except meraki.APIError as e:
         print(f'Meraki API error: {e}')
     except Exception as e:
         print(f'some other error: {e}')
 
-    # Set up output CSV
-    output_file = open(networks_file_path, mode='w', newline='\n')
+    # Only MX/Z appliances have VLANs. HA pairs share a network, so only fetch each network once.
+    network_ids = list(dict.fromkeys(device['networkId'] for device in devices
+                                     if device['model'][:2] in ('MX', 'Z1', 'Z3') and device['networkId'] is not None))
+    total = len(network_ids)
+    print(f'  - found {len(devices)} devices and {total} appliance networks in organization {org_id}')
+
+    # VLAN rows and fingerprints of the previous run
+    state = load_state(state_file_path)
+    known_networks = state.get('networks', {})
+    run_time = datetime.now(timezone.utc)
+
+    to_fetch = network_ids
+    if incremental and known_networks and state.get('last_run'):
+        # Only re-fetch networks that are new or had configuration changes since the last run
+        changed_ids = get_changed_network_ids(dashboard, rate_limiter, org_id, state['last_run'])
+        if changed_ids is not None:
+            # Networks that could not be fetched last time may have missed changes, always fetch them again
+            changed_ids.update(state.get('failed', []))
+            to_fetch = [network_id for network_id in network_ids
+                        if network_id not in known_networks or network_id in changed_ids]
+            print(f'  - incremental run: {len(to_fetch)} of {total} networks new or changed since {state["last_run"]}')
+
+    fetch_start = datetime.now()
+    network_vlans, errors = fetch_vlans(dashboard, rate_limiter, to_fetch, workers)
+    fetch_time = datetime.now() - fetch_start
+
+    # Compare fingerprints against the previous run. Networks that could not be fetched keep their previous VLANs.
+    networks = {}
+    delta = {'added': [], 'changed': [], 'removed': []}
+    for network_id in network_ids:
+        if network_id in network_vlans:
+            rows = [{'Network ID': vlan["networkId"], 'VLID': str(vlan["id"]), 'VLAN Name': vlan["name"],
+                     'subnet': vlan["subnet"] or ''} for vlan in network_vlans[network_id]]
+            fingerprint = hashlib.sha256(json.dumps(rows, sort_keys=True).encode()).hexdigest()
+            if network_id not in known_networks:
+                delta['added'].append(network_id)
+            elif known_networks[network_id]['fingerprint'] != fingerprint:
+                delta['changed'].append(network_id)
+            networks[network_id] = {'fingerprint': fingerprint, 'rows': rows}
+        elif network_id in known_networks:
+            networks[network_id] = known_networks[network_id]
+    delta['removed'] = [network_id for network_id in known_networks if network_id not in networks]
+
+    # Rows in the order the networks were found, so the output is stable between runs
+    csv_rows = [row for network_id in network_ids if network_id in networks for row in networks[network_id]['rows']]
+    for row in csv_rows:
+        # Add to the master list
+        subnetMapList.append({'subnet': row['subnet'], 'networkId': row['Network ID']})
+
+    has_changed = any(delta.values()) or not os.path.exists(networks_file_path)
+    if has_changed:
+        write_atomic(networks_file_path, lambda output_file: write_csv(output_file, csv_rows))
+        print(f'\nWrote {len(csv_rows)} VLANs to {networks_file_path}: {len(delta["added"])} networks added, '
+              f'{len(delta["changed"])} changed, {len(delta["removed"])} removed')
+        if publish:
+            publish_networks(csv_rows, delta)
+    else:
+        print(f'\nNo VLAN changes, {networks_file_path} left untouched')
+
+    # last_run moves on even if some networks failed, they are remembered and retried on the next run instead
+    failed = [network_id for network_id in to_fetch if network_id not in network_vlans]
+    write_atomic(state_file_path, lambda state_file: json.dump(
+        {'last_run': run_time.isoformat(), 'failed': failed, 'networks': networks}, state_file))
+
+    print(f'Fetched VLANs of {len(to_fetch) - errors} of {len(to_fetch)} networks ({errors} errors) '
+          f'in {fetch_time} using {workers} workers')
+    print(f'Dashboard API usage: {rate_limiter.usage()}')
+
+
+def fetch_vlans(dashboard, rate_limiter, network_ids: list, workers: int):
+    # Fetch VLANs concurrently, the rate limiter keeps us inside the org's API budget
+    network_vlans = {}
+    errors = 0
+    total = len(network_ids)
+    progress_step = max(1, total // 20)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(rate_limiter.call, dashboard.appliance.getNetworkApplianceVlans, network_id,
+                                   priority=BULK): network_id
+                   for network_id in network_ids}
+        for counter, future in enumerate(as_completed(futures), 1):
+            network_id = futures[future]
+            try:
+                network_vlans[network_id] = future.result()
+            except meraki.APIError as e:
+                errors += 1
+                print(f'Meraki API error for network {network_id}: {e}')
+            except Exception as e:
+                errors += 1
+                print(f'some other error for network {network_id}: {e}')
+            if counter % progress_step == 0 or counter == total:
+                print(f'  - fetched VLANs of {counter} of {total} networks ({counter * 100 // total}%)')
+    return network_vlans, errors
+
+
+def get_changed_network_ids(dashboard, rate_limiter, org_id, since: str):
+    # Allow for some clock skew between us and the Dashboard
+    t0 = (datetime.fromisoformat(since) - timedelta(minutes=5)).isoformat()
+    try:
+        changes = rate_limiter.call(dashboard.organizations.getOrganizationConfigurationChanges, org_id,
+                                    total_pages='all', t0=t0, priority=BULK)
+    except Exception as e:
+        print(f'Unable to get configuration changes, checking all networks: {e}')
+        return None
+    return {change['networkId'] for change in changes if change.get('networkId')}
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, 'r') as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f'Ignoring unreadable state file {path}: {e}')
+        return {}
+
+
+def write_csv(output_file, rows: list):
     field_names = ['Network ID', 'VLID', 'VLAN Name', 'subnet']
     csv_writer = csv.DictWriter(output_file, field_names, delimiter=',', quotechar='"',
                                 quoting=csv.QUOTE_ALL)
     csv_writer.writeheader()
+    csv_writer.writerows(rows)
 
-    # Iterate through devices
-    total = len(devices)
-    counter = 1
-    print(f'  - iterating through {total} devices in organization {org_id}')
-    for device in devices:
-        print(f'Checking if {device["name"]} is an MX ({counter} of {total})')
-        # If the device is an MX, try getting the VLANs
-        if device['model'][:2] in ('MX', 'Z1', 'Z3') and device['networkId'] is not None:
-            # Get network VLANs
-            try:
-                networkVLANs = dashboard.appliance.getNetworkApplianceVlans(device["networkId"])
-            except meraki.APIError as e:
-                print(f'Meraki API error: {e}')
-            except Exception as e:
-                print(f'some other error: {e}')
-            else:
-                # Write rows
-                for vlan in networkVLANs:
-                    # Add to the master list
-                    subnetMapList.append({'subnet':vlan["subnet"], 'networkId': vlan["networkId"]})
-                    csv_writer.writerow({'Network ID': vlan["networkId"], 'VLID': vlan["id"], 'VLAN Name': vlan["name"], 'subnet': vlan["subnet"]})
-        counter += 1
-    output_file.close()
+
+def write_atomic(path: str, write):
+    # Write to a temporary file next to the target and rename it, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='\n') as output_file:
+            write(output_file)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def publish_networks(rows: list, delta: dict):
+    # Hand the new table to running mappers through Redis
+    redis_client = redis.Redis(host=yaml_config.get('redis_host', 'localhost'),
+                               port=yaml_config.get('redis_port', 6379),
+                               db=yaml_config.get('redis_db', 0))
+    network_table = NetworkTable(redis_client, networks_file_path, yaml_config.get('redis_expire', 28800),
+                                 subscribe=False)
+    version = network_table.publish(rows, delta)
+    print(f'Published network table version {version} to Redis')
 
 if __name__ == '__main__':
     start_time = datetime.now()
@@ -88,6 +220,12 @@ if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-c', '--config', help='Path to configuration file')
     arg_parser.add_argument('-n', '--networks', help='Path to network definition CSV file')
+    arg_parser.add_argument('-w', '--workers', type=int, default=8, help='Number of concurrent VLAN requests')
+    arg_parser.add_argument('-i', '--incremental', action='store_true',
+                            help='Only re-fetch networks that are new or had configuration changes since the last run')
+    arg_parser.add_argument('-s', '--state', help='Path to the state file (default: <networks file>.state.json)')
+    arg_parser.add_argument('-p', '--publish', action='store_true',
+                            help='Publish a changed network table to running mappers through Redis')
     parsed_args = arg_parser.parse_args()
 
     config_file_path = 'config/config.yaml'
@@ -95,14 +233,16 @@ if __name__ == '__main__':
         config_file_path = parsed_args.config
 
     networks_file_path = 'config/networks.csv'
-    if parsed_args.config:
-        networks_file_path = parsed_args.config
+    if parsed_args.networks:
+        networks_file_path = parsed_args.networks
+
+    state_file_path = parsed_args.state or f'{networks_file_path}.state.json'
 
     with open(config_file_path, 'r') as config_file:
         yaml_config = yaml.safe_load(config_file)
 
     meraki_config = MerakiConfig(yaml_config)
 
-    main()
+    main(parsed_args.workers, parsed_args.incremental, parsed_args.publish)
     end_time = datetime.now()
     print(f'\nScript complete, total runtime {end_time - start_time}')
@@ -1,8 +1,11 @@
-import json
 import logging
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import redis
+import redis.asyncio
+
+import client_record
+import metrics
 
 logger = logging.getLogger("meraki_ise.group_mapper")
 
@@ -12,6 +15,8 @@ class GroupMapper:
         self.config = config
         self.redis = redis.Redis(host=config.get('redis_host', 'localhost'), port=config.get('redis_port', 6379),
                                  db=config.get('redis_db', 0))
+        self.aredis = redis.asyncio.Redis(host=config.get('redis_host', 'localhost'),
+                                          port=config.get('redis_port', 6379), db=config.get('redis_db', 0))
         self.cache_expire = cache_expire
         self._profile_key = 'endpointProfile'
 
@@ -21,73 +26,171 @@ class GroupMapper:
     def map_to_groupid(self, session: dict) -> str:
         raise NotImplementedError
 
+    @staticmethod
+    def _cache_key(mac: str) -> str:
+        return f"client.{mac.replace(':', '')}"
+
+    def _map_sessions(self, pxgrid_message: dict, name_key: str, mac_key: str) -> List[Tuple[str, bytes, tuple]]:
+        """
+        Map the sessions of a pxGrid message without looking at the cache.
+
+        :return: List of tuples of (cache key, packed cache record, (network_id, mac, name, mapped_group))
+        """
+        candidates = []
+
+        sessions = pxgrid_message.get('sessions')
+
+        if not sessions:
+            logger.debug(f"Mapper called with an empty session object. Doing nothing.")
+            return candidates
+
+        # Messages can contain multiple sessions
+        for session in sessions:
+            # We're only interested in started and authenticated sessions
+            if session['state'] not in ('STARTED', 'AUTHENTICATED'):
+                continue
+            name = str(session[name_key])
+            mac = str(session[mac_key])
+
+            if len(session['ipAddresses']) == 0:
+                logger.error(f"Client {name} ({mac}) has no IP addresses. Cannot map to network.")
+                continue
+
+            ip = session['ipAddresses'][0]
+
+            # map the network and group IDs
+            with metrics.MAP_NETWORK.time():
+                network_id = self.map_to_networkid(ip)
+            logger.debug(f"Client {name} ({mac}) mapped to network {network_id}.")
+            if self._profile_key not in session:
+                logger.error(f"Client {name} ({mac}) has no {self._profile_key} set. Cannot map to group.")
+                continue
+
+            # Do the heavy lifting
+            with metrics.MAP_GROUP.time():
+                group_id = self.map_to_groupid(session)
+            result = (network_id, mac, name, group_id)
+            record = client_record.pack({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
+            candidates.append((self._cache_key(mac), record, result))
+
+        return candidates
+
+    def _diff(self, candidates: List[Tuple[str, bytes, tuple]], cached_records: list,
+              queued_digests: Optional[list] = None) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, bytes, tuple]]]:
+        """
+        Compare freshly mapped sessions against their cached records by digest.
+
+        :param queued_digests: Digests of the records still waiting to be provisioned, if any. A queued record is
+            newer than the cached one, so it is compared against instead.
+        :return: Tuple of (legacy cache records to migrate, candidates that are new or differ from the cache)
+        """
+        migrations = []
+        changed = []
+        for (key, record, result), cached_record, queued in zip(candidates, cached_records,
+                                                                queued_digests or [None] * len(candidates)):
+            name, mac = result[2], result[1]
+            if queued:
+                if queued == client_record.record_digest(record):
+                    logger.debug(f"Found an identical mapping queued for client {name} ({mac})")
+                    metrics.CACHE_HIT.inc()
+                    continue
+                logger.debug(f"Found a different mapping queued for client {name} ({mac})")
+                metrics.CACHE_CHANGED.inc()
+            elif cached_record:
+                # We found a cached mapping. Nice.
+                # Now, if wanted the cached mapping to be acted upon (i.e. provision the client) add it to the result
+                # even if it is identical.
+                if client_record.record_digest(cached_record) == client_record.record_digest(record):
+                    logger.debug(f"Found a cached identical mapping for client {name} ({mac})")
+                    metrics.CACHE_HIT.inc()
+                    if client_record.is_legacy(cached_record):
+                        # Migrate records written by older versions to the compact format
+                        migrations.append((key, record))
+                    continue
+                logger.debug(f"Found a cached but different mapping for client {name} ({mac})")
+                metrics.CACHE_CHANGED.inc()
+            else:
+                metrics.CACHE_MISS.inc()
+            changed.append((key, record, result))
+        return migrations, changed
+
     def map(self, pxgrid_message: dict, name_key: str = 'userName', mac_key: str = 'macAddress') -> List[
         Tuple[str, str, str, str]]:
         """
         Do the mapping.
 
+        All cached mappings of the message are fetched with a single MGET and changes are written back in a single
+        pipeline.
+
         :param pxgrid_message: Message from pxGrid
         :param name_key: Dictionary key for the username field in the pxGrid message
         :param mac_key: Dictionary key for the MAC address field in the pxGrid message
-        :param group_key: Dictionary key for the group field in the pxGrid message
         :return: List of tuples of (network_id, mac, name, mapped_group)
         """
+        candidates = self._map_sessions(pxgrid_message, name_key, mac_key)
+        if not candidates:
+            # If the message did not contain session information this will return an empty list
+            return []
+
+        with metrics.REDIS_GET.time():
+            cached_records = self.redis.mget([key for key, _, _ in candidates])
+        migrations, changed = self._diff(candidates, cached_records)
+        writes = migrations + [(key, record) for key, record, _ in changed]
+        if writes:
+            with metrics.REDIS_SET.time():
+                pipe = self.redis.pipeline(transaction=False)
+                for key, record in writes:
+                    pipe.set(key, record, ex=self.cache_expire)
+                pipe.execute()
+        return [result for _, _, result in changed]
+
+    async def map_async(self, pxgrid_message: dict, name_key: str = 'userName', mac_key: str = 'macAddress') -> List[
+        Tuple[str, str, str, str]]:
+        """
+        Same as map(), but talks to Redis through redis.asyncio so the event loop is never blocked.
+        """
+        changed = await self.map_uncommitted_async(pxgrid_message, name_key, mac_key)
+        await self.commit_async([(key, record) for key, record, _ in changed])
+        return [result for _, _, result in changed]
 
-        mappings = []
-
-        sessions = pxgrid_message.get('sessions')
-
-        if sessions:
-            # Messages can contain multiple sessions
-            for session in sessions:
-                # We're only interested in started and authenticated sessions
-                if session['state'] not in ('STARTED', 'AUTHENTICATED'):
-                    continue
-                name = str(session[name_key])
-                mac = str(session[mac_key])
-
-                if len(session['ipAddresses']) == 0:
-                    logger.error(f"Client {name} ({mac}) has no IP addresses. Cannot map to network.")
-                    return []
+    async def map_uncommitted_async(self, pxgrid_message: dict, name_key: str = 'userName', mac_key: str = 'macAddress',
+                                    queued_key: Optional[Callable[[str], str]] = None) -> List[
+            Tuple[str, bytes, tuple]]:
+        """
+        Map a message and diff it against the cache, without recording the changed mappings in the cache.
 
-                ip = session['ipAddresses'][0]
+        Used when the cache must only be updated once a client was actually provisioned, see commit_async().
 
-                # map the network and group IDs
-                network_id = self.map_to_networkid(ip)
-                logger.debug(f"Client {name} ({mac}) mapped to network {network_id}.")
-                if self._profile_key in session:
-                    # Do the heavy lifting
-                    group_id = self.map_to_groupid(session)
-                    result = (network_id, mac, name, group_id)
-                    result_json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-                else:
-                    logger.error(f"Client {name} ({mac}) has no {self._profile_key} set. Cannot map to group.")
-
-                cached_mapping = self.redis.get(f"client.{mac.replace(':', '')}")
-
-                if cached_mapping:
-                    # We found a cached mapping. Nice.
-                    # Now, if wanted the cached mapping to be acted upon (i.e. provision the client) uncomment the next
-                    # two lines
-                    #mapping = json.loads(cached_mapping)
-                    #mappings.append((mapping['network_id'], mapping['mac'], mapping['name'], mapping['group']))
-                    #need to check the string. if everything is the same, do nothing. But if any element is different do the other code
-                    logger.debug(f"result_json_obj var is ({result_json_obj})")
-                    logger.debug(f"cached_mapping var is ({cached_mapping})")
-                    if cached_mapping.decode() == result_json_obj:
-                        logger.debug(f"Found a cached identical mapping for client {name} ({mac})")
-                    else:
-                        logger.debug(f"Found a cached but different mapping for client {name} ({mac})")
-                        # so let's update it then
-                        json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-                        self.redis.set(f"client.{mac.replace(':', '')}", json_obj, ex=self.cache_expire)
-                        mappings.append(result)
-                else:
-                    json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-                    self.redis.set(f"client.{mac.replace(':', '')}", json_obj, ex=self.cache_expire)
-                    mappings.append(result)
-        else:
-            logger.debug(f"Mapper called with an empty session object. Doing nothing.")
+        :param queued_key: Returns the key holding the digest of the record queued for a cache key, if records wait
+            in a work queue before they are committed. Sessions are then compared against the queued record first,
+            so a client that changes back to its cached mapping while another one is queued is not missed.
+        :return: List of tuples of (cache key, cache record, (network_id, mac, name, mapped_group))
+        """
+        candidates = self._map_sessions(pxgrid_message, name_key, mac_key)
+        if not candidates:
+            return []
+
+        keys = [key for key, _, _ in candidates]
+        queued_digests = None
+        with metrics.REDIS_GET.time():
+            if queued_key is None:
+                cached_records = await self.aredis.mget(keys)
+            else:
+                records = await self.aredis.mget(keys + [queued_key(key) for key in keys])
+                cached_records, queued_digests = records[:len(keys)], records[len(keys):]
+        migrations, changed = self._diff(candidates, cached_records, queued_digests)
+        await self.commit_async(migrations)
+        return changed
+
+    async def commit_async(self, writes: List[Tuple[str, bytes]]):
+        """
+        Write cache records in a single pipeline.
 
-        # If the message did not contain session information this will return an empty list
-        return mappings
+        :param writes: List of tuples of (cache key, cache record)
+        """
+        if writes:
+            with metrics.REDIS_SET.time():
+                async with self.aredis.pipeline(transaction=False) as pipe:
+                    for key, record in writes:
+                        pipe.set(key, record, ex=self.cache_expire)
+                    await pipe.execute()
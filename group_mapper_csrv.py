@@ -1,105 +1,172 @@
-import json
+from functools import lru_cache
 from sanic.log import logger, logging
 from typing import List, Tuple
-from ipaddress import ip_address, ip_network
-from csv import DictReader
 from typing import Optional
 import redis
+import redis.asyncio
 
-class GroupMapper:
+import client_record
+import metrics
+from table_mapper import TableMapper
+
+
+@lru_cache(maxsize=1024)
+def split_roles(roles: str) -> tuple:
+    # CP sends roles as a single string with multiple comma-separated values. Split into list and trim whitespace
+    return tuple(x.strip(' ') for x in roles.split(','))
+
+
+class GroupMapper(TableMapper):
     def __init__(self, config: dict, cache_expire: int = 28800):
         self.config = config
         self.redis = redis.Redis(host=config.get('redis_host', 'localhost'), port=config.get('redis_port', 6379),
                                  db=config.get('redis_db', 0))
+        # Requests are mapped concurrently, let them wait for a free connection rather than fail when all are busy
+        self.aredis = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+            host=config.get('redis_host', 'localhost'), port=config.get('redis_port', 6379),
+            db=config.get('redis_db', 0), max_connections=int(config.get('redis_max_connections', 50))))
         self.cache_expire = cache_expire
         self._profile_key = 'role'
-
-    def map_to_networkid(self, ip: str):
-        cached_networks = self.redis.get('networks')
-        if not cached_networks:
-            with open(self.config.get('networks_file_path', 'config/networks.csv'), 'r') as csv_file:
-                csv_reader = DictReader(csv_file)
-                networks = list(csv_reader)
-                self.redis.set('networks', json.dumps(networks), ex=self.cache_expire)
-        else:
-            networks = json.loads(cached_networks)
-
-        for network in networks:
-            if ip_address(ip) in ip_network(network['subnet']):
-                return network['Network ID']
-
-        logger.error(f"Unable to map {ip} to an existing Meraki Network")
+        super().__init__(self.redis, config, cache_expire)
 
     def map_to_groupid(self, session: dict) -> Optional[str]:
-        #logger.debug(f"hit map_to_groupid. roles are . {session[self._profile_key]}")
-        # CP send roles as a single string  with multiple comma-separated values. Split into list and trim whitespace
-        roleslist = session[self._profile_key].split(',')
-        roleslist = [x.strip(' ') for x in roleslist]
+        roleslist = split_roles(session[self._profile_key])
         logger.debug(f"roles are {roleslist}")
-        profile_map = self.config.get('profile_map')
-        # make profile name case insensitive
-        profile_map = {k.lower(): v for k, v in profile_map.items()}
-        logger.debug(f"profile_map is ({profile_map})")
-        if profile_map:
-            for profile in roleslist:
-                group = profile_map.get(profile.lower())
-                if group:
-                    return str(group)
-        return None
+        return self.profile_map.get().match(roleslist)
 
-    def map(self, session: dict, name_key: str = 'userName', mac_key: str = 'macAddress', ip_key: str = 'ipAddress') -> List[
-        Tuple[str, str, str, str]]:
+    def _map_session(self, session: dict, name_key: str, mac_key: str, ip_key: str) -> Optional[
+            Tuple[str, bytes, tuple]]:
         """
-        Do the mapping.
+        Map a session without looking at the cache.
 
-        :param session: Message from external context server
-        :param name_key: Dictionary key for the username field in the message
-        :param mac_key: Dictionary key for the MAC address field in the message
-        :param group_key: Dictionary key for the group field in the message
-        :return: List of tuples of (network_id, mac, name, mapped_group)
+        :return: Tuple of (cache key, packed cache record, (network_id, mac, name, mapped_group)), or None
         """
-
-        mappings = []
-
         name = str(session[name_key])
         mac = str(session[mac_key]).upper()
         ip = str(session[ip_key])
 
         if len(session['ipAddress']) == 0:
             logger.error(f"Client {name} ({mac}) has no IP addresses. Cannot map to network.")
-            return []
+            return None
 
         # map the network and group IDs
-        network_id = self.map_to_networkid(ip)
+        with metrics.MAP_NETWORK.time():
+            network_id = self.map_to_networkid(ip)
         logger.debug(f"Client {name} ({mac}) mapped to network {network_id}.")
         logger.debug(f"session is ({session})")
-        if self._profile_key in session:
-            # Do the heavy lifting
-            group_id = self.map_to_groupid(session)
-            result = (network_id, mac, name, group_id)
-            result_json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-        else:
+        if self._profile_key not in session:
             logger.error(f"Client {name} ({mac}) has no {self._profile_key} set. Cannot map to group.")
+            return None
 
-        cached_mapping = self.redis.get(f"client.{mac.replace(':', '')}")
+        # Do the heavy lifting
+        with metrics.MAP_GROUP.time():
+            group_id = self.map_to_groupid(session)
+        result = (network_id, mac, name, group_id)
+        record = client_record.pack({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
+        return f"client.{mac.replace(':', '')}", record, result
+
+    @staticmethod
+    def _compare(record: bytes, cached_record: Optional[bytes], result: tuple) -> Tuple[bool, bool]:
+        """
+        Compare a freshly mapped session against its cached record by digest.
 
-        if cached_mapping:
+        :return: Tuple of (whether the record must be written to the cache, whether the client must be provisioned)
+        """
+        name, mac = result[2], result[1]
+        if cached_record:
             # We found a cached mapping. Nice.
-            #need to check the string. if everything is the same, do nothing. But if any element is different do the other code
-            #logger.debug(f"result_json_obj var is ({result_json_obj})")
-            #logger.debug(f"cached_mapping var is ({cached_mapping})")
-            if cached_mapping.decode() == result_json_obj:
+            # Compare the digests. If everything is the same, do nothing. But if any element is different update it.
+            if client_record.record_digest(cached_record) == client_record.record_digest(record):
                 logger.debug(f"Found a cached identical mapping for client {name} ({mac})")
-            else:
-                logger.debug(f"Found a cached but different mapping for client {name} ({mac})")
-                # so let's update it then
-                json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-                self.redis.set(f"client.{mac.replace(':', '')}", json_obj, ex=self.cache_expire)
-                mappings.append(result)
+                metrics.CACHE_HIT.inc()
+                # Migrate records written by older versions to the compact format
+                return client_record.is_legacy(cached_record), False
+            logger.debug(f"Found a cached but different mapping for client {name} ({mac})")
+            metrics.CACHE_CHANGED.inc()
         else:
-            json_obj = json.dumps({'network_id': network_id, 'mac': mac, 'ip': ip, 'name': name, 'group': group_id})
-            self.redis.set(f"client.{mac.replace(':', '')}", json_obj, ex=self.cache_expire)
-            mappings.append(result)
+            metrics.CACHE_MISS.inc()
+        return True, True
+
+    def map(self, session: dict, name_key: str = 'userName', mac_key: str = 'macAddress', ip_key: str = 'ipAddress') -> List[
+        Tuple[str, str, str, str]]:
+        """
+        Do the mapping.
+
+        :param session: Message from external context server
+        :param name_key: Dictionary key for the username field in the message
+        :param mac_key: Dictionary key for the MAC address field in the message
+        :param ip_key: Dictionary key for the IP address field in the message
+        :return: List of tuples of (network_id, mac, name, mapped_group)
+        """
+        mapped = self._map_session(session, name_key, mac_key, ip_key)
+        if mapped is None:
+            return []
+        key, record, result = mapped
+
+        with metrics.REDIS_GET.time():
+            cached_record = self.redis.get(key)
+        write, changed = self._compare(record, cached_record, result)
+        if write:
+            with metrics.REDIS_SET.time():
+                self.redis.set(key, record, ex=self.cache_expire)
+        return [result] if changed else []
+
+    async def map_async(self, session: dict, name_key: str = 'userName', mac_key: str = 'macAddress',
+                        ip_key: str = 'ipAddress') -> List[Tuple[str, str, str, str]]:
+        """
+        Same as map(), but talks to Redis through redis.asyncio so the event loop is never blocked.
+        """
+        mapped = self._map_session(session, name_key, mac_key, ip_key)
+        if mapped is None:
+            return []
+        key, record, result = mapped
+
+        with metrics.REDIS_GET.time():
+            cached_record = await self.aredis.get(key)
+        write, changed = self._compare(record, cached_record, result)
+        if write:
+            with metrics.REDIS_SET.time():
+                await self.aredis.set(key, record, ex=self.cache_expire)
+        return [result] if changed else []
+
+    async def map_many_async(self, sessions: List[dict], name_key: str = 'userName', mac_key: str = 'macAddress',
+                             ip_key: str = 'ipAddress') -> List[Tuple[str, Optional[tuple]]]:
+        """
+        Map many sessions in one pass: all cached mappings are fetched with a single MGET and changes are written
+        back in a single pipeline.
+
+        :return: For every session a tuple of (outcome, detail). The outcome is 'changed' (the client must be
+                 provisioned), 'unchanged' (identical to the cached mapping), 'skipped' (no IP address or role) or
+                 'invalid' (a required field is missing or malformed). The detail is the (network_id, mac, name, mapped_group)
+                 mapping for 'changed' and 'unchanged', the error message for 'invalid' and None otherwise.
+        """
+        outcomes = [('skipped', None)] * len(sessions)
+        candidates = []
+        for index, session in enumerate(sessions):
+            try:
+                mapped = self._map_session(session, name_key, mac_key, ip_key)
+            except KeyError as e:
+                logger.error(f"Session for {session.get(mac_key)} cannot be mapped, missing field {e}")
+                outcomes[index] = ('invalid', f"Missing field {e}")
+                continue
+            except (ValueError, TypeError, AttributeError) as e:
+                # An IP address that doesn't parse, or a field of the wrong type
+                logger.error(f"Session for {session.get(mac_key)} cannot be mapped: {e}")
+                outcomes[index] = ('invalid', f"Invalid session: {e}")
+                continue
+            if mapped is not None:
+                candidates.append((index, mapped))
+        if not candidates:
+            return outcomes
 
-        # If the message did not contain session information this will return an empty list
-        return mappings
+        with metrics.REDIS_GET.time():
+            cached_records = await self.aredis.mget([key for _, (key, _, _) in candidates])
+        async with self.aredis.pipeline(transaction=False) as pipe:
+            for (index, (key, record, result)), cached_record in zip(candidates, cached_records):
+                write, changed = self._compare(record, cached_record, result)
+                if write:
+                    pipe.set(key, record, ex=self.cache_expire)
+                outcomes[index] = ('changed', result) if changed else ('unchanged', result)
+            with metrics.REDIS_SET.time():
+                await pipe.execute()
+        return outcomes
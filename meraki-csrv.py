@@ -2,16 +2,21 @@
 from sanic import Sanic
 from sanic import response
 from sanic_httpauth import HTTPBasicAuth
-import hashlib
+import asyncio
+import inspect
+import signal
 import ssl
+import threading
 import json
 import argparse
+from functools import wraps
 from sanic.log import logger, logging
-import meraki
-import meraki.exceptions
 import yaml
 
+import metrics
+from credentials import CredentialStore
 from group_mapper_csrv import GroupMapper
+from provisioner import MerakiConfig, ProvisioningQueue
 
 __author__ = "Ryan LaTorre"
 __email__ = "rylatorr@cisco.com"
@@ -19,7 +24,34 @@ __copyright__ = "Copyright (c) 2020 Cisco and/or its affiliates"
 __license__ = "Cisco Sample Code License"
 
 app = Sanic("meraki-csrv")
-auth = HTTPBasicAuth()
+
+
+class AsyncHTTPBasicAuth(HTTPBasicAuth):
+    """
+    HTTPBasicAuth whose login_required awaits the password check, so the KDF doesn't block the event loop.
+    """
+
+    def login_required(self, f):
+        @wraps(f)
+        async def decorated(request, *args, **kwargs):
+            authorization = self.get_auth(request)
+            request.ctx.authorization = authorization
+            # Let OPTIONS through like HTTPBasicAuth does, for CORS
+            if request.method != "OPTIONS":
+                if authorization is None or not await self.verify_password_callback(
+                        authorization.username, authorization.password):
+                    return self.auth_error_callback(request)
+            result = f(request, *args, **kwargs)
+            return await result if inspect.isawaitable(result) else result
+
+        return decorated
+
+
+auth = AsyncHTTPBasicAuth()
+
+# Mapping and provisioning that outlive the request that started them
+background_tasks = set()
+metrics.track_queue('background_tasks', app, lambda _: len(background_tasks))
 
 # The root logger
 #logging.getLogger().setLevel(logging.INFO)
@@ -29,30 +61,9 @@ logging.getLogger('meraki').setLevel(logging.ERROR)
 #logger.setLevel(logging.INFO)
 logger.setLevel(logging.DEBUG)
 
-class MerakiConfig:
-    def __init__(self, config):
-        self.api_key = config['meraki_api_key']
-
-def provision_client(network_id: str, mac: str, username: str, mapped_group: str):
-    clients = [{'mac': mac, 'name': username}]
-    device_policy = 'Group policy'
-    dashboard = meraki.DashboardAPI(meraki_config.api_key, output_log=False, print_console=False)
-    return dashboard.networks.provisionNetworkClients(network_id,
-                                                     clients,
-                                                     device_policy,
-                                                     groupPolicyId=str(mapped_group))
-
-# used for HTTP auth
-def hash_password(salt, password, yaml_config):
-    salted = password + salt
-    return hashlib.sha512(salted.encode("utf8")).hexdigest()
-
-
 @auth.verify_password
-def verify_password(username, password):
-    if username in users:
-        return users.get(username) == hash_password(app_salt, password, yaml_config)
-    return False
+async def verify_password(username, password):
+    return await credential_store.verify_async(username, password)
 
 @app.route("/testauth")
 @auth.login_required
@@ -64,25 +75,149 @@ def testauth(request):
 async def test(request):
     return response.json({"hello": "world"})
 
+
+@app.route("/metrics")
+@auth.login_required
+async def metrics_endpoint(request):
+    body, content_type = metrics.render()
+    return response.raw(body, content_type=content_type)
+
+
+async def handle_login(message: dict):
+    mapped_users = await group_mapper.map_async(message)
+    logger.debug(f'mapped_user is {mapped_users}')
+    # Concurrent requests for the same network and group policy are coalesced into one Dashboard call.
+    # Errors are logged per client by the provisioning queue.
+    await asyncio.gather(*(provisioning_queue.provision(*user) for user in mapped_users),
+                         return_exceptions=True)
+
+
+def _log_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f'Unable to handle user login: {task.exception()!r}')
+
+
 @app.route("/api/user-login", methods=['POST'])
 @auth.login_required
 async def userLogin(request):
-    message = json.loads(request.body)
+    with metrics.JSON_DECODE.time():
+        message = json.loads(request.body)
     logger.debug(f'Message is: {message}')
     if 'macAddress' in message:
-        mapper = group_mapper
-        mapped_users = mapper.map(message)
-        logger.debug(f'mapped_user is {mapped_users}')
-        for user in mapped_users:
-            try:
-                provision_client(*user)
-                logging.info(f"Provisioning user {user[2]} with MAC {user[1]} into group {user[3]}")
-            except meraki.exceptions.APIError as e:
-                logger.error(
-                    f"Meraki API error while provisioning client {user[2]} ({user[1]}) into network {user[0]}: {e}")
+        # Map and provision in the background so a slow Dashboard call never holds up the response. Wait for it
+        # for at most csrv_response_wait seconds: 200 means it is done, 202 that it is still in progress.
+        while len(background_tasks) >= max_pending:
+            # Push back on the sender instead of queueing without bound
+            await asyncio.wait(background_tasks, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(handle_login(message))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        task.add_done_callback(_log_failure)
+        if response_wait > 0:
+            done, _ = await asyncio.wait({task}, timeout=response_wait)
+            if done:
+                return response.json(message, status=200)
+        return response.json(message, status=202)
 
     return response.json(message, status=200)
 
+
+def parse_sessions(body: bytes) -> list:
+    """
+    Parse the body of a bulk request, either a JSON array or newline delimited JSON (one session per line).
+
+    :return: List of tuples of (session, error message), an NDJSON line that is not valid JSON has the error set
+    :raises ValueError: If the body is a JSON array that cannot be parsed
+    """
+    body = body.strip()
+    if body[:1] == b'[':
+        return [(item, None) for item in json.loads(body)]
+    items = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError as e:
+            items.append((None, f'Invalid JSON: {e}'))
+    return items
+
+
+@app.route("/api/user-login/bulk", methods=['POST'])
+@auth.login_required
+async def userLoginBulk(request):
+    """
+    Bulk variant of /api/user-login. Maps all sessions with a single Redis round trip, provisions them through
+    grouped Dashboard calls and returns the outcome for each session, in request order.
+    """
+    try:
+        with metrics.JSON_DECODE.time():
+            items = parse_sessions(request.body)
+    except ValueError as e:
+        return response.json({'error': f'Invalid JSON: {e}'}, status=400)
+    if len(items) > bulk_max_items:
+        return response.json({'error': f'At most {bulk_max_items} sessions per request'}, status=413)
+
+    results = [{'index': index} for index in range(len(items))]
+    # Only the last login of a client counts
+    latest = {}
+    for index, (session, error) in enumerate(items):
+        if error is None and (not isinstance(session, dict) or 'macAddress' not in session):
+            error = 'Not a session with a macAddress'
+        if error is not None:
+            results[index].update(status='invalid', error=error)
+            continue
+        results[index]['macAddress'] = session['macAddress']
+        mac = str(session['macAddress']).upper()
+        if mac in latest:
+            results[latest[mac]]['status'] = 'superseded'
+        latest[mac] = index
+
+    indexes = list(latest.values())
+    outcomes = await group_mapper.map_many_async([items[index][0] for index in indexes])
+    futures = {}
+    for index, (outcome, mapping) in zip(indexes, outcomes):
+        results[index]['status'] = outcome
+        if outcome == 'invalid':
+            results[index]['error'] = mapping
+            continue
+        if outcome == 'skipped':
+            results[index]['error'] = 'No IP address or role'
+            continue
+        results[index].update(networkId=mapping[0], groupPolicyId=mapping[3])
+        if outcome == 'changed':
+            # Clients of the same network and group policy are provisioned together in bulk calls
+            futures[provisioning_queue.provision(*mapping)] = index
+            results[index]['status'] = 'queued'
+
+    if futures and bulk_response_wait > 0:
+        await asyncio.wait(futures, timeout=bulk_response_wait)
+    for future, index in futures.items():
+        if not future.done():
+            continue
+        if future.exception() is not None:
+            results[index].update(status='failed', error=str(future.exception()))
+        else:
+            results[index]['status'] = 'provisioned'
+    complete = all(result['status'] != 'queued' for result in results)
+    logger.debug(f'Bulk request with {len(items)} sessions, {len(futures)} provisioned')
+    return response.json({'results': results}, status=200 if complete else 202)
+
+
+@app.listener('after_server_start')
+async def handle_reload(app, loop):
+    # Re-read config.yaml and networks.csv on SIGHUP without blocking the event loop
+    loop.add_signal_handler(
+        signal.SIGHUP, lambda: threading.Thread(target=group_mapper.reload, name='reload', daemon=True).start())
+
+
+@app.listener('before_server_stop')
+async def drain(app, loop):
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await provisioning_queue.close()
+
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-c', '--config', help='Path to configuration file')
@@ -95,6 +230,7 @@ if __name__ == "__main__":
 
     with open(config_file_path, 'r') as config_file:
         yaml_config = yaml.safe_load(config_file)
+    yaml_config['config_file_path'] = config_file_path
 
     networks_file_path = 'config/networks.csv'
     if parsed_args.networks:
@@ -107,15 +243,18 @@ if __name__ == "__main__":
     meraki_config = MerakiConfig(yaml_config)
 
     group_mapper = GroupMapper(yaml_config)
+    provisioning_queue = ProvisioningQueue(meraki_config)
+    response_wait = float(yaml_config.get('csrv_response_wait', 0))
+    max_pending = int(yaml_config.get('csrv_max_pending', 1000))
+    bulk_max_items = int(yaml_config.get('csrv_bulk_max_items', 10000))
+    bulk_response_wait = float(yaml_config.get('csrv_bulk_response_wait', 30))
 
     yaml_config['networks_file_path'] = networks_file_path
 
     # Retrieve authorized HTTP users
-    app_salt = yaml_config.get('app_salt')
-    users = yaml_config.get('http_users')
-    for k, v in users.items():
-        users[k] = hash_password(app_salt, v, yaml_config)
-    logger.debug(f'users dict is {users}')
+    credential_store = CredentialStore(yaml_config.get('http_users'),
+                                       cache_ttl=float(yaml_config.get('csrv_auth_cache_ttl', 300)))
+    logger.debug(f'HTTP users are {list(credential_store.users)}')
 
     if yaml_config['use_ssl']:
         # run on HTTPS
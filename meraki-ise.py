@@ -2,21 +2,22 @@
 
 import argparse
 import asyncio
-import json
 import logging
 import signal
-from asyncio.tasks import FIRST_COMPLETED
-from csv import DictReader
-from ipaddress import ip_address, ip_network
-from typing import Optional
+from typing import Optional, Union
 
-import meraki
-import meraki.exceptions
+import redis
 import yaml
 from websockets import ConnectionClosed
 
+import metrics
 from group_mapper import GroupMapper
-from pxgrid import PxgridConfig, PxgridSessionPubsub, PxgridSessionService
+from pipeline import PipelineConfig, SessionPipeline
+from provisioner import MerakiConfig, ProvisioningQueue
+from pxgrid import PxgridCache, PxgridConfig, PxgridSessionPubsub, PxgridSessionService
+from sharding import ShardedDispatcher, consume
+from table_mapper import TableMapper
+from work_queue import ProvisioningStream, WorkQueueConfig
 
 __author__ = "Ryan LaTorre"
 __email__ = "rylatorr@cisco.com"
@@ -32,44 +33,19 @@ logging.getLogger().setLevel(logging.INFO)
 logging.getLogger('meraki').setLevel(logging.ERROR)
 logger = logging.getLogger("meraki_ise")
 
-class MerakiConfig:
-    def __init__(self, config):
-        self.api_key = config['meraki_api_key']
-
-
-class ExampleGroupMapper(GroupMapper):
+class ExampleGroupMapper(TableMapper, GroupMapper):
     """
     This is an example implementation of the Group mapper.
     This can be used with profile selectors that are strings such as the 'endpointProfile' from the pxGrid message
     """
 
     def __init__(self, config: dict, cache_expire: int = 28800):
-        super().__init__(config, cache_expire)
+        GroupMapper.__init__(self, config, cache_expire)
+        TableMapper.__init__(self, self.redis, config, cache_expire)
         self._profile_key = 'endpointProfile'
 
-    def map_to_networkid(self, ip: str):
-        cached_networks = self.redis.get('networks')
-        if not cached_networks:
-            with open(self.config.get('networks_file_path', 'config/networks.csv'), 'r') as csv_file:
-                csv_reader = DictReader(csv_file)
-                networks = list(csv_reader)
-                self.redis.set('networks', json.dumps(networks), ex=self.cache_expire)
-        else:
-            networks = json.loads(cached_networks)
-
-        for network in networks:
-            if ip_address(ip) in ip_network(network['subnet']):
-                return network['Network ID']
-
-        logger.error(f"Unable to map {ip} to an existing Meraki Network")
-
     def map_to_groupid(self, session: dict) -> Optional[str]:
-        profile_map = self.config.get('profile_map')
-        if profile_map:
-            group = profile_map.get(session[self._profile_key])
-            if group:
-                return str(group)
-        return None
+        return self.profile_map.get().lookup(session[self._profile_key])
 
 
 class AuthzProfileMapper(ExampleGroupMapper):
@@ -83,61 +59,89 @@ class AuthzProfileMapper(ExampleGroupMapper):
         self._profile_key = 'selectedAuthzProfiles'
 
     def map_to_groupid(self, session: dict) -> Optional[str]:
-        profile_map = self.config.get('profile_map')
-        # make profile name case insensitive
-        profile_map = {k.lower(): v for k, v in profile_map.items()}
-        #logger.debug(f"profile_map is ({profile_map})")
-        if profile_map:
-            # 'selectedAuthzProfiles' is a list, so we need to iterate through it
-            # Demo code laziness: This will perform provisioning upon first match.
-            # So if a user has more than one matching profile only the first one will be
-            # used to determine how to provision that user.
-            for profile in session[self._profile_key]:
-                group = profile_map.get(profile.lower())
-                if group:
-                    return str(group)
-        return None
-
-
-def provision_client(network_id: str, mac: str, username: str, mapped_group: str):
-    clients = [{'mac': mac, 'name': username}]
-    device_policy = 'Group policy'
-    dashboard = meraki.DashboardAPI(meraki_config.api_key, output_log=False, print_console=False)
-    return dashboard.networks.provisionNetworkClients(network_id,
-                                                     clients,
-                                                     device_policy,
-                                                     groupPolicyId=str(mapped_group))
-
-
-async def future_read_message(pubsub_service, future):
-    try:
-        message = await pubsub_service.read_message()
-        future.set_result(message)
-    except ConnectionClosed:
-        logging.error('Websocket connection closed')
+        # 'selectedAuthzProfiles' is a list. Profile names are matched case insensitively and if a user has more
+        # than one matching profile, profile_map_priority decides which one is used to provision that user.
+        return self.profile_map.get().match(session[self._profile_key])
+
 
+def build_pipeline(config: dict) -> SessionPipeline:
+    #group_mapper = ExampleGroupMapper(config)
+    group_mapper = AuthzProfileMapper(config)
+    provisioning_queue = ProvisioningQueue(MerakiConfig(config))
+    work_queue_config = WorkQueueConfig(config)
+    work_queue = None
+    if work_queue_config.enabled:
+        work_queue = ProvisioningStream(group_mapper.aredis, work_queue_config, group_mapper.cache_expire)
+    return SessionPipeline(group_mapper, provisioning_queue, PipelineConfig(config), work_queue)
 
-async def subscribe_loop(pubsub_service: PxgridSessionPubsub, mapper: GroupMapper):
-    await pubsub_service.connect()
-    while True:
-        future = asyncio.Future()
-        future_read = future_read_message(pubsub_service, future)
+
+def run_worker(shard: int, worker_queue, config: dict, workers: int):
+    """
+    Entry point of a worker process in sharded mode.
+    """
+    # Forked workers inherit the intake loop's signal wakeup fd: without this, every signal a worker handles is also
+    # delivered to the intake process, and a SIGHUP passed on to the workers would come back to it as a new reload
+    signal.set_wakeup_fd(-1)
+    # The intake process handles shutdown and tells us to stop through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if not MerakiConfig(config).rate_limit_shared:
+        # Every worker has its own Dashboard rate limiter, so split the budget between them
+        config = dict(config, meraki_rate_limit=float(config.get('meraki_rate_limit', 10)) / workers)
+    metrics_port = int(config.get('metrics_port', 0))
+    if metrics_port:
+        metrics.start_exporter(metrics_port + 1 + shard)
+    pipeline = build_pipeline(config)
+    # Reloads are passed on from the intake process
+    signal.signal(signal.SIGHUP, lambda *_: pipeline.reload())
+    logger.info(f"Worker {shard} started")
+    asyncio.run(consume(worker_queue, pipeline))
+
+
+async def bootstrap_sessions(session_service: PxgridSessionService,
+                             pipeline: Union[SessionPipeline, ShardedDispatcher], live_macs: set):
+    """
+    Push every session that is already active through the pipeline, so endpoints that connected before we
+    subscribed get provisioned too. Only sessions whose mapping differs from the cache cause Dashboard calls.
+    """
+    try:
+        await session_service.bootstrap(pipeline.put, session_service.config.bootstrap_chunk_size,
+                                        skip=lambda session: session.get('macAddress') in live_macs)
+    except Exception as e:
+        logger.error(f"Unable to bootstrap active sessions: {e}")
+    finally:
+        live_macs.clear()
+
+
+async def subscribe_loop(pubsub_service: PxgridSessionPubsub, pipeline: Union[SessionPipeline, ShardedDispatcher],
+                         session_service: Optional[PxgridSessionService] = None):
+    await pubsub_service.reconnect()
+    pipeline.start()
+    # Subscribe first so nothing is missed, then bootstrap alongside the live events. Sessions updated live while
+    # the bootstrap runs are newer than its snapshot, so they are left out of it.
+    bootstrap = None
+    live_macs = set()
+    if session_service is not None and session_service.config.bootstrap:
+        bootstrap = asyncio.ensure_future(bootstrap_sessions(session_service, pipeline, live_macs))
+    try:
+        while True:
+            # Reconnects and catches up on missed sessions by itself when the websocket drops
+            message = await pubsub_service.read_message()
+            if 'sessions' in message:
+                if bootstrap is not None and not bootstrap.done():
+                    live_macs.update(session.get('macAddress') for session in message['sessions'])
+                # Mapping and provisioning happen in the pipeline (or worker processes),
+                # this only blocks if the pipeline is full
+                await pipeline.put(message)
+    except asyncio.CancelledError:
+        if bootstrap is not None:
+            bootstrap.cancel()
+        await pipeline.close()
         try:
-            await asyncio.wait([future_read], return_when=FIRST_COMPLETED)
-        except asyncio.CancelledError:
             await pubsub_service.destroy()
-            break
-        else:
-            message = future.result()
-            if 'sessions' in message:
-                mapped_users = mapper.map(message)
-                for user in mapped_users:
-                    try:
-                        provision_client(*user)
-                        logging.info(f"Provisioning user {user[2]} with MAC {user[1]} into group {user[3]}")
-                    except meraki.exceptions.APIError as e:
-                        logger.error(
-                            f"Meraki API error while provisioning client {user[2]} ({user[1]}) into network {user[0]}: {e}")
+        except ConnectionClosed:
+            pass
 
 
 if __name__ == '__main__':
@@ -151,6 +155,9 @@ if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-c', '--config', help='Path to configuration file')
     arg_parser.add_argument('-n', '--networks', help='Path to network definition CSV file')
+    arg_parser.add_argument('-w', '--workers', type=int,
+                            help='Number of worker processes to shard sessions across (0 to map and provision in '
+                                 'this process)')
     parsed_args = arg_parser.parse_args()
 
     config_file_path = 'config/config.yaml'
@@ -159,6 +166,7 @@ if __name__ == '__main__':
 
     with open(config_file_path, 'r') as config_file:
         yaml_config = yaml.safe_load(config_file)
+    yaml_config['config_file_path'] = config_file_path
 
     networks_file_path = 'config/networks.csv'
     if parsed_args.networks:
@@ -168,20 +176,35 @@ if __name__ == '__main__':
     if 'networks_file_path' not in yaml_config:
         yaml_config['networks_file_path'] = networks_file_path
 
-    meraki_config = MerakiConfig(yaml_config)
+    workers = int(yaml_config.get('worker_processes', 0))
+    if parsed_args.workers is not None:
+        workers = parsed_args.workers
+
+    metrics_port = int(yaml_config.get('metrics_port', 0))
+    if metrics_port:
+        metrics.start_exporter(metrics_port)
+
     pxgrid_config = PxgridConfig(yaml_config)
 
-    session_service = PxgridSessionService(pxgrid_config)
+    # Service lookups and secrets are cached in Redis, so restarts skip those round trips
+    pxgrid_cache = PxgridCache(redis.Redis(host=yaml_config.get('redis_host', 'localhost'),
+                                           port=yaml_config.get('redis_port', 6379),
+                                           db=yaml_config.get('redis_db', 0)))
+    session_service = PxgridSessionService(pxgrid_config, pxgrid_cache)
     session_pubsub = PxgridSessionPubsub(session_service)
-    #group_mapper = ExampleGroupMapper(yaml_config)
-    group_mapper = AuthzProfileMapper(yaml_config)
+    if workers > 0:
+        session_pipeline = ShardedDispatcher(run_worker, workers, PipelineConfig(yaml_config).queue_size,
+                                             worker_args=(yaml_config, workers))
+    else:
+        session_pipeline = build_pipeline(yaml_config)
 
     loop = asyncio.get_event_loop()
-    subscribe_task = asyncio.ensure_future(subscribe_loop(session_pubsub, group_mapper))
+    subscribe_task = asyncio.ensure_future(subscribe_loop(session_pubsub, session_pipeline, session_service))
 
     # Setup signal handlers
     loop.add_signal_handler(signal.SIGINT, subscribe_task.cancel)
     loop.add_signal_handler(signal.SIGTERM, subscribe_task.cancel)
+    loop.add_signal_handler(signal.SIGHUP, session_pipeline.reload)
 
     # Event loop
     loop.run_until_complete(subscribe_task)
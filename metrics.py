@@ -0,0 +1,93 @@
+import logging
+import threading
+import weakref
+from typing import Any, Callable, Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+
+logger = logging.getLogger("meraki_ise.metrics")
+
+# Stages range from microseconds (subnet lookup) to seconds (Dashboard calls behind the rate limiter)
+STAGE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram('meraki_ise_stage_seconds', 'Time spent in each processing stage', ['stage'],
+                          buckets=STAGE_BUCKETS)
+# Label children are bound once, looking them up by name on every observation is comparatively slow
+STOMP_DECODE = STAGE_SECONDS.labels('stomp_decode')
+JSON_DECODE = STAGE_SECONDS.labels('json_decode')
+MAP_NETWORK = STAGE_SECONDS.labels('map_to_networkid')
+MAP_GROUP = STAGE_SECONDS.labels('map_to_groupid')
+# Redis stages time the whole await, so under load they include the time the event loop took to resume the caller,
+# not only the Redis round trip
+REDIS_GET = STAGE_SECONDS.labels('redis_get')
+REDIS_SET = STAGE_SECONDS.labels('redis_set')
+# Each provisionNetworkClients attempt, and the wait for a thread, the rate limiter's budget or a 429 pause before it
+PROVISION = STAGE_SECONDS.labels('provision_network_clients')
+DASHBOARD_WAIT = STAGE_SECONDS.labels('dashboard_wait')
+
+CACHE_LOOKUPS = Counter('meraki_ise_cache_lookups_total',
+                        'Client mapping cache lookups: hit (identical), changed (cached but different) or miss',
+                        ['result'])
+CACHE_HIT = CACHE_LOOKUPS.labels('hit')
+CACHE_CHANGED = CACHE_LOOKUPS.labels('changed')
+CACHE_MISS = CACHE_LOOKUPS.labels('miss')
+
+DASHBOARD_CALLS = Counter('meraki_ise_provisioning_calls_total',
+                          'provisionNetworkClients calls by HTTP status code, "ok" for success and "error" for '
+                          'failures without a response', ['status'])
+DASHBOARD_RATE_LIMITED = Counter('meraki_ise_dashboard_rate_limited_total',
+                                 'Dashboard API calls answered with 429 and retried')
+PROVISIONED_CLIENTS = Counter('meraki_ise_provisioned_clients_total', 'Clients provisioned, by result', ['result'])
+
+QUEUE_DEPTH = Gauge('meraki_ise_queue_depth', 'Items waiting or in flight at each queue', ['queue'])
+
+
+# Queue name -> {owner: depth function}, owners are held weakly so instances that are gone stop being reported
+_queue_depths: Dict[str, weakref.WeakKeyDictionary] = {}
+# Metrics are collected on the exporter's thread
+_queue_depths_lock = threading.Lock()
+
+
+def _total_depth(name: str) -> float:
+    with _queue_depths_lock:
+        depths = list(_queue_depths[name].items())
+    return sum(depth(owner) for owner, depth in depths)
+
+
+def track_queue(name: str, owner: Any, depth: Callable[[Any], float]):
+    """
+    Report the depth of a queue, read from depth(owner) whenever metrics are collected. Several instances can track a
+    queue with the same name, the gauge then reports their total.
+
+    :param owner: The instance the queue belongs to. It is only weakly referenced, so depth shouldn't hold on to it.
+    """
+    with _queue_depths_lock:
+        if name not in _queue_depths:
+            _queue_depths[name] = weakref.WeakKeyDictionary()
+            QUEUE_DEPTH.labels(name).set_function(lambda: _total_depth(name))
+        _queue_depths[name][owner] = depth
+
+
+def provisioning_status(e: Exception = None) -> str:
+    """
+    :return: The metrics label for the outcome of a Dashboard call
+    """
+    if e is None:
+        return 'ok'
+    status = getattr(e, 'status', None)
+    return str(status) if status is not None else 'error'
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    :return: Tuple of (the metrics in the Prometheus text format, its content type)
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port: int, addr: str = '0.0.0.0'):
+    """
+    Serve /metrics on a background thread.
+    """
+    start_http_server(port, addr=addr)
+    logger.info(f"Serving metrics on {addr}:{port}")
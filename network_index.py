@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import threading
+import time
+from csv import DictReader
+from ipaddress import ip_address, ip_network
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger("meraki_ise.network_index")
+
+
+class SubnetIndex:
+    """
+    Longest-prefix-match index of subnet to Meraki network ID mappings.
+
+    Subnets are bucketed per IP version and prefix length into dicts keyed by the integer network address.
+    A lookup masks the address once per distinct prefix length (longest first) and does a dict probe, so the cost
+    depends on the number of distinct prefix lengths (at most 33 for IPv4, 129 for IPv6) and not on the number of
+    subnets in networks.csv.
+    """
+
+    def __init__(self, networks: Iterable[dict] = (), subnet_key: str = 'subnet', network_key: str = 'Network ID'):
+        self._subnet_key = subnet_key
+        self._network_key = network_key
+        self._tables = {4: [], 6: []}
+        self._size = 0
+        self.build(networks)
+
+    def __len__(self):
+        return self._size
+
+    def build(self, networks: Iterable[dict]):
+        """
+        (Re)build the index from rows of networks.csv.
+
+        The new tables are built aside and swapped in with a single assignment, so concurrent lookups always see
+        either the old or the new index.
+
+        :param networks: Iterable of dicts with at least the subnet and network ID keys
+        """
+        buckets = {4: {}, 6: {}}
+        size = 0
+        for network in networks:
+            try:
+                subnet = ip_network(network[self._subnet_key], strict=False)
+                network_id = network[self._network_key]
+            except (KeyError, ValueError) as e:
+                logger.warning(f"Skipping invalid network row {network}: {e}")
+                continue
+            table = buckets[subnet.version].setdefault(subnet.prefixlen, {})
+            # Keep the first occurrence, just like the linear scan over the CSV did
+            if int(subnet.network_address) not in table:
+                table[int(subnet.network_address)] = network_id
+                size += 1
+
+        tables = {}
+        for version, max_len in ((4, 32), (6, 128)):
+            tables[version] = [(((1 << prefixlen) - 1) << (max_len - prefixlen), table)
+                               for prefixlen, table in sorted(buckets[version].items(), reverse=True)]
+        self._tables, self._size = tables, size
+
+    def lookup(self, ip: str) -> Optional[str]:
+        """
+        Find the network ID of the most specific subnet containing an IP address.
+
+        :param ip: IPv4 or IPv6 address
+        :return: The network ID or None if no subnet matches
+        """
+        address = ip_address(ip)
+        address_int = int(address)
+        for mask, table in self._tables[address.version]:
+            network_id = table.get(address_int & mask)
+            if network_id is not None:
+                return network_id
+        return None
+
+
+class NetworkTable:
+    """
+    Process-local copy of the network table, kept in sync with the other replicas through Redis.
+
+    The parsed networks.csv lives in the Redis 'networks' key and its version in 'networks.version'. Whichever
+    process (re)loads the CSV bumps the version and publishes it on the 'networks.changed' channel. Every replica
+    listens on that channel (and on keyspace notifications for the 'networks' key, if enabled on the server) from a
+    background thread, which rebuilds the local SubnetIndex, so lookups never leave the process.
+
+    Lookups never wait for a rebuild and never take the lock: a new index is built aside (on the subscription
+    thread, or on a background thread when the table expired) and swapped in with a single assignment, while
+    lookups keep using the previous one. Only the very first lookup waits, if the table is still being loaded.
+
+    networks.csv itself is the source of truth: subscribed replicas start loading it when they are created, and its
+    modification time is checked at most every check_interval seconds. A changed file is reloaded on a background
+    thread (or right away with reload(), e.g. on SIGHUP), then swapped in and published to the other replicas.
+    Replicas watching the same file only publish a table that differs from the one in Redis.
+    """
+
+    key = 'networks'
+    version_key = 'networks.version'
+    channel = 'networks.changed'
+
+    def __init__(self, redis_client, networks_file_path: str = 'config/networks.csv', cache_expire: int = 28800,
+                 subscribe: bool = True, check_interval: float = 10):
+        self.redis = redis_client
+        self.networks_file_path = networks_file_path
+        self.cache_expire = cache_expire
+        self.check_interval = check_interval
+        self.index = SubnetIndex()
+        self.version = None
+        self._stale = True
+        self._expires = 0
+        self._loaded = False
+        # Held while the table is loaded or rebuilt
+        self._lock = threading.Lock()
+        # Held while a background refresh is scheduled or running
+        self._refresh_lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        # (mtime, size) of networks.csv when it was last loaded, None until then
+        self._file_stat = None
+        self._next_check = 0
+        self._pubsub_thread = None
+        if subscribe:
+            self._subscribe()
+            self._refresh_in_background()
+
+    def _subscribe(self):
+        db = self.redis.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._invalidate, f"__keyspace@{db}__:{self.key}": self._invalidate})
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True,
+                                                   exception_handler=self._pubsub_exception)
+
+    def _invalidate(self, message=None):
+        try:
+            if str(json.loads(message['data'])['version']).encode() == self.version:
+                # Our own publication, the index is already up to date
+                return
+        except (TypeError, ValueError, KeyError):
+            # Keyspace notifications don't carry a version
+            pass
+        self._stale = True
+        self._refresh_in_background()
+
+    def _pubsub_exception(self, e, pubsub, thread):
+        # Changes may have been missed while disconnected
+        logger.warning(f"Lost network table subscription, will refresh on next lookup: {e}")
+        self._stale = True
+        time.sleep(1)
+
+    def close(self):
+        if self._pubsub_thread:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+
+    def load_csv(self) -> list:
+        with open(self.networks_file_path, 'r') as csv_file:
+            return list(DictReader(csv_file))
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.networks_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_file(self):
+        """
+        Build the index from networks.csv and publish the table, unless Redis already holds the same one. Must be
+        called with the lock held.
+        """
+        stat = self._stat()
+        networks = self.load_csv()
+        # Swap in the new index before publishing it, so the notification finds it up to date
+        self.index = SubnetIndex(networks)
+        self._loaded = True
+        cached = self.redis.get(self.key)
+        if cached is not None and json.loads(cached) == networks:
+            self.version = self.redis.get(self.version_key)
+        else:
+            logger.info(f"Loading network table from {self.networks_file_path}")
+            self.publish(networks, on_version=self._set_version)
+        self._file_stat = stat
+        self._expires = time.monotonic() + self.cache_expire
+
+    def _set_version(self, version: int):
+        self.version = str(version).encode()
+
+    def reload(self, networks_file_path: Optional[str] = None):
+        """
+        Re-read networks.csv now, or switch to another file, and swap in the new index.
+        """
+        with self._lock:
+            if networks_file_path:
+                self.networks_file_path = networks_file_path
+            self._stale = False
+            try:
+                self._load_file()
+            except BaseException:
+                self._stale = True
+                raise
+        logger.info(f"Reloaded network table with {len(self.index)} subnets from {self.networks_file_path}")
+
+    def reload_in_background(self, networks_file_path: Optional[str] = None):
+        """
+        Same as reload(), on a separate thread. Errors are logged and the previous index is kept.
+        """
+        def run():
+            try:
+                self.reload(networks_file_path)
+            except Exception as e:
+                logger.error(f"Unable to reload network table from {networks_file_path or self.networks_file_path}: "
+                             f"{e}")
+
+        threading.Thread(target=run, name='networks-reload', daemon=True).start()
+
+    def config_changed(self, previous: dict, config: dict):
+        """
+        ReloadingProfileMap listener: switch to another file when networks_file_path is changed in config.yaml.
+        """
+        networks_file_path = config.get('networks_file_path')
+        if networks_file_path and networks_file_path != previous.get('networks_file_path'):
+            self.reload_in_background(networks_file_path)
+
+    def _check_file(self):
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            stat = self._stat()
+            if self._file_stat is not None and stat is not None and stat != self._file_stat:
+                # Don't start another reload for the same change on the next check
+                self._file_stat = stat
+                self.reload_in_background()
+        finally:
+            self._check_lock.release()
+
+    def publish(self, networks: list, delta: dict = None, on_version: Optional[Callable[[int], None]] = None) -> int:
+        """
+        Store a network table in Redis and notify all replicas.
+
+        :param networks: List of networks.csv rows
+        :param delta: Optional summary of what changed (e.g. added/changed/removed network IDs), sent along with
+            the notification
+        :param on_version: Called with the new table version before the notification is sent
+        :return: The new table version
+        """
+        pipe = self.redis.pipeline()
+        pipe.set(self.key, json.dumps(networks), ex=self.cache_expire)
+        pipe.incr(self.version_key)
+        version = pipe.execute()[1]
+        if on_version is not None:
+            on_version(version)
+        self.redis.publish(self.channel, json.dumps({'version': version, **(delta or {})}))
+        return version
+
+    def refresh(self):
+        """
+        Bring the index up to date with the table in Redis (or networks.csv), building the new one aside.
+        """
+        with self._lock:
+            # Another thread may have refreshed while we were waiting for the lock
+            if not self._stale and time.monotonic() < self._expires:
+                return
+            # Cleared first, so a notification that arrives while we rebuild isn't lost
+            self._stale = False
+            try:
+                pipe = self.redis.pipeline()
+                pipe.get(self.version_key)
+                pipe.exists(self.key)
+                version, cached = pipe.execute()
+                if not cached or (self._file_stat is None and self._stat() is not None):
+                    # The table expired, or this process has not read networks.csv yet: what is in Redis may be older
+                    self._load_file()
+                    return
+                if version != self.version or not self._loaded:
+                    logger.info(f"Network table changed (version {version}), rebuilding subnet index")
+                    self.index = SubnetIndex(json.loads(self.redis.get(self.key) or '[]'))
+                    self._loaded = True
+                    self.version = version
+                self._expires = time.monotonic() + self.cache_expire
+            except BaseException:
+                self._stale = True
+                raise
+
+    def _refresh_in_background(self):
+        """
+        Run refresh() on a separate thread, unless one is already scheduled. Errors are logged and the previous
+        index is kept until the next attempt.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Unable to refresh network table: {e}")
+                # Don't retry on every lookup while Redis is unavailable
+                time.sleep(1)
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, name='networks-refresh', daemon=True).start()
+
+    def lookup(self, ip: str) -> Optional[str]:
+        """
+        Map an IP address to a Meraki network ID using the local subnet index.
+
+        :param ip: IPv4 or IPv6 address
+        :return: The network ID or None if no subnet matches
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._check_file()
+        if self._stale or now >= self._expires:
+            if self._loaded:
+                self._refresh_in_background()
+            else:
+                # Nothing to answer from yet
+                self.refresh()
+        return self.index.lookup(ip)
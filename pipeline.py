@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from provisioner import ProvisioningQueue
+from work_queue import ProvisioningStream
+
+logger = logging.getLogger("meraki_ise.pipeline")
+
+
+class PipelineConfig:
+    def __init__(self, config):
+        self.queue_size = int(config.get('pipeline_queue_size', 1000))
+        self.map_workers = int(config.get('pipeline_map_workers', 1))
+        self.provision_concurrency = int(config.get('pipeline_provision_concurrency', 500))
+        self.stats_interval = float(config.get('pipeline_stats_interval', 60))
+        self.coalesce_window = float(config.get('pipeline_coalesce_window', 0.5))
+
+
+class SessionCoalescer:
+    """
+    Collapses session updates for the same MAC address that arrive within a window.
+
+    ISE publishes several messages per endpoint during one authentication (STARTED, AUTHENTICATED, accounting
+    updates). The first update for a MAC opens a window of `window` seconds; later updates within it replace the
+    pending session, so only the latest state is mapped and provisioned. Windows are not extended by later updates,
+    which bounds the added latency to `window`.
+    """
+
+    def __init__(self, window: float, max_pending: int, mac_key: str = 'macAddress', batch_size: int = 100):
+        self.window = window
+        self.max_pending = max_pending
+        self.mac_key = mac_key
+        self.batch_size = batch_size
+        # MAC -> (deadline, session), in deadline order since deadlines are only set on insertion
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self.counters = {'sessions': 0, 'collapsed': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, session: dict) -> bool:
+        """
+        :return: False if the session was collapsed into a pending update for the same MAC
+        """
+        self.counters['sessions'] += 1
+        mac = session.get(self.mac_key)
+        pending = self._pending.get(mac)
+        if pending is not None:
+            self.counters['collapsed'] += 1
+            self._pending[mac] = (pending[0], session)
+            return False
+        self._pending[mac] = (asyncio.get_running_loop().time() + self.window, session)
+        self._wakeup.set()
+        return True
+
+    def is_full(self) -> bool:
+        return len(self._pending) >= self.max_pending
+
+    def pop_due(self, flush_all: bool = False) -> list:
+        """
+        Remove and return the sessions whose window has passed (or all of them), in messages of batch_size sessions.
+        """
+        now = asyncio.get_running_loop().time()
+        sessions = []
+        for mac, (deadline, session) in list(self._pending.items()):
+            if not flush_all and deadline > now:
+                break
+            del self._pending[mac]
+            sessions.append(session)
+        return [{'sessions': sessions[i:i + self.batch_size]} for i in range(0, len(sessions), self.batch_size)]
+
+    async def wait_due(self):
+        """
+        Wait until the oldest pending session is due.
+        """
+        while not self._pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        loop = asyncio.get_running_loop()
+        # The loop can wake a timer up to its clock resolution early, so sleep until the deadline has really passed
+        deadline = next(iter(self._pending.values()))[0]
+        while deadline > loop.time():
+            await asyncio.sleep(deadline - loop.time())
+
+
+class SessionPipeline:
+    """
+    Bounded asyncio pipeline between pxGrid message intake and provisioning.
+
+        read -> coalescer -> [message queue] -> map workers -> [provision queue] -> provision dispatcher
+             -> ProvisioningQueue
+
+    The reader only has to put messages on the message queue, so the websocket keeps pace with ISE while mapping
+    and provisioning happen in the background. Up to map_workers messages are mapped concurrently, with the mapper's
+    map_async() if it has one or on a thread pool otherwise, and at most provision_concurrency clients are in flight
+    at the Dashboard. When a later stage falls behind its queue fills up and put() blocks, pushing back onto the
+    reader instead of growing memory without bound.
+
+    With a durable work queue the map workers add changed mappings to a Redis Stream instead, which is consumed
+    with the same in-flight limit (see ProvisioningStream).
+
+    With a pipeline_coalesce_window, updates for the same MAC within the window are collapsed into the latest one
+    before mapping (see SessionCoalescer).
+
+    Note that more than one map worker may reorder updates for the same client.
+    """
+
+    def __init__(self, mapper, provisioner: ProvisioningQueue, config: PipelineConfig,
+                 work_queue: ProvisioningStream = None):
+        self.mapper = mapper
+        self.provisioner = provisioner
+        self.work_queue = work_queue
+        self.config = config
+        self.messages = asyncio.Queue(maxsize=config.queue_size)
+        self.provisions = asyncio.Queue(maxsize=config.queue_size)
+        self._in_flight = asyncio.Semaphore(config.provision_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=config.map_workers, thread_name_prefix='mapper')
+        self._in_flight_count = 0
+        self._coalescer = None
+        if config.coalesce_window > 0:
+            self._coalescer = SessionCoalescer(config.coalesce_window, config.queue_size * 10)
+        self._tasks = []
+        self.counters = {'messages': 0, 'mapped': 0, 'provisioned': 0, 'failed': 0}
+        metrics.track_queue('messages', self, lambda pipeline: pipeline.messages.qsize())
+        metrics.track_queue('provisions', self, lambda pipeline: pipeline.provisions.qsize())
+        metrics.track_queue('in_flight', self, lambda pipeline: pipeline._in_flight_count)
+        if self._coalescer is not None:
+            metrics.track_queue('coalescer', self, lambda pipeline: len(pipeline._coalescer))
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._map_worker()) for _ in range(self.config.map_workers)]
+        if self.work_queue is not None:
+            self._tasks.append(asyncio.ensure_future(self.work_queue.run(self.provisioner, self._in_flight)))
+        else:
+            self._tasks.append(asyncio.ensure_future(self._provision_dispatcher()))
+        if self._coalescer is not None:
+            self._tasks.append(asyncio.ensure_future(self._coalesce_flusher()))
+        if self.config.stats_interval > 0:
+            self._tasks.append(asyncio.ensure_future(self._log_stats()))
+
+    async def put(self, message: dict):
+        """
+        Hand a pxGrid message to the pipeline, waiting while the message queue is full.
+        """
+        self.counters['messages'] += 1
+        if self._coalescer is None:
+            await self.messages.put(message)
+            return
+
+        for session in message.get('sessions', []):
+            self._coalescer.add(session)
+        if self._coalescer.is_full():
+            # Don't let the coalescer grow without bound when the map stage falls behind
+            for batch in self._coalescer.pop_due(flush_all=True):
+                await self.messages.put(batch)
+
+    async def _coalesce_flusher(self):
+        while True:
+            await self._coalescer.wait_due()
+            for batch in self._coalescer.pop_due():
+                await self.messages.put(batch)
+
+    def reload(self):
+        """
+        Re-read config.yaml and networks.csv in the background, if the mapper supports it.
+        """
+        if hasattr(self.mapper, 'reload'):
+            threading.Thread(target=self.mapper.reload, name='reload', daemon=True).start()
+
+    def stats(self) -> dict:
+        coalescer = {}
+        if self._coalescer is not None:
+            coalescer = {'coalesce_pending': len(self._coalescer),
+                         'coalesce_sessions': self._coalescer.counters['sessions'],
+                         'coalesce_collapsed': self._coalescer.counters['collapsed']}
+        return {**coalescer,
+                'message_queue': self.messages.qsize(),
+                'provision_queue': self.provisions.qsize(),
+                'in_flight': self._in_flight_count,
+                **self.counters,
+                **(self.work_queue.stats() if self.work_queue is not None else {}),
+                'dashboard': self.provisioner.rate_limiter.usage()}
+
+    async def _map_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self.messages.get()
+            try:
+                if self.work_queue is not None:
+                    # The cache is only committed once the client has been provisioned
+                    changed = await self.mapper.map_uncommitted_async(message, queued_key=self.work_queue.queued_key)
+                    await self.work_queue.enqueue(changed)
+                    self.counters['mapped'] += len(changed)
+                    continue
+                if hasattr(self.mapper, 'map_async'):
+                    mapped_users = await self.mapper.map_async(message)
+                else:
+                    mapped_users = await loop.run_in_executor(self._executor, self.mapper.map, message)
+                for user in mapped_users:
+                    self.counters['mapped'] += 1
+                    await self.provisions.put(user)
+            except Exception as e:
+                logger.exception(f"Error while mapping pxGrid message: {e}")
+            finally:
+                self.messages.task_done()
+
+    async def _provision_dispatcher(self):
+        while True:
+            user = await self.provisions.get()
+            await self._in_flight.acquire()
+            self._in_flight_count += 1
+            future = self.provisioner.provision(*user)
+            future.add_done_callback(self._provisioned)
+            self.provisions.task_done()
+
+    def _provisioned(self, future: asyncio.Future):
+        self._in_flight.release()
+        self._in_flight_count -= 1
+        if future.cancelled() or future.exception():
+            self.counters['failed'] += 1
+        else:
+            self.counters['provisioned'] += 1
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self.config.stats_interval)
+            logger.info(f"Pipeline stats: {self.stats()}")
+
+    async def _join(self):
+        await self.messages.join()
+        await self.provisions.join()
+
+    async def close(self, timeout: float = 10):
+        """
+        Drain the queues (for at most timeout seconds), then stop the workers and the provisioning queue.
+        """
+        if self._coalescer is not None:
+            for batch in self._coalescer.pop_due(flush_all=True):
+                await self.messages.put(batch)
+        try:
+            # One after the other: the provision queue may only fill up once the messages have been mapped
+            await asyncio.wait_for(self._join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Pipeline not drained after {timeout}s, dropping {self.stats()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+        await self.provisioner.close()
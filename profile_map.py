@@ -0,0 +1,149 @@
+import fnmatch
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+import yaml
+
+logger = logging.getLogger("meraki_ise.profile_map")
+
+
+class ProfileMap:
+    """
+    Precompiled, case insensitive lookup of profile (role) names to group policy IDs.
+
+    Keys of the profile_map config are matched case insensitively. Keys prefixed with 're:' are regular expressions
+    and keys containing shell wildcards (*, ? or [) are glob patterns. An exact name always wins over a pattern,
+    patterns are tried in the order they appear in the config. Pattern results are memoized per profile name, so
+    every distinct name is only matched against the patterns once.
+
+    When a session carries several profiles, `priority` decides which mapping is used: 'session' (the default)
+    takes the first of the session's profiles that maps to a group, 'config' the one that comes first in the
+    profile_map config.
+    """
+
+    def __init__(self, profile_map: Optional[dict], priority: str = 'session'):
+        if priority not in ('session', 'config'):
+            raise ValueError(f"Unknown profile map priority {priority!r}, use 'session' or 'config'")
+        self.priority = priority
+        self._exact = {}
+        self._patterns = []
+        self._memo = {}
+        for rank, (name, group) in enumerate((profile_map or {}).items()):
+            name = str(name)
+            entry = (rank, str(group))
+            if name.startswith('re:'):
+                self._patterns.append((re.compile(name[3:], re.IGNORECASE), entry))
+            elif any(c in name for c in '*?['):
+                self._patterns.append((re.compile(fnmatch.translate(name.casefold())), entry))
+            else:
+                self._exact.setdefault(name.casefold(), entry)
+
+    def __len__(self):
+        return len(self._exact) + len(self._patterns)
+
+    def _lookup(self, profile: str) -> Optional[tuple]:
+        key = profile.casefold()
+        entry = self._exact.get(key)
+        if entry is not None:
+            return entry
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        entry = next((entry for pattern, entry in self._patterns if pattern.fullmatch(key)), None)
+        # Only ever holds the distinct profile names seen, but don't let garbage input grow it without bound
+        if len(self._memo) < 65536:
+            self._memo[key] = entry
+        return entry
+
+    def lookup(self, profile: str) -> Optional[str]:
+        """
+        :return: The group policy ID for a single profile name, or None
+        """
+        entry = self._lookup(profile)
+        return entry[1] if entry else None
+
+    def match(self, profiles: Iterable[str]) -> Optional[str]:
+        """
+        :return: The group policy ID for a list of profile names, according to the priority setting, or None
+        """
+        best = None
+        for profile in profiles:
+            entry = self._lookup(profile)
+            if entry is None:
+                continue
+            if self.priority == 'session':
+                return entry[1]
+            if best is None or entry[0] < best[0]:
+                best = entry
+        return best[1] if best else None
+
+
+class ReloadingProfileMap:
+    """
+    Holds the compiled ProfileMap and recompiles it when config.yaml changes.
+
+    The config file's mtime is checked at most every check_interval seconds, from whichever thread calls get(), or
+    it is reloaded right away with reload() (e.g. on SIGHUP). Listeners added with add_listener() are called with the
+    previous and the new contents of the config file after every reload, to pick up other settings.
+    """
+
+    def __init__(self, config: dict, check_interval: float = 10):
+        self.config_file_path = config.get('config_file_path')
+        self.check_interval = check_interval
+        self.current = ProfileMap(config.get('profile_map'), config.get('profile_map_priority', 'session'))
+        self._mtime = self._stat()
+        self._next_check = time.monotonic() + check_interval
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._file_config = {}
+        if self.config_file_path:
+            try:
+                self._file_config = self._read()
+            except (OSError, yaml.YAMLError):
+                pass
+
+    def add_listener(self, listener: Callable[[dict, dict], None]):
+        self._listeners.append(listener)
+
+    def _read(self) -> dict:
+        with open(self.config_file_path, 'r') as config_file:
+            return yaml.safe_load(config_file) or {}
+
+    def _stat(self) -> Optional[float]:
+        if not self.config_file_path:
+            return None
+        try:
+            return os.stat(self.config_file_path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        if not self.config_file_path:
+            return
+        self._mtime = self._stat()
+        config = self._read()
+        # Swap in the new map with a single assignment, lookups in flight keep using the old one
+        self.current = ProfileMap(config.get('profile_map'), config.get('profile_map_priority', 'session'))
+        logger.info(f"Reloaded profile map with {len(self.current)} entries from {self.config_file_path}")
+        previous, self._file_config = self._file_config, config
+        for listener in self._listeners:
+            listener(previous, config)
+
+    def get(self) -> ProfileMap:
+        if self.config_file_path and time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._next_check = time.monotonic() + self.check_interval
+                mtime = self._stat()
+                if mtime is not None and mtime != self._mtime:
+                    self._mtime = mtime
+                    self.reload()
+            except Exception as e:
+                logger.error(f"Unable to reload profile map from {self.config_file_path}: {e}")
+            finally:
+                self._lock.release()
+        return self.current
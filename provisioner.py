@@ -0,0 +1,302 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import meraki
+import meraki.exceptions
+from requests.adapters import HTTPAdapter
+
+import metrics
+from rate_limiter import get_rate_limiter
+
+logger = logging.getLogger("meraki_ise.provisioner")
+
+DEVICE_POLICY = 'Group policy'
+API_ERRORS = (meraki.exceptions.APIError, meraki.exceptions.AsyncAPIError)
+
+
+class MerakiConfig:
+    def __init__(self, config):
+        self.api_key = config['meraki_api_key']
+        self.base_url = config.get('meraki_base_url', 'https://api.meraki.com/api/v1')
+        self.batch_window = float(config.get('provision_batch_window', 0.5))
+        self.batch_size = int(config.get('provision_batch_size', 100))
+        self.max_connections = int(config.get('meraki_max_connections', 10))
+        self.use_asyncio = bool(config.get('meraki_use_asyncio', False))
+        self.rate_limit = float(config.get('meraki_rate_limit', 10))
+        self.rate_burst = float(config.get('meraki_rate_burst', 10))
+        self.max_retries = int(config.get('meraki_max_retries', 5))
+        # The Dashboard API budget is shared with the other processes through Redis
+        self.rate_limit_shared = bool(config.get('meraki_rate_limit_shared', True))
+        self.redis_host = config.get('redis_host', 'localhost')
+        self.redis_port = config.get('redis_port', 6379)
+        self.redis_db = config.get('redis_db', 0)
+
+
+_dashboard = None
+_dashboard_lock = threading.Lock()
+
+
+def get_dashboard(meraki_config: MerakiConfig) -> meraki.DashboardAPI:
+    """
+    Return the process wide Dashboard API client, creating it on first use.
+
+    The client (and its keep-alive HTTP connection pool) is shared by all provisioning calls instead of doing a new
+    SDK setup and TLS handshake per client.
+    """
+    global _dashboard
+    with _dashboard_lock:
+        if _dashboard is None:
+            # 429s are handled by our rate limiter, which pauses all callers instead of just the one that was refused
+            _dashboard = meraki.DashboardAPI(meraki_config.api_key, base_url=meraki_config.base_url,
+                                             output_log=False, print_console=False, wait_on_rate_limit=False)
+            # SDKs based on requests use its default pool of 10 connections, size it to match our workers. Newer
+            # SDKs use httpx and don't expose their pool size, there meraki_max_connections only caps concurrency.
+            req_session = getattr(getattr(_dashboard, '_session', None), '_req_session', None)
+            if req_session is not None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=meraki_config.max_connections)
+                req_session.mount('https://', adapter)
+            else:
+                logger.warning(f"Meraki SDK {meraki.__version__} doesn't allow sizing its connection pool, "
+                               f"meraki_max_connections only limits the number of concurrent Dashboard calls "
+                               f"(it sizes the pool with meraki_use_asyncio)")
+        return _dashboard
+
+
+def provision_clients(dashboard: meraki.DashboardAPI, network_id: str, clients: List[dict], mapped_group: str):
+    """
+    Provision a list of clients into a group policy with a single provisionNetworkClients call.
+
+    :param dashboard: Meraki Dashboard API client
+    :param network_id: Meraki network ID
+    :param clients: List of {'mac': ..., 'name': ...} dicts
+    :param mapped_group: Group policy ID
+    """
+    return dashboard.networks.provisionNetworkClients(network_id,
+                                                     clients,
+                                                     DEVICE_POLICY,
+                                                     groupPolicyId=str(mapped_group))
+
+
+class ProvisioningQueue:
+    """
+    Coalesces client provisioning into bulk provisionNetworkClients calls.
+
+    Clients are grouped by (network_id, group policy). A group is sent as soon as it holds batch_size clients or
+    batch_window seconds after its first client was queued, whichever comes first. If a bulk call fails every client
+    of the batch is retried on its own, so errors are still reported (and raised) per client.
+
+    Batches are sent concurrently, so the queue keeps at most one update per MAC queued and one in flight: a newer
+    update replaces a queued one (whose future then resolves with the newer one's outcome), and an update for a
+    client whose previous call is still in flight waits for that call before it is queued. A client's group can
+    therefore never be overwritten by an older one.
+
+    Calls go through the shared synchronous Dashboard client on a small thread pool, or, with meraki_use_asyncio,
+    through the SDK's meraki.aio client directly on the event loop. Either way every call is paced by the shared
+    Dashboard rate limiter at interactive priority.
+    """
+
+    def __init__(self, meraki_config: MerakiConfig):
+        self.meraki_config = meraki_config
+        self.batch_window = meraki_config.batch_window
+        self.batch_size = meraki_config.batch_size
+        self._batches: Dict[Tuple[str, str], List[Tuple[dict, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+        # By MAC: the update queued in a batch, the future of the one in flight and the one waiting for it
+        self._queued: Dict[str, Tuple[Tuple[str, str], Tuple[dict, asyncio.Future]]] = {}
+        self._sending: Dict[str, asyncio.Future] = {}
+        self._waiting: Dict[str, Tuple[Tuple[str, str], Tuple[dict, asyncio.Future]]] = {}
+        self._tasks = set()
+        self._executor = None
+        self._aio_dashboard = None
+        self._aio_context = contextlib.AsyncExitStack()
+        self.rate_limiter = get_rate_limiter(meraki_config)
+        metrics.track_queue('provision_batches', self,
+                            lambda queue: sum(len(batch) for batch in queue._batches.values()))
+        metrics.track_queue('dashboard_waiting', self, lambda queue: queue.rate_limiter.waiting())
+
+    def provision(self, network_id: str, mac: str, username: str, mapped_group: str) -> asyncio.Future:
+        """
+        Queue a client for provisioning.
+
+        :return: Future that resolves once the client has been provisioned (or failed to)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (network_id, str(mapped_group))
+        # Failures are logged by the queue, so callers may fire and forget without unretrieved exception warnings
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        item = ({'mac': mac, 'name': username}, future)
+
+        # An update that wasn't sent yet is replaced by this one
+        if mac in self._queued:
+            queued_key, queued_item = self._queued.pop(mac)
+            batch = self._batches[queued_key]
+            batch.remove(queued_item)
+            if not batch:
+                del self._batches[queued_key]
+                timer = self._timers.pop(queued_key, None)
+                if timer:
+                    timer.cancel()
+            self._chain(queued_item[1], future)
+        if mac in self._waiting:
+            self._chain(self._waiting.pop(mac)[1][1], future)
+
+        if mac in self._sending:
+            self._waiting[mac] = (key, item)
+        else:
+            self._add(key, item)
+        return future
+
+    @staticmethod
+    def _chain(replaced: asyncio.Future, future: asyncio.Future):
+        """
+        Resolve the future of a replaced update with the outcome of the update that replaced it.
+        """
+        def resolve(f: asyncio.Future):
+            if replaced.done():
+                return
+            if f.cancelled():
+                replaced.cancel()
+            elif f.exception() is not None:
+                replaced.set_exception(f.exception())
+            else:
+                replaced.set_result(f.result())
+
+        future.add_done_callback(resolve)
+
+    def _add(self, key: Tuple[str, str], item: Tuple[dict, asyncio.Future]):
+        batch = self._batches.setdefault(key, [])
+        batch.append(item)
+        self._queued[item[0]['mac']] = (key, item)
+
+        if len(batch) >= self.batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.batch_window, self._flush, key)
+
+    def _flush(self, key: Tuple[str, str]):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self._batches.pop(key, None)
+        if batch:
+            for client, future in batch:
+                del self._queued[client['mac']]
+                self._sending[client['mac']] = future
+                future.add_done_callback(functools.partial(self._sent, client['mac']))
+            task = asyncio.ensure_future(self._send(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _sent(self, mac: str, future: asyncio.Future):
+        if self._sending.get(mac) is future:
+            del self._sending[mac]
+            # Queue the update that waited for this call
+            if mac in self._waiting:
+                self._add(*self._waiting.pop(mac))
+
+    async def _call(self, network_id: str, clients: List[dict], mapped_group: str):
+        # The Dashboard call itself and the wait for a thread, the rate limiter's budget or a 429 pause before each
+        # attempt are timed separately
+        waiting_since = time.perf_counter()
+
+        def timed(*args):
+            nonlocal waiting_since
+            metrics.DASHBOARD_WAIT.observe(time.perf_counter() - waiting_since)
+            try:
+                with metrics.PROVISION.time():
+                    return provision_clients(*args)
+            finally:
+                waiting_since = time.perf_counter()
+
+        async def timed_async(*args):
+            nonlocal waiting_since
+            metrics.DASHBOARD_WAIT.observe(time.perf_counter() - waiting_since)
+            try:
+                with metrics.PROVISION.time():
+                    return await provision_clients(*args)
+            finally:
+                waiting_since = time.perf_counter()
+
+        if self.meraki_config.use_asyncio:
+            if self._aio_dashboard is None:
+                # Only needed with meraki_use_asyncio, so only import it when asked for
+                import meraki.aio
+                # Entered as a context manager so close() can shut it down through the SDK's public interface
+                self._aio_dashboard = await self._aio_context.enter_async_context(meraki.aio.AsyncDashboardAPI(
+                    self.meraki_config.api_key, base_url=self.meraki_config.base_url, output_log=False,
+                    print_console=False, wait_on_rate_limit=False,
+                    maximum_concurrent_requests=self.meraki_config.max_connections))
+            return await self.rate_limiter.call_async(timed_async, self._aio_dashboard,
+                                                      network_id, clients, mapped_group)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.meraki_config.max_connections,
+                                                thread_name_prefix='provisioner')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(
+            self.rate_limiter.call, timed, get_dashboard(self.meraki_config),
+            network_id, clients, mapped_group))
+
+    async def _send(self, key: Tuple[str, str], batch: List[Tuple[dict, asyncio.Future]]):
+        network_id, mapped_group = key
+        clients = [client for client, _ in batch]
+        try:
+            result = await self._call(network_id, clients, mapped_group)
+        except API_ERRORS as e:
+            metrics.DASHBOARD_CALLS.labels(metrics.provisioning_status(e)).inc()
+            if len(batch) == 1:
+                self._fail(network_id, *batch[0], e)
+                return
+            logger.warning(f"Bulk provisioning of {len(batch)} clients into network {network_id} failed ({e}), "
+                           f"retrying clients individually")
+            await asyncio.gather(*(self._send(key, [item]) for item in batch))
+            return
+        except Exception as e:
+            metrics.DASHBOARD_CALLS.labels(metrics.provisioning_status(e)).inc()
+            for client, future in batch:
+                self._fail(network_id, client, future, e)
+            return
+
+        metrics.DASHBOARD_CALLS.labels(metrics.provisioning_status()).inc()
+        metrics.PROVISIONED_CLIENTS.labels('provisioned').inc(len(batch))
+        for client, future in batch:
+            logger.info(f"Provisioning user {client['name']} with MAC {client['mac']} into group {mapped_group}")
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(network_id: str, client: dict, future: asyncio.Future, e: Exception):
+        metrics.PROVISIONED_CLIENTS.labels('failed').inc()
+        if isinstance(e, API_ERRORS):
+            logger.error(f"Meraki API error while provisioning client {client['name']} ({client['mac']}) "
+                         f"into network {network_id}: {e}")
+        else:
+            logger.exception(f"Error while provisioning client {client['name']} ({client['mac']}) "
+                             f"into network {network_id}: {e}")
+        if not future.done():
+            future.set_exception(e)
+
+    async def close(self):
+        """
+        Send all queued batches and wait for outstanding calls to complete.
+        """
+        while self._batches or self._tasks:
+            for key in list(self._batches):
+                self._flush(key)
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            # Lets the updates that waited for those calls queue up
+            await asyncio.sleep(0)
+        if self._aio_dashboard is not None:
+            await self._aio_context.aclose()
+            self._aio_dashboard = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
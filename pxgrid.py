@@ -1,11 +1,25 @@
+import asyncio
+import codecs
+import concurrent.futures
 import json
 import logging
+import random
+import re
 import ssl
+import threading
+import time
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional
 
 import backoff
+import httpx
+import redis.exceptions
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from websockets.exceptions import ConnectionClosed, InvalidStatusCode, WebSocketException
 
+import metrics
 from ws_stomp import WebSocketStomp
 
 __author__ = "Felix Kaechele"
@@ -13,6 +27,13 @@ __email__ = "fkaechel@cisco.com"
 __copyright__ = "Copyright (c) 2020 Cisco and/or its affiliates"
 __license__ = "Cisco Sample Code License"
 
+logger = logging.getLogger("meraki_ise.pxgrid")
+
+# Errors that are worth retrying when (re)connecting to the pubsub service
+RECONNECT_ERRORS = (OSError, asyncio.TimeoutError, WebSocketException, requests.RequestException, LookupError)
+# Errors that mean a pxGrid node is unreachable, as opposed to it answering with an error
+FAILOVER_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.NetworkError, httpx.TimeoutException)
+
 class PxgridConfig:
     def __init__(self, config: map):
         self.host = config['pxgrid_host']
@@ -23,6 +44,131 @@ class PxgridConfig:
         self.client_key = config['pxgrid_client_key']
         self.ca_cert = config['pxgrid_ca_cert']
         self.ca_verify = config['pxgrid_ca_verify']
+        self.lookup_cache_ttl = int(config.get('pxgrid_lookup_cache_ttl', 3600))
+        self.secret_cache_ttl = int(config.get('pxgrid_secret_cache_ttl', 3600))
+        self.pool_size = int(config.get('pxgrid_pool_size', 10))
+        self.connect_timeout = float(config.get('pxgrid_connect_timeout', 5))
+        self.read_timeout = float(config.get('pxgrid_read_timeout', 30))
+        self.bootstrap = bool(config.get('pxgrid_bootstrap', True))
+        self.bootstrap_chunk_size = int(config.get('pxgrid_bootstrap_chunk_size', 100))
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str) -> Iterator:
+    """
+    Yield the elements of the array under `key` of a JSON object that arrives in chunks, e.g. a streamed HTTP
+    response, without ever holding the whole document. Only the current element and one chunk are kept in memory.
+
+    :param chunks: The document as UTF-8 encoded chunks
+    :param key: Key of the array in the top level object
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    buffer = ''
+    pos = None
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        if pos is None:
+            match = start.search(buffer)
+            if match is None:
+                # Keep enough of the tail to find a key that is split across chunks
+                buffer = buffer[-(len(key) + 64):]
+                continue
+            pos = match.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element continues in the next chunk
+                break
+            if end == len(buffer):
+                # A number may continue in the next chunk
+                break
+            yield element
+            pos = end
+        buffer = buffer[pos:]
+        pos = 0
+    if pos is not None:
+        raise ValueError(f"JSON document ended inside the {key!r} array")
+
+
+class PxgridCache:
+    """
+    TTL cache for ServiceLookup results and access secrets.
+
+    With a Redis client the entries are shared by all processes and survive restarts, otherwise they only live as
+    long as the process. Redis errors are logged and treated as cache misses.
+    """
+
+    def __init__(self, redis_client=None, prefix: str = 'pxgrid'):
+        self.redis = redis_client
+        self.prefix = prefix
+        self._local = {}
+
+    def get(self, key: str):
+        if self.redis is None:
+            value, expires = self._local.get(key, (None, 0))
+            return value if expires > time.monotonic() else None
+        try:
+            value = self.redis.get(f"{self.prefix}.{key}")
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Unable to read {key} from the pxGrid cache: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value, ttl: int):
+        if ttl <= 0:
+            return
+        if self.redis is None:
+            self._local[key] = (value, time.monotonic() + ttl)
+            return
+        try:
+            self.redis.set(f"{self.prefix}.{key}", json.dumps(value), ex=ttl)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Unable to write {key} to the pxGrid cache: {e}")
+
+    def delete(self, key: str):
+        if self.redis is None:
+            self._local.pop(key, None)
+            return
+        try:
+            self.redis.delete(f"{self.prefix}.{key}")
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Unable to delete {key} from the pxGrid cache: {e}")
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session(config: PxgridConfig) -> requests.Session:
+    """
+    Return the keep-alive HTTP session shared by all pxGrid REST calls made with a configuration, creating it on
+    first use.
+
+    Connections (and their TLS handshakes with client certificate auth) are reused across ServiceLookup,
+    AccessSecret and session service calls instead of opening a new one per request.
+    """
+    with _http_sessions_lock:
+        session = _http_sessions.get(config)
+        if session is None:
+            session = requests.Session()
+            if config.client_cert:
+                session.auth = HTTPBasicAuth(config.nodename, '')
+                session.cert = (config.client_cert, config.client_key)
+            else:
+                session.auth = HTTPBasicAuth(config.nodename, config.password)
+            session.verify = config.ca_cert if config.ca_verify else False
+            # One pool per pxGrid node (controller and PSNs), each holding up to pool_size connections
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=config.pool_size))
+            _http_sessions[config] = session
+        return session
 
 
 class PxgridRest:
@@ -30,7 +176,10 @@ class PxgridRest:
     def __init__(self, config: PxgridConfig):
         self.account_active = False
         self.config = config
-        self.base_url = f"https://{self.config.host}:8910/pxgrid/control/"
+        self.control_url = f"https://{self.config.host}:8910/pxgrid/control/"
+        self.base_url = self.control_url
+        self.http = get_http_session(config)
+        self._aio_session = None
 
     @backoff.on_predicate(backoff.fibo, max_tries=10)
     def _account_activate(self):
@@ -44,25 +193,64 @@ class PxgridRest:
         payload = {}
         if self.config.description:
             payload['description'] = self.config.description
-        return self.request('AccountActivate', payload, False)
+        return self.request('AccountActivate', payload, False, base_url=self.control_url)
 
-    def request(self, endpoint, payload, require_active_account=True):
+    def _post(self, endpoint, payload, require_active_account=True, stream=False,
+              base_url: Optional[str] = None) -> requests.Response:
         if not self.account_active and require_active_account:
             self.account_active = self._account_activate()
-        url = self.base_url + endpoint
+        url = (base_url or self.base_url) + endpoint
         logging.debug(f"pxgrid url={url}")
         json_string = json.dumps(payload)
         logging.debug(f"  request={json_string}")
-        if self.config.client_cert:
-            r = requests.post(url,
-                              auth=HTTPBasicAuth(self.config.nodename, ''),
-                              cert=(self.config.client_cert, self.config.client_key),
-                              json=payload,
-                              verify=self.config.ca_cert if self.config.ca_verify else False)
-        else:
-            r = requests.post(url,
-                              auth=HTTPBasicAuth(self.config.nodename, self.config.password),
-                              verify=self.config.ca_cert if self.config.ca_verify else False)
+        return self.http.post(url, json=payload, stream=stream,
+                              timeout=(self.config.connect_timeout, self.config.read_timeout))
+
+    def request(self, endpoint, payload, require_active_account=True, base_url: Optional[str] = None):
+        r = self._post(endpoint, payload, require_active_account, base_url=base_url)
+
+        response = {}
+        try:
+            response = r.json()
+        except json.decoder.JSONDecodeError:
+            pass
+
+        logging.debug(f"  response={response}")
+        return response
+
+    def _get_aio_session(self) -> httpx.AsyncClient:
+        if self._aio_session is None:
+            if self.config.ca_verify:
+                context = ssl.create_default_context(cafile=self.config.ca_cert)
+            else:
+                context = ssl._create_unverified_context()
+            if self.config.client_cert:
+                context.load_cert_chain(certfile=self.config.client_cert, keyfile=self.config.client_key)
+                auth = (self.config.nodename, '')
+            else:
+                auth = (self.config.nodename, self.config.password or '')
+            self._aio_session = httpx.AsyncClient(
+                auth=auth, verify=context,
+                limits=httpx.Limits(max_connections=self.config.pool_size,
+                                    max_keepalive_connections=self.config.pool_size),
+                timeout=httpx.Timeout(self.config.read_timeout, connect=self.config.connect_timeout))
+        return self._aio_session
+
+    async def _post_async(self, endpoint, payload, require_active_account=True) -> httpx.Response:
+        if not self.account_active and require_active_account:
+            loop = asyncio.get_running_loop()
+            self.account_active = await loop.run_in_executor(None, self._account_activate)
+        url = self.base_url + endpoint
+        logging.debug(f"pxgrid url={url}")
+        logging.debug(f"  request={json.dumps(payload)}")
+        return await self._get_aio_session().post(url, json=payload)
+
+    async def request_async(self, endpoint, payload, require_active_account=True):
+        """
+        Same as request(), but on the event loop through a pooled httpx session, so several REST calls can be in
+        flight at once.
+        """
+        r = await self._post_async(endpoint, payload, require_active_account)
 
         response = {}
         try:
@@ -73,53 +261,328 @@ class PxgridRest:
         logging.debug(f"  response={response}")
         return response
 
+    async def close_async(self):
+        if self._aio_session is not None:
+            await self._aio_session.aclose()
+            self._aio_session = None
+
 
 class PxgridService(PxgridRest):
+    """
+    A pxGrid service, provided by one or more nodes.
 
-    def __init__(self, config: PxgridConfig, service_name: str):
+    ServiceLookup results and access secrets are kept in a PxgridCache, so restarts and reconnects skip those
+    round trips. A random node is used first, which spreads several clients across the nodes, and failover()
+    moves on to the next one when a node is unreachable.
+    """
+
+    def __init__(self, config: PxgridConfig, service_name: str, cache: Optional[PxgridCache] = None):
         super().__init__(config)
-        lookup_result = self._lookup(service_name)
-        self.name = lookup_result['name']
-        self.node_name = lookup_result['nodeName']
-        self.properties = lookup_result['properties']
+        self.service_name = service_name
+        self.cache = cache if cache is not None else PxgridCache()
+        self.services = self._lookup(service_name)
+        self._index = random.randrange(len(self.services))
+        self._first_index = self._index
+        self._use(self.services[self._index])
+
+    def _use(self, service: dict):
+        self.name = service['name']
+        self.node_name = service['nodeName']
+        self.properties = service['properties']
 
-    def _lookup(self, service_name):
-        payload = {'name': service_name}
-        service_lookup_response = self.request('ServiceLookup', payload)
-        return service_lookup_response['services'][0]
+    def _lookup(self, service_name, refresh=False) -> List[dict]:
+        key = f"{self.config.nodename}.lookup.{service_name}"
+        services = None if refresh else self.cache.get(key)
+        if not services:
+            payload = {'name': service_name}
+            services = self.request('ServiceLookup', payload, base_url=self.control_url).get('services')
+            if not services:
+                raise LookupError(f"No pxGrid node provides the {service_name} service")
+            self.cache.set(key, services, self.config.lookup_cache_ttl)
+        return services
 
-    def get_access_secret(self):
-        payload = {'peerNodeName': self.node_name}
-        return self.request('AccessSecret', payload)['secret']
+    def failover(self):
+        """
+        Switch to the next node providing the service. Once every node was tried, look the service up again in
+        case the deployment changed.
+        """
+        previous = self.node_name
+        self._index = (self._index + 1) % len(self.services)
+        if self._index == self._first_index:
+            self.services = self._lookup(self.service_name, refresh=True)
+            self._index = self._first_index = random.randrange(len(self.services))
+        self._use(self.services[self._index])
+        logger.warning(f"Failing over {self.service_name} from pxGrid node {previous} to {self.node_name}")
+
+    def get_access_secret(self, refresh=False):
+        key = f"{self.config.nodename}.secret.{self.node_name}"
+        secret = None if refresh else self.cache.get(key)
+        if secret is None:
+            payload = {'peerNodeName': self.node_name}
+            secret = self.request('AccessSecret', payload, base_url=self.control_url)['secret']
+            self.cache.set(key, secret, self.config.secret_cache_ttl)
+        return secret
+
+    def invalidate_access_secret(self):
+        """
+        Drop the cached secret for the current node, e.g. after it was rejected, so no process reuses it.
+        """
+        self.cache.delete(f"{self.config.nodename}.secret.{self.node_name}")
 
 
 class PxgridSessionService(PxgridService):
-    def __init__(self, config: PxgridConfig):
-        super().__init__(config, 'com.cisco.ise.session')
+    def __init__(self, config: PxgridConfig, cache: Optional[PxgridCache] = None):
+        super().__init__(config, 'com.cisco.ise.session', cache)
+
+    def _use(self, service: dict):
+        super()._use(service)
         self.base_url = self.properties['restBaseUrl'] + '/'
 
+    def _post(self, endpoint, payload, require_active_account=True, stream=False,
+              base_url: Optional[str] = None) -> requests.Response:
+        if base_url is not None:
+            return super()._post(endpoint, payload, require_active_account, stream, base_url)
+        # Session queries go to the node providing the service, fail over to the others if it is unreachable
+        for attempt in range(len(self.services)):
+            try:
+                return super()._post(endpoint, payload, require_active_account, stream)
+            except FAILOVER_ERRORS as e:
+                if attempt == len(self.services) - 1:
+                    raise
+                logger.warning(f"pxGrid node {self.node_name} is unreachable: {e}")
+                self.failover()
+
+    async def _post_async(self, endpoint, payload, require_active_account=True) -> httpx.Response:
+        # Same failover as _post()
+        for attempt in range(len(self.services)):
+            try:
+                return await super()._post_async(endpoint, payload, require_active_account)
+            except FAILOVER_ERRORS as e:
+                if attempt == len(self.services) - 1:
+                    raise
+                logger.warning(f"pxGrid node {self.node_name} is unreachable: {e}")
+                # May look the service up again
+                await asyncio.get_running_loop().run_in_executor(None, self.failover)
+
     def get_user_groups_by_username(self, username):
         payload = {'userName': username}
         return self.request('getUserGroupByUserName', payload)['groups']
 
+    async def get_user_groups_by_username_async(self, username):
+        payload = {'userName': username}
+        return (await self.request_async('getUserGroupByUserName', payload))['groups']
+
+    def get_sessions(self, start_timestamp: Optional[str] = None) -> list:
+        """
+        :param start_timestamp: Only return sessions that changed at or after this ISO 8601 timestamp
+        :return: List of sessions
+        """
+        payload = {}
+        if start_timestamp:
+            payload['startTimestamp'] = start_timestamp
+        return self.request('getSessions', payload).get('sessions', [])
+
+    async def get_sessions_async(self, start_timestamp: Optional[str] = None) -> list:
+        payload = {}
+        if start_timestamp:
+            payload['startTimestamp'] = start_timestamp
+        return (await self.request_async('getSessions', payload)).get('sessions', [])
+
+    def iter_sessions(self, start_timestamp: Optional[str] = None, chunk_size: int = 100) -> Iterator[List[dict]]:
+        """
+        Like get_sessions(), but streams the response and yields the sessions in lists of up to chunk_size.
+        """
+        payload = {}
+        if start_timestamp:
+            payload['startTimestamp'] = start_timestamp
+        with self._post('getSessions', payload, stream=True) as r:
+            r.raise_for_status()
+            chunk = []
+            for session in iter_json_array(r.iter_content(chunk_size=65536), 'sessions'):
+                chunk.append(session)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    async def bootstrap(self, put: Callable[[dict], Awaitable], chunk_size: int = 100,
+                        skip: Optional[Callable[[dict], bool]] = None) -> int:
+        """
+        Feed every active session to put() as session messages of up to chunk_size sessions.
+
+        getSessions returns all active sessions in one response, which can be very large. It is streamed and parsed
+        incrementally in a thread that hands over one chunk at a time and waits until put() accepted it, so memory
+        stays bounded by chunk_size (plus whatever put() queues) no matter how many sessions there are.
+
+        :param put: Coroutine function taking a session message, e.g. SessionPipeline.put
+        :param skip: Optional predicate called on the event loop, sessions for which it is true are left out
+        :return: Number of sessions passed to put()
+        """
+        loop = asyncio.get_running_loop()
+        stopped = threading.Event()
+        handover = None
+        started = time.monotonic()
+
+        async def hand_over(sessions: List[dict]) -> int:
+            if skip is not None:
+                sessions = [session for session in sessions if not skip(session)]
+            if sessions:
+                await put({'sessions': sessions})
+            return len(sessions)
+
+        def produce() -> int:
+            nonlocal handover
+            count = 0
+            chunks = self.iter_sessions(chunk_size=chunk_size)
+            try:
+                for chunk in chunks:
+                    if stopped.is_set():
+                        break
+                    handover = asyncio.run_coroutine_threadsafe(hand_over(chunk), loop)
+                    try:
+                        added = handover.result()
+                    except concurrent.futures.CancelledError:
+                        break
+                    count += added
+                    if count // 10000 != (count - added) // 10000:
+                        logger.info(f"Bootstrapped {count} sessions so far")
+            finally:
+                chunks.close()
+            return count
+
+        try:
+            count = await loop.run_in_executor(None, produce)
+        except asyncio.CancelledError:
+            stopped.set()
+            if handover is not None:
+                handover.cancel()
+            raise
+        logger.info(f"Bootstrapped {count} active sessions in {time.monotonic() - started:.1f}s")
+        return count
+
+
+def _parse_timestamp(timestamp: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _log_reconnect_backoff(details):
+    logger.warning(f"Reconnecting to pxGrid failed, retrying in {details['wait']:.1f}s "
+                   f"(attempt {details['tries']}): {details['exception']}")
+
 
 class PxgridSessionPubsub(WebSocketStomp):
+    """
+    Session topic subscription that survives connection loss.
+
+    When the websocket drops, read_message() reconnects with exponential backoff and subscribes again. The first
+    attempt reuses the cached AccessSecret, every failed attempt fails over to the next pubsub node and fetches a
+    fresh secret for it. A secret the node rejected (HTTP 401) is also dropped from the cache. It then asks the session service for every session that changed since the last event
+    it saw and returns them as session messages of up to pxgrid_bootstrap_chunk_size sessions, so nothing that
+    happened during the outage is lost. The response is streamed like the bootstrap, so a long outage doesn't have
+    to fit in memory. Sessions seen both in the catch-up and on the topic are harmless, unchanged mappings are
+    skipped by the mapper's cache.
+    """
 
     def __init__(self, session_service: PxgridSessionService):
         self.config = session_service.config
         self.__session_service = session_service
         self.__session_pubsub_service = PxgridService(self.config,
-                                                      self.__session_service.properties['wsPubsubService'])
+                                                      self.__session_service.properties['wsPubsubService'],
+                                                      self.__session_service.cache)
         super().__init__(self.__session_pubsub_service.properties['wsUrl'],
                          self.config.nodename,
                          self.__session_pubsub_service.get_access_secret(),
                          self._create_ssl_context())
+        # Timestamp of the newest session event seen, as sent by ISE and parsed for comparison
+        self.last_timestamp = None
+        self._last_seen = None
+        self.reconnects = 0
+        self._failed_attempts = 0
+        self._catching_up = None
 
     async def connect(self):
         await super().connect()
         await self.stomp_connect(self.__session_pubsub_service.node_name)
         await self.stomp_subscribe(self.__session_service.properties['sessionTopic'])
 
+    @backoff.on_exception(backoff.expo, RECONNECT_ERRORS, max_value=60, on_backoff=_log_reconnect_backoff)
+    async def reconnect(self):
+        """
+        (Re)connect and subscribe, retrying until it works. Also used for the first connection, so a stale cached
+        secret or an unavailable node at startup is handled the same way.
+        """
+        reconnecting = self.ws is not None
+        if reconnecting:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+        self._pending.clear()
+        loop = asyncio.get_running_loop()
+        pubsub_service = self.__session_pubsub_service
+        try:
+            if self._failed_attempts:
+                # The node may be down or the cached secret may have been rotated
+                await loop.run_in_executor(None, pubsub_service.failover)
+                self.ws_url = pubsub_service.properties['wsUrl']
+            self.password = await loop.run_in_executor(None, pubsub_service.get_access_secret,
+                                                       self._failed_attempts > 0)
+            await self.connect()
+        except RECONNECT_ERRORS as e:
+            self._failed_attempts += 1
+            if isinstance(e, InvalidStatusCode) and e.status_code == 401:
+                pubsub_service.invalidate_access_secret()
+            raise
+        self._failed_attempts = 0
+        if reconnecting:
+            self.reconnects += 1
+        logger.info(f"{'Reconnected' if reconnecting else 'Connected'} to pxGrid pubsub service "
+                    f"{pubsub_service.node_name}")
+
+    async def catch_up(self) -> AsyncIterator[dict]:
+        """
+        Yield the sessions that changed since the last seen event as session messages. The response is read and
+        parsed in a thread, one chunk at a time.
+        """
+        if self.last_timestamp is None:
+            return
+        since = self.last_timestamp
+        loop = asyncio.get_running_loop()
+        chunks = self.__session_service.iter_sessions(since, self.config.bootstrap_chunk_size)
+        count = 0
+        try:
+            while True:
+                try:
+                    sessions = await loop.run_in_executor(None, next, chunks, None)
+                except (requests.RequestException, ValueError) as e:
+                    logger.error(f"Unable to catch up on sessions since {since} after {count} sessions: {e}")
+                    return
+                if sessions is None:
+                    break
+                count += len(sessions)
+                message = {'sessions': sessions}
+                self._track(message)
+                yield message
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                # Still being read in the thread after a cancellation, it is closed when garbage collected
+                pass
+        logger.info(f"Caught up on {count} sessions changed since {since}")
+
+    def _track(self, message: dict):
+        for session in message.get('sessions', ()):
+            timestamp = session.get('timestamp')
+            seen = _parse_timestamp(timestamp)
+            if seen is not None and (self._last_seen is None or seen > self._last_seen):
+                self._last_seen = seen
+                self.last_timestamp = timestamp
+
     def _create_ssl_context(self):
         #context = ssl.create_default_context()
         context = ssl._create_unverified_context()
@@ -130,5 +593,21 @@ class PxgridSessionPubsub(WebSocketStomp):
         return context
 
     async def read_message(self):
-        message = await self.stomp_read_message()
-        return json.loads(message)
+        while True:
+            if self._catching_up is not None:
+                try:
+                    return await self._catching_up.__anext__()
+                except StopAsyncIteration:
+                    self._catching_up = None
+            try:
+                body = await self.stomp_read_message()
+                # The body is the UTF-8 bytes of the frame, json.loads takes them without an intermediate str
+                with metrics.JSON_DECODE.time():
+                    message = json.loads(body)
+            except ConnectionClosed as e:
+                logger.warning(f"Websocket connection closed ({e}), reconnecting")
+                await self.reconnect()
+                self._catching_up = self.catch_up()
+                continue
+            self._track(message)
+            return message
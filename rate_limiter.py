@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import threading
+import time
+
+import meraki.exceptions
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+import metrics
+
+logger = logging.getLogger("meraki_ise.rate_limiter")
+
+# Priorities, lower is more important
+INTERACTIVE = 0
+BULK = 1
+
+
+class DashboardRateLimiter:
+    """
+    Client side token bucket for all Dashboard API calls of a process.
+
+    Meraki allows about 10 requests per second per organization. Calls take a token before they are sent, tokens
+    refill at `rate` per second up to `burst`. Bulk callers (e.g. genNetworkSubnetCSV.py) yield to interactive
+    provisioning whenever both are waiting. A 429 pauses the whole bucket for the Retry-After period the Dashboard
+    asked for and the call is retried, instead of every caller hammering the API with its own retries.
+
+    The budget is per process, see SharedRateLimiter for one that is shared by all processes through Redis.
+    """
+
+    def __init__(self, rate: float = 10, burst: float = 10, max_retries: int = 5):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._cond = threading.Condition()
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+        self.counters = {'calls': 0, 'rate_limited': 0, 'wait_seconds': 0.0}
+
+    def _try_acquire(self, priority: int) -> float:
+        """
+        Take a token if one is available. Must be called with the lock held.
+
+        :return: 0 if a token was taken, otherwise the number of seconds to wait before trying again
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if priority > INTERACTIVE and self._waiting[INTERACTIVE]:
+            return 1 / self.rate
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.counters['calls'] += 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, priority: int = INTERACTIVE):
+        """
+        Block the calling thread until a request may be sent.
+        """
+        start = time.monotonic()
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    wait = self._try_acquire(priority)
+                    if not wait:
+                        break
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                self.counters['wait_seconds'] += time.monotonic() - start
+                self._cond.notify_all()
+
+    async def acquire_async(self, priority: int = INTERACTIVE):
+        """
+        Wait on the event loop until a request may be sent.
+        """
+        start = time.monotonic()
+        with self._cond:
+            self._waiting[priority] += 1
+        try:
+            while True:
+                wait = await self._try_acquire_async(priority)
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                self.counters['wait_seconds'] += time.monotonic() - start
+                self._cond.notify_all()
+
+    def _try_acquire_locked(self, priority: int) -> float:
+        with self._cond:
+            return self._try_acquire(priority)
+
+    async def _try_acquire_async(self, priority: int) -> float:
+        return self._try_acquire_locked(priority)
+
+    def backoff(self, retry_after: float):
+        """
+        Pause all callers for retry_after seconds after the Dashboard answered 429.
+        """
+        with self._cond:
+            self.counters['rate_limited'] += 1
+            metrics.DASHBOARD_RATE_LIMITED.inc()
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._tokens = 0
+        logger.warning(f"Dashboard API rate limit hit, pausing requests for {retry_after}s")
+
+    def waiting(self) -> int:
+        """
+        :return: Number of callers waiting for budget
+        """
+        with self._cond:
+            return self._waiting[INTERACTIVE] + self._waiting[BULK]
+
+    def usage(self) -> dict:
+        """
+        Current budget usage, for logging and metrics.
+        """
+        with self._cond:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            return {'rate': self.rate,
+                    'tokens_available': round(tokens, 2),
+                    'waiting_interactive': self._waiting[INTERACTIVE],
+                    'waiting_bulk': self._waiting[BULK],
+                    'paused_for': round(max(0.0, self._paused_until - now), 2),
+                    **self.counters}
+
+    @staticmethod
+    def _retry_after(e: Exception) -> float:
+        response = getattr(e, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            return float(headers.get('Retry-After', 1))
+        except ValueError:
+            return 1
+
+    @staticmethod
+    def _is_rate_limited(e: Exception) -> bool:
+        return getattr(e, 'status', None) == 429
+
+    def call(self, fn, *args, priority: int = INTERACTIVE, **kwargs):
+        """
+        Call a (synchronous) Dashboard API method within the budget, retrying on 429.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            try:
+                return fn(*args, **kwargs)
+            except meraki.exceptions.APIError as e:
+                if not self._is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                self.backoff(self._retry_after(e))
+
+    async def call_async(self, fn, *args, priority: int = INTERACTIVE, **kwargs):
+        """
+        Await a meraki.aio Dashboard API method within the budget, retrying on 429.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async(priority)
+            try:
+                return await fn(*args, **kwargs)
+            except (meraki.exceptions.APIError, meraki.exceptions.AsyncAPIError) as e:
+                if not self._is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                self.backoff(self._retry_after(e))
+
+
+# Token bucket shared through Redis. Returns the seconds to wait as a string (Lua numbers are truncated to integers
+# on the way out), '0' if a token was taken.
+# KEYS: bucket hash, pause key, interactive waiting flag. ARGV: rate, burst, priority.
+ACQUIRE_SCRIPT = """
+local paused = redis.call('PTTL', KEYS[2])
+if paused > 0 then
+    return tostring(paused / 1000)
+end
+local rate, burst, priority = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+if priority > 0 and redis.call('EXISTS', KEYS[3]) == 1 then
+    return tostring(1 / rate)
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+    if priority == 0 then
+        -- Bulk callers in every process hold off while interactive ones wait
+        redis.call('SET', KEYS[3], 1, 'PX', math.ceil(wait * 2000) + 10)
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(math.max(now, updated)))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 60000)
+return tostring(wait)
+"""
+
+# Pause the shared bucket after a 429. KEYS: bucket hash, pause key. ARGV: pause in milliseconds.
+BACKOFF_SCRIPT = """
+local pause = tonumber(ARGV[1])
+if redis.call('PTTL', KEYS[2]) < pause then
+    redis.call('SET', KEYS[2], 1, 'PX', pause)
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+-- Start refilling from empty once the pause is over
+redis.call('HSET', KEYS[1], 'tokens', '0', 'updated', tostring(now + pause / 1000))
+redis.call('PEXPIRE', KEYS[1], pause + 60000)
+"""
+
+
+class SharedRateLimiter(DashboardRateLimiter):
+    """
+    DashboardRateLimiter whose budget, 429 pause and priority are kept in Redis, so they hold across every process
+    that calls the Dashboard for the organization: meraki-ise.py and its workers, meraki-csrv.py and
+    genNetworkSubnetCSV.py all take their tokens from the same bucket, and bulk callers in any process yield while an
+    interactive caller anywhere is waiting.
+
+    Each token costs one script call to Redis. If Redis can't be reached the process falls back to its own bucket
+    (at the full meraki_rate_limit) and tries Redis again every retry_interval seconds.
+    """
+
+    key = 'meraki.ratelimit'
+    pause_key = 'meraki.ratelimit.paused'
+    interactive_key = 'meraki.ratelimit.interactive'
+
+    def __init__(self, redis_client: redis.Redis, rate: float = 10, burst: float = 10, max_retries: int = 5):
+        super().__init__(rate, burst, max_retries)
+        self.redis = redis_client
+        self._acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._backoff_script = redis_client.register_script(BACKOFF_SCRIPT)
+        self._shared = True
+        self._retry_at = 0
+        self.retry_interval = 5
+
+    def _fall_back(self, e: Exception):
+        if self._shared:
+            logger.warning(f"Unable to reach the shared Dashboard API budget in Redis, using a local one: {e}")
+            self._shared = False
+        self._retry_at = time.monotonic() + self.retry_interval
+
+    def _try_acquire(self, priority: int) -> float:
+        if priority > INTERACTIVE and self._waiting[INTERACTIVE]:
+            return 1 / self.rate
+        if not self._shared and time.monotonic() < self._retry_at:
+            return super()._try_acquire(priority)
+        try:
+            wait = float(self._acquire_script(keys=[self.key, self.pause_key, self.interactive_key],
+                                              args=[self.rate, self.burst, priority]))
+        except redis.RedisError as e:
+            self._fall_back(e)
+            return super()._try_acquire(priority)
+        if not self._shared:
+            logger.info("Using the shared Dashboard API budget in Redis again")
+            self._shared = True
+        if not wait:
+            self.counters['calls'] += 1
+        return wait
+
+    async def _try_acquire_async(self, priority: int) -> float:
+        # Keep the Redis round trip off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._try_acquire_locked, priority)
+
+    def backoff(self, retry_after: float):
+        super().backoff(retry_after)
+        if not self._shared and time.monotonic() < self._retry_at:
+            return
+        try:
+            self._backoff_script(keys=[self.key, self.pause_key], args=[int(retry_after * 1000)])
+        except redis.RedisError as e:
+            self._fall_back(e)
+
+    def usage(self) -> dict:
+        usage = super().usage()
+        if self._shared:
+            # The local bucket is not used
+            del usage['tokens_available']
+        return dict(usage, shared=self._shared)
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter(meraki_config) -> DashboardRateLimiter:
+    """
+    Return the process wide rate limiter, creating it from the Meraki configuration on first use.
+    """
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            if meraki_config.rate_limit_shared:
+                # Fail fast, callers wait on the limiter and it has a local fallback
+                redis_client = redis.Redis(host=meraki_config.redis_host, port=meraki_config.redis_port,
+                                           db=meraki_config.redis_db, socket_timeout=1, socket_connect_timeout=1,
+                                           retry=Retry(NoBackoff(), 0))
+                _rate_limiter = SharedRateLimiter(redis_client, rate=meraki_config.rate_limit,
+                                                  burst=meraki_config.rate_burst,
+                                                  max_retries=meraki_config.max_retries)
+            else:
+                _rate_limiter = DashboardRateLimiter(rate=meraki_config.rate_limit,
+                                                     burst=meraki_config.rate_burst,
+                                                     max_retries=meraki_config.max_retries)
+        return _rate_limiter
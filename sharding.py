@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import zlib
+from typing import Callable
+
+import metrics
+
+logger = logging.getLogger("meraki_ise.sharding")
+
+
+def _queue_depth(worker_queue) -> float:
+    try:
+        return worker_queue.qsize()
+    except NotImplementedError:
+        # Not available on macOS
+        return float('nan')
+
+
+def shard_for(mac: str, shards: int) -> int:
+    """
+    :return: The shard (worker index) that owns a MAC address
+    """
+    normalized = ''.join(c for c in str(mac).upper() if c in '0123456789ABCDEF')
+    return zlib.crc32(normalized.encode()) % shards
+
+
+class ShardedDispatcher:
+    """
+    Fans pxGrid sessions out to worker processes, sharded by MAC address.
+
+    The intake process only reads the websocket and splits every message by MAC hash. Each worker process runs its
+    own mapper, Redis connections, Dashboard client and SessionPipeline on its own event loop. All updates for a
+    MAC go to the same worker over a FIFO queue, so per-client ordering holds while throughput scales with cores.
+    The worker queues are bounded: put() waits while a worker is behind, which pushes back onto the reader.
+
+    A worker that died is restarted on a fresh queue (a process that dies while reading can leave the old one
+    locked), taking over whatever the dead worker had not read yet. put() checks this before every put and again
+    every put_timeout seconds while it waits, so a dead worker can't block the reader forever.
+
+    Has the same start()/put()/stats()/close() interface as SessionPipeline, so subscribe_loop can use either.
+    """
+
+    def __init__(self, worker: Callable, workers: int, queue_size: int = 1000, worker_args: tuple = (),
+                 mac_key: str = 'macAddress', put_timeout: float = 10):
+        self._context = multiprocessing.get_context()
+        self._worker = worker
+        self._worker_args = worker_args
+        self.workers = workers
+        self.queue_size = queue_size
+        self.mac_key = mac_key
+        self.put_timeout = put_timeout
+        self.queues = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [self._process(shard) for shard in range(workers)]
+        self.counters = {'messages': 0, 'sessions': 0, 'restarts': 0}
+        for shard in range(workers):
+            metrics.track_queue(f"worker_{shard}", self,
+                                lambda dispatcher, shard=shard: _queue_depth(dispatcher.queues[shard]))
+
+    def _process(self, shard: int) -> multiprocessing.Process:
+        return self._context.Process(target=self._worker, args=(shard, self.queues[shard], *self._worker_args),
+                                     name=f"meraki-ise-worker-{shard}", daemon=True)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Started {self.workers} worker processes")
+
+    def _restart(self, shard: int):
+        """
+        Replace a dead worker with a new process on a new queue, carrying over the messages it had not read.
+        """
+        process = self.processes[shard]
+        old_queue = self.queues[shard]
+        self.queues[shard] = self._context.Queue(maxsize=self.queue_size)
+        moved = lost = 0
+        while True:
+            try:
+                # Not get_nowait(): our own last puts may still be on their way through the queue's feeder thread
+                message = old_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            try:
+                self.queues[shard].put_nowait(message)
+                moved += 1
+            except queue.Full:
+                lost += 1
+        # Don't wait on the old queue's feeder thread at exit, nothing reads from it anymore
+        old_queue.cancel_join_thread()
+        old_queue.close()
+        self.counters['restarts'] += 1
+        logger.error(f"Worker {process.name} died with exit code {process.exitcode}, restarting it "
+                     f"({moved} queued messages carried over, {lost} dropped)")
+        self.processes[shard] = self._process(shard)
+        self.processes[shard].start()
+
+    def _put(self, shard: int, message: dict):
+        """
+        Blocking put onto a worker queue, restarting the worker if it died while the queue was full.
+        """
+        waited = 0
+        while True:
+            if self.processes[shard].exitcode is not None:
+                self._restart(shard)
+            try:
+                self.queues[shard].put(message, timeout=self.put_timeout)
+                return
+            except queue.Full:
+                waited += self.put_timeout
+                if self.processes[shard].is_alive():
+                    logger.warning(f"Worker {self.processes[shard].name} has not taken a message for {waited}s")
+
+    async def put(self, message: dict):
+        self.counters['messages'] += 1
+        shards = {}
+        for session in message.get('sessions', []):
+            shards.setdefault(shard_for(session.get(self.mac_key), self.workers), []).append(session)
+            self.counters['sessions'] += 1
+
+        loop = asyncio.get_running_loop()
+        for shard, sessions in shards.items():
+            if self.processes[shard].exitcode is not None:
+                await loop.run_in_executor(None, self._restart, shard)
+            try:
+                self.queues[shard].put_nowait({'sessions': sessions})
+            except queue.Full:
+                # Block in a thread rather than on the event loop
+                await loop.run_in_executor(None, self._put, shard, {'sessions': sessions})
+
+    def reload(self):
+        """
+        Pass a reload on to the workers, which own the mappers.
+        """
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    def stats(self) -> dict:
+        depths = []
+        for worker_queue in self.queues:
+            try:
+                depths.append(worker_queue.qsize())
+            except NotImplementedError:
+                # Not available on macOS
+                depths.append(None)
+        return {'worker_queues': depths,
+                'workers_alive': sum(process.is_alive() for process in self.processes),
+                **self.counters}
+
+    async def close(self, timeout: float = 30):
+        """
+        Tell the workers to drain and stop, then wait for them (for at most timeout seconds).
+        """
+        loop = asyncio.get_running_loop()
+        for process, worker_queue in zip(self.processes, self.queues):
+            if process.exitcode is not None:
+                logger.warning(f"Worker {process.name} died with exit code {process.exitcode}, "
+                               f"{_queue_depth(worker_queue)} queued messages are lost")
+                worker_queue.cancel_join_thread()
+                continue
+            try:
+                await loop.run_in_executor(None, worker_queue.put, None, True, timeout)
+            except queue.Full:
+                # Terminated below if it doesn't stop by itself
+                logger.warning(f"Worker {process.name} did not take the stop message within {timeout}s")
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} did not stop within {timeout}s, terminating it")
+                process.terminate()
+
+
+async def consume(worker_queue, pipeline):
+    """
+    Worker side: feed messages from the intake process into a local pipeline until told to stop.
+    """
+    loop = asyncio.get_running_loop()
+    pipeline.start()
+    while True:
+        message = await loop.run_in_executor(None, worker_queue.get)
+        if message is None:
+            break
+        await pipeline.put(message)
+    await pipeline.close()
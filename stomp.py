@@ -1,3 +1,31 @@
+import re
+from typing import List, Tuple
+
+# Frames whose headers are not escaped, see the STOMP 1.2 spec
+UNESCAPED_COMMANDS = ('CONNECT', 'CONNECTED')
+_ESCAPE = {b'\\': b'\\\\', b'\r': b'\\r', b'\n': b'\\n', b':': b'\\c'}
+_UNESCAPE = {b'\\\\': b'\\', b'\\r': b'\r', b'\\n': b'\n', b'\\c': b':'}
+_ESCAPE_RE = re.compile(rb'[\\\r\n:]')
+_UNESCAPE_RE = re.compile(rb'\\.?', re.DOTALL)
+
+
+def _escape(value: bytes) -> bytes:
+    return _ESCAPE_RE.sub(lambda m: _ESCAPE[m.group()], value)
+
+
+def _unescape_match(match) -> bytes:
+    try:
+        return _UNESCAPE[match.group()]
+    except KeyError:
+        raise ValueError(f"Invalid STOMP header escape sequence {match.group()!r}") from None
+
+
+def _unescape(value: bytes) -> bytes:
+    if b'\\' not in value:
+        return value
+    return _UNESCAPE_RE.sub(_unescape_match, value)
+
+
 class StompFrame:
     def __init__(self):
         self.headers = {}
@@ -35,6 +63,27 @@ class StompFrame:
             out.write(self.content)
         out.write('\0')
 
+    def encode(self) -> bytes:
+        """
+        Serialize the frame to bytes, escaping header names and values as STOMP 1.2 requires. str content is
+        encoded as UTF-8 and a content-length header is added for it if none was set.
+        """
+        content = self.content
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        escape = self.command not in UNESCAPED_COMMANDS
+        lines = [self.command.encode()]
+        headers = self.headers
+        if content and 'content-length' not in headers:
+            headers = {**headers, 'content-length': str(len(content))}
+        for key, value in headers.items():
+            key, value = str(key).encode('utf-8'), str(value).encode('utf-8')
+            if escape:
+                key, value = _escape(key), _escape(value)
+            lines.append(key + b':' + value)
+        lines.append(b'')
+        return b'\n'.join(lines) + b'\n' + (content or b'') + b'\0'
+
     @staticmethod
     def parse(input):
         frame = StompFrame()
@@ -43,7 +92,76 @@ class StompFrame:
             line = line.rstrip('\r\n')
             if line == '':
                 break
-            (name, value) = line.split(':')
+            (name, value) = line.split(':', 1)
             frame.headers[name] = value
         frame.content = input.read()[:-1]
         return frame
+
+    @staticmethod
+    def decode(data: bytes, start: int = 0) -> Tuple['StompFrame', int]:
+        """
+        Parse one frame from a bytes buffer, splitting its header block in a single pass.
+
+        Header names and values are unescaped and decoded to str, the first occurrence of a repeated header wins.
+        The body is returned as bytes: it is read up to content-length when the header is present (so it may
+        contain NUL bytes), otherwise up to the next NUL.
+
+        :param data: Buffer holding one or more frames
+        :param start: Offset of the frame in the buffer
+        :return: Tuple of the frame and the offset just after its terminating NUL
+        """
+        frame = StompFrame()
+        # The header block ends at the first empty line, with either LF or CRLF line endings
+        end = data.find(b'\n\n', start)
+        crlf_end = data.find(b'\r\n\r\n', start, end if end >= 0 else len(data))
+        if crlf_end >= 0:
+            end, pos = crlf_end, crlf_end + 4
+        elif end >= 0:
+            pos = end + 2
+        else:
+            raise ValueError("Truncated STOMP frame: no end of headers")
+        block = data[start:end]
+        lines = block.split(b'\n')
+        frame.command = lines[0].rstrip(b'\r').decode()
+        # Escape sequences are rare, skip the per-header unescaping when the block has none
+        unescape = b'\\' in block and frame.command not in UNESCAPED_COMMANDS
+        headers = frame.headers
+        for line in lines[1:]:
+            if line[-1:] == b'\r':
+                line = line[:-1]
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise ValueError(f"Malformed STOMP header line {line[:80]!r}")
+            if unescape:
+                name, value = _unescape(name), _unescape(value)
+            name = name.decode()
+            if name not in headers:
+                headers[name] = value.decode()
+
+        length = headers.get('content-length')
+        if length is not None:
+            end = pos + int(length)
+            if end >= len(data) or data[end] != 0:
+                raise ValueError("Truncated STOMP frame: body shorter than content-length")
+        else:
+            end = data.find(b'\0', pos)
+            if end < 0:
+                raise ValueError("Truncated STOMP frame: no NUL terminator")
+        frame.content = data[pos:end]
+        return frame, end + 1
+
+    @staticmethod
+    def decode_all(data: bytes) -> List['StompFrame']:
+        """
+        Parse every frame in a buffer, e.g. a websocket message carrying several frames. Heart-beat EOLs between
+        frames are skipped.
+        """
+        frames = []
+        pos, size = 0, len(data)
+        while True:
+            while pos < size and data[pos] in b'\r\n':
+                pos += 1
+            if pos >= size:
+                return frames
+            frame, pos = StompFrame.decode(data, pos)
+            frames.append(frame)
@@ -0,0 +1,40 @@
+import logging
+from typing import Optional
+
+from network_index import NetworkTable
+from profile_map import ReloadingProfileMap
+
+logger = logging.getLogger("meraki_ise.table_mapper")
+
+
+class TableMapper:
+    """
+    Network and profile lookups shared by the mappers of meraki-ise.py and meraki-csrv.py.
+
+    IP addresses are mapped to networks with the NetworkTable built from networks.csv, profiles to group policies
+    with the profile map from config.yaml. Both are reloaded when their file changes, and the network table also
+    picks up a changed networks_file_path from config.yaml.
+    """
+
+    def __init__(self, redis_client, config: dict, cache_expire: int = 28800):
+        self.networks = NetworkTable(redis_client, config.get('networks_file_path', 'config/networks.csv'),
+                                     cache_expire)
+        self.profile_map = ReloadingProfileMap(config)
+        self.profile_map.add_listener(self.networks.config_changed)
+
+    def reload(self):
+        """
+        Re-read config.yaml and networks.csv right away, e.g. on SIGHUP. Lookups keep using the previous profile map
+        and subnet index until the new ones are swapped in.
+        """
+        for name, reload in (('profile map', self.profile_map.reload), ('network table', self.networks.reload)):
+            try:
+                reload()
+            except Exception as e:
+                logger.error(f"Unable to reload {name}: {e}")
+
+    def map_to_networkid(self, ip: str) -> Optional[str]:
+        network_id = self.networks.lookup(ip)
+        if network_id is None:
+            logger.error(f"Unable to map {ip} to an existing Meraki Network")
+        return network_id
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import sys
+import threading
+
+import pytest
+import redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_script(name: str):
+    """
+    Import one of the hyphenated entry point scripts (e.g. meraki-csrv.py) as a module.
+    """
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def redis_port():
+    # A fake Redis server on a TCP port, for code that builds its own clients from the config
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+@pytest.fixture
+def redis_client(redis_port):
+    client = redis.Redis(port=redis_port)
+    client.flushall()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def networks_file(tmp_path):
+    path = tmp_path / 'networks.csv'
+    path.write_text('Network ID,subnet\nL_1,10.0.0.0/16\nL_2,10.0.1.0/24\n')
+    return str(path)
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import client_record
+from group_mapper import GroupMapper
+
+MAPPING = {'network_id': 'L_1', 'mac': 'AA:00:00:00:00:01', 'ip': '10.0.0.1', 'name': 'user', 'group': '100'}
+
+
+class StaticMapper(GroupMapper):
+    def map_to_networkid(self, ip: str) -> str:
+        return 'L_1'
+
+    def map_to_groupid(self, session: dict) -> str:
+        return session[self._profile_key]
+
+
+def test_pack_round_trip():
+    record = client_record.pack(MAPPING)
+    assert record[:1] == client_record.VERSION
+    assert client_record.unpack(record) == MAPPING
+    assert client_record.record_digest(record) == client_record.digest(MAPPING)
+
+
+def test_none_and_empty_strings_are_distinct():
+    record = client_record.pack(dict(MAPPING, group=None, name=''))
+    assert client_record.unpack(record) == dict(MAPPING, group=None, name='')
+    assert client_record.digest(dict(MAPPING, group=None)) != client_record.digest(dict(MAPPING, group=''))
+
+
+def test_digest_ignores_key_order_and_value_types():
+    reordered = dict(reversed(list(MAPPING.items())))
+    assert client_record.digest(reordered) == client_record.digest(dict(MAPPING, group=100))
+    assert client_record.digest(MAPPING) != client_record.digest(dict(MAPPING, group='101'))
+
+
+def test_legacy_records():
+    legacy = json.dumps(MAPPING).encode()
+    assert client_record.is_legacy(legacy)
+    assert client_record.unpack(legacy) == MAPPING
+    assert client_record.record_digest(legacy) == client_record.record_digest(client_record.pack(MAPPING))
+    assert client_record.record_digest(None) is None
+    with pytest.raises(ValueError):
+        client_record.unpack(b'\x02' + bytes(16))
+
+
+def test_legacy_records_are_migrated_in_place(redis_client, redis_port):
+    mapper = StaticMapper({'redis_port': redis_port})
+    redis_client.set('client.AA0000000001', json.dumps(MAPPING))
+    session = {'state': 'STARTED', 'userName': 'user', 'macAddress': 'AA:00:00:00:00:01',
+               'ipAddresses': ['10.0.0.1'], 'endpointProfile': '100'}
+
+    # Identical to the cached mapping, so nothing to provision, but the record is rewritten in the compact format
+    assert mapper.map({'sessions': [session]}) == []
+    record = redis_client.get('client.AA0000000001')
+    assert not client_record.is_legacy(record)
+    assert client_record.unpack(record) == MAPPING
+
+    assert mapper.map({'sessions': [dict(session, endpointProfile='101')]}) == [
+        ('L_1', 'AA:00:00:00:00:01', 'user', '101')]
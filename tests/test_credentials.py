@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+import pytest
+
+import credentials
+from credentials import CredentialStore, check_password, hash_password, is_hash
+
+# Cheap parameters, the tests don't need a slow KDF
+FAST = {'n': 2 ** 4, 'r': 8, 'p': 1}
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    """
+    Record every KDF run as (password, encoded hash, thread name).
+    """
+    calls = []
+
+    def check(password, encoded):
+        calls.append((password, encoded, threading.current_thread().name))
+        return check_password(password, encoded)
+
+    monkeypatch.setattr(credentials, 'check_password', check)
+    return calls
+
+
+def test_hash_and_check():
+    encoded = hash_password('secret', **FAST)
+    assert is_hash(encoded) and encoded.startswith('scrypt$16$8$1$')
+    assert check_password('secret', encoded)
+    assert not check_password('Secret', encoded)
+    assert not check_password('secret', 'scrypt$broken')
+    assert not check_password('secret', encoded.replace('scrypt', 'bcrypt'))
+
+
+def test_plain_passwords_are_hashed_at_startup():
+    store = CredentialStore({'admin': 'password', 'api': hash_password('token', **FAST)})
+    assert all(is_hash(value) for value in store.users.values())
+    assert store.users['api'].startswith('scrypt$16$')
+    assert store.verify('admin', 'password') and store.verify('api', 'token')
+
+
+def test_successes_are_cached_and_failures_are_not(checks):
+    store = CredentialStore({'admin': hash_password('password', **FAST)})
+    assert store.verify('admin', 'password') and store.verify('admin', 'password')
+    assert not store.verify('admin', 'wrong') and not store.verify('admin', 'wrong')
+    assert not store.verify('admin', None)
+    assert len(checks) == 3
+    assert store.counters == {'cache_hits': 1, 'cache_misses': 3, 'failures': 3}
+
+
+def test_cache_expires(checks, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(credentials.time, 'monotonic', lambda: now[0])
+    store = CredentialStore({'admin': hash_password('password', **FAST)}, cache_ttl=10)
+    store.verify('admin', 'password')
+    now[0] += 5
+    store.verify('admin', 'password')
+    now[0] += 10
+    store.verify('admin', 'password')
+    assert len(checks) == 2
+
+
+def test_cache_size_is_bounded():
+    users = {f"user{i}": hash_password('password', **FAST) for i in range(5)}
+    store = CredentialStore(users, cache_size=3)
+    for username in users:
+        assert store.verify(username, 'password')
+    assert len(store._verified) <= 3
+
+
+def test_unknown_users_pay_for_the_kdf(checks):
+    store = CredentialStore({'admin': hash_password('password', **FAST)})
+    assert not store.verify('nobody', 'password')
+    assert len(checks) == 1 and checks[0][1] == store._dummy
+
+
+def test_verify_async_runs_the_kdf_off_the_event_loop(checks):
+    store = CredentialStore({'admin': hash_password('password', **FAST)})
+
+    async def run():
+        return await asyncio.gather(store.verify_async('admin', 'password'), store.verify_async('admin', 'wrong'),
+                                    store.verify_async('nobody', 'password'), store.verify_async(None, 'password'))
+
+    assert asyncio.run(run()) == [True, False, False, False]
+    assert len(checks) == 3 and all(thread.startswith('auth') for _, _, thread in checks)
+    assert asyncio.run(store.verify_async('admin', 'password'))
+    assert len(checks) == 3
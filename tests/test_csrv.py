@@ -0,0 +1,117 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import load_script
+
+csrv = load_script('meraki-csrv')
+
+
+def test_parse_sessions_json_array():
+    assert csrv.parse_sessions(b' [{"macAddress": "a"}, {"macAddress": "b"}]\n') == [
+        ({'macAddress': 'a'}, None), ({'macAddress': 'b'}, None)]
+
+
+def test_parse_sessions_ndjson_keeps_bad_lines():
+    items = csrv.parse_sessions(b'{"macAddress": "a"}\n\n{"macAddress": \n{"macAddress": "c"}\n')
+    assert [session for session, _ in items] == [{'macAddress': 'a'}, None, {'macAddress': 'c'}]
+    assert items[1][1].startswith('Invalid JSON')
+    assert items[0][1] is None and items[2][1] is None
+
+
+def test_parse_sessions_broken_array():
+    with pytest.raises(ValueError):
+        csrv.parse_sessions(b'[{"macAddress": "a"},')
+
+
+class FakeMapper:
+    async def map_async(self, message: dict) -> list:
+        return [('L_1', message['macAddress'], message.get('userName'), '100')]
+
+
+class FakeProvisioningQueue:
+    """
+    Provisions once `released` is set.
+    """
+
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.provisioned = []
+
+    async def provision(self, network_id, mac, name, group):
+        await self.released.wait()
+        self.provisioned.append(mac)
+
+
+@pytest.fixture
+def login(monkeypatch):
+    """
+    Calls the /api/user-login handler (past authentication) with a session for a MAC address.
+    """
+    handler = csrv.userLogin[1].__wrapped__
+    provisioning_queue = FakeProvisioningQueue()
+    monkeypatch.setattr(csrv, 'group_mapper', FakeMapper(), raising=False)
+    monkeypatch.setattr(csrv, 'provisioning_queue', provisioning_queue, raising=False)
+    monkeypatch.setattr(csrv, 'response_wait', 0, raising=False)
+    monkeypatch.setattr(csrv, 'max_pending', 1000, raising=False)
+
+    async def login(mac: str):
+        return await handler(SimpleNamespace(body=json.dumps({'macAddress': mac, 'userName': 'user'}).encode()))
+
+    login.provisioning_queue = provisioning_queue
+    yield login
+    csrv.background_tasks.clear()
+
+
+def test_user_login_returns_200_when_done_within_the_response_wait(login, monkeypatch):
+    monkeypatch.setattr(csrv, 'response_wait', 1)
+
+    async def run():
+        login.provisioning_queue.released.set()
+        return await login('a')
+
+    result = asyncio.run(run())
+    assert result.status == 200
+    assert json.loads(result.body) == {'macAddress': 'a', 'userName': 'user'}
+    assert login.provisioning_queue.provisioned == ['a']
+
+
+def test_user_login_returns_202_while_still_provisioning(login, monkeypatch):
+    monkeypatch.setattr(csrv, 'response_wait', 0.05)
+
+    async def run():
+        result = await login('a')
+        pending = set(csrv.background_tasks)
+        login.provisioning_queue.released.set()
+        await asyncio.wait(pending, timeout=1)
+        return result, pending
+
+    result, pending = asyncio.run(run())
+    assert result.status == 202
+    assert len(pending) == 1
+    # Finished in the background
+    assert login.provisioning_queue.provisioned == ['a']
+    assert not csrv.background_tasks
+
+
+def test_user_login_waits_while_max_pending_logins_are_in_progress(login, monkeypatch):
+    monkeypatch.setattr(csrv, 'max_pending', 2)
+
+    async def run():
+        assert (await login('a')).status == 202
+        assert (await login('b')).status == 202
+        third = asyncio.ensure_future(login('c'))
+        await asyncio.sleep(0.05)
+        waited = not third.done()
+        pending = len(csrv.background_tasks)
+        login.provisioning_queue.released.set()
+        result = await asyncio.wait_for(third, 1)
+        await asyncio.wait(set(csrv.background_tasks), timeout=1)
+        return waited, pending, result
+
+    waited, pending, result = asyncio.run(run())
+    assert waited and pending == 2
+    assert result.status == 202
+    assert login.provisioning_queue.provisioned == ['a', 'b', 'c']
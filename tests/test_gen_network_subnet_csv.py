@@ -0,0 +1,78 @@
+import csv
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import genNetworkSubnetCSV as gen
+from rate_limiter import DashboardRateLimiter
+
+
+class FakeDashboard:
+    def __init__(self):
+        self.vlans = {}
+        self.failing = set()
+        self.changes = []
+        self.fetched = []
+        devices = [{'model': 'MX68', 'networkId': 'N_1'}, {'model': 'MX68', 'networkId': 'N_2'},
+                   {'model': 'MR46', 'networkId': 'N_3'}]
+        self.organizations = SimpleNamespace(
+            getOrganizations=lambda: [{'id': 'O_1', 'name': 'org'}],
+            getOrganizationDevices=lambda org_id: devices,
+            getOrganizationConfigurationChanges=lambda org_id, **kwargs: [{'networkId': n} for n in self.changes])
+        self.appliance = SimpleNamespace(getNetworkApplianceVlans=self.get_vlans)
+
+    def get_vlans(self, network_id):
+        self.fetched.append(network_id)
+        if network_id in self.failing:
+            raise RuntimeError('timed out')
+        return [{'networkId': network_id, 'id': 1, 'name': 'data', 'subnet': self.vlans[network_id]}]
+
+
+@pytest.fixture
+def dashboard(tmp_path, monkeypatch):
+    fake = FakeDashboard()
+    monkeypatch.setattr(gen.meraki, 'DashboardAPI', lambda **kwargs: fake)
+    monkeypatch.setattr(gen, 'get_rate_limiter', lambda config: DashboardRateLimiter(rate=1000, burst=1000))
+    monkeypatch.setattr(gen, 'meraki_config', SimpleNamespace(api_key='x', org_name='org', base_url=None),
+                        raising=False)
+    monkeypatch.setattr(gen, 'networks_file_path', str(tmp_path / 'networks.csv'), raising=False)
+    monkeypatch.setattr(gen, 'state_file_path', str(tmp_path / 'networks.csv.state.json'), raising=False)
+    return fake
+
+
+def subnets() -> dict:
+    with open(gen.networks_file_path, newline='') as networks_file:
+        return {row['Network ID']: row['subnet'] for row in csv.DictReader(networks_file)}
+
+
+def test_incremental_run_retries_failed_networks(dashboard):
+    dashboard.vlans = {'N_1': '10.1.0.0/24', 'N_2': '10.2.0.0/24'}
+    gen.main(workers=2)
+    assert subnets() == {'N_1': '10.1.0.0/24', 'N_2': '10.2.0.0/24'}
+
+    # N_2 changes but can't be fetched, it keeps its previous VLANs for now
+    dashboard.vlans['N_2'] = '10.22.0.0/24'
+    dashboard.changes = ['N_2']
+    dashboard.failing = {'N_2'}
+    gen.main(workers=2, incremental=True)
+    assert subnets()['N_2'] == '10.2.0.0/24'
+    with open(gen.state_file_path) as state_file:
+        assert json.load(state_file)['failed'] == ['N_2']
+
+    # The change is older than last_run, but N_2 is fetched again because it failed
+    dashboard.changes = []
+    dashboard.failing = set()
+    dashboard.fetched.clear()
+    gen.main(workers=2, incremental=True)
+    assert dashboard.fetched == ['N_2']
+    assert subnets()['N_2'] == '10.22.0.0/24'
+    with open(gen.state_file_path) as state_file:
+        assert json.load(state_file)['failed'] == []
+
+
+def test_meraki_config_shares_the_provisioning_settings():
+    config = gen.MerakiConfig({'meraki_api_key': 'x', 'meraki_org_name': 'org', 'meraki_rate_limit': 4,
+                               'meraki_rate_limit_shared': False, 'redis_db': 2})
+    assert (config.org_name, config.rate_limit, config.rate_burst, config.rate_limit_shared, config.redis_db) == (
+        'org', 4.0, 10.0, False, 2)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import client_record
+from group_mapper_csrv import GroupMapper
+
+
+@pytest.fixture
+def mapper(redis_client, redis_port, networks_file):
+    group_mapper = GroupMapper({'redis_port': redis_port, 'networks_file_path': networks_file,
+                                'profile_map': {'Employee': 100, 'Contractor': 101}})
+    yield group_mapper
+    group_mapper.networks.close()
+
+
+def session(mac: str, ip: str = '10.0.1.5', role='Employee', **fields) -> dict:
+    return dict({'macAddress': mac, 'ipAddress': ip, 'userName': f"user-{mac[-2:]}", 'role': role}, **fields)
+
+
+def test_map_many_maps_and_caches(mapper, redis_client):
+    async def run():
+        first = await mapper.map_many_async([session('aa:bb:cc:dd:ee:01'),
+                                             session('aa:bb:cc:dd:ee:02', ip='10.0.7.1', role='Contractor')])
+        # The Redis connection pool is bound to the event loop, so both passes run on the same one
+        second = await mapper.map_many_async([session('aa:bb:cc:dd:ee:01'),
+                                              session('aa:bb:cc:dd:ee:02', ip='10.0.7.1')])
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == [('changed', ('L_2', 'AA:BB:CC:DD:EE:01', 'user-01', '100')),
+                     ('changed', ('L_1', 'AA:BB:CC:DD:EE:02', 'user-02', '101'))]
+    record = client_record.unpack(redis_client.get('client.AABBCCDDEE01'))
+    assert record['network_id'] == 'L_2' and record['group'] == '100'
+    assert [outcome for outcome, _ in second] == ['unchanged', 'changed']
+
+
+def test_map_many_reports_invalid_sessions_per_item(mapper, redis_client):
+    sessions = [session('aa:bb:cc:dd:ee:01'),
+                session('aa:bb:cc:dd:ee:02', ip='not-an-ip'),
+                session('aa:bb:cc:dd:ee:03', role=['Employee', 'Contractor']),
+                {'macAddress': 'aa:bb:cc:dd:ee:04', 'ipAddress': '10.0.1.6', 'role': 'Employee'},
+                session('aa:bb:cc:dd:ee:05', ip=''),
+                session('aa:bb:cc:dd:ee:06')]
+    outcomes = asyncio.run(mapper.map_many_async(sessions))
+
+    assert [outcome for outcome, _ in outcomes] == ['changed', 'invalid', 'invalid', 'invalid', 'skipped', 'changed']
+    assert 'not-an-ip' in outcomes[1][1]
+    assert outcomes[3][1] == "Missing field 'userName'"
+    # Only the valid sessions were cached
+    assert sorted(redis_client.keys('client.*')) == [b'client.AABBCCDDEE01', b'client.AABBCCDDEE06']
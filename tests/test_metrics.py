@@ -0,0 +1,26 @@
+import gc
+
+from prometheus_client import REGISTRY
+
+import metrics
+
+
+class Queue:
+    def __init__(self, depth: int):
+        self.depth = depth
+
+
+def depth(name: str) -> float:
+    return REGISTRY.get_sample_value('meraki_ise_queue_depth', {'queue': name})
+
+
+def test_queues_with_the_same_name_are_added_up():
+    first, second = Queue(3), Queue(4)
+    metrics.track_queue('test_shared', first, lambda queue: queue.depth)
+    metrics.track_queue('test_shared', second, lambda queue: queue.depth)
+    assert depth('test_shared') == 7
+
+    # Instances that are gone stop being reported
+    del second
+    gc.collect()
+    assert depth('test_shared') == 3
@@ -0,0 +1,105 @@
+import json
+import time
+
+import pytest
+
+from network_index import NetworkTable, SubnetIndex
+
+NETWORKS = [
+    {'Network ID': 'L_wide', 'subnet': '10.0.0.0/8'},
+    {'Network ID': 'L_site', 'subnet': '10.1.0.0/16'},
+    {'Network ID': 'L_vlan', 'subnet': '10.1.2.0/24'},
+    {'Network ID': 'L_v6', 'subnet': '2001:db8::/32'},
+    {'Network ID': 'L_v6_vlan', 'subnet': '2001:db8:0:1::/64'},
+]
+
+
+def test_most_specific_subnet_wins():
+    index = SubnetIndex(NETWORKS)
+    assert index.lookup('10.1.2.3') == 'L_vlan'
+    assert index.lookup('10.1.3.3') == 'L_site'
+    assert index.lookup('10.2.0.1') == 'L_wide'
+    assert index.lookup('192.168.0.1') is None
+
+
+def test_ipv6():
+    index = SubnetIndex(NETWORKS)
+    assert index.lookup('2001:db8:0:1::10') == 'L_v6_vlan'
+    assert index.lookup('2001:db8:ffff::1') == 'L_v6'
+    assert index.lookup('2001:db9::1') is None
+
+
+def test_first_duplicate_is_kept_and_invalid_rows_are_skipped():
+    index = SubnetIndex([{'Network ID': 'L_1', 'subnet': '10.0.0.0/24'},
+                         {'Network ID': 'L_2', 'subnet': '10.0.0.0/24'},
+                         {'Network ID': 'L_3', 'subnet': 'not a subnet'},
+                         {'subnet': '10.0.1.0/24'},
+                         # Host bits are ignored
+                         {'Network ID': 'L_4', 'subnet': '10.0.2.1/24'}])
+    assert len(index) == 2
+    assert index.lookup('10.0.0.1') == 'L_1'
+    assert index.lookup('10.0.2.200') == 'L_4'
+
+
+def test_rebuild_replaces_the_index():
+    index = SubnetIndex(NETWORKS)
+    index.build([{'Network ID': 'L_new', 'subnet': '10.1.2.0/24'}])
+    assert len(index) == 1
+    assert index.lookup('10.1.2.3') == 'L_new'
+    assert index.lookup('10.1.3.3') is None
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def table(redis_client, networks_file):
+    network_table = NetworkTable(redis_client, networks_file)
+    yield network_table
+    network_table.close()
+    # Don't let a refresh still in progress write to the next test's Redis
+    assert wait_for(lambda: not network_table._refresh_lock.locked())
+
+
+def test_table_is_loaded_and_published(table, redis_client):
+    assert table.lookup('10.0.1.5') == 'L_2'
+    assert table.version == redis_client.get('networks.version')
+    # Our own notification doesn't send us back to Redis
+    time.sleep(0.2)
+    assert not table._stale
+
+
+def test_published_tables_are_picked_up_without_blocking_lookups(table, redis_client, networks_file):
+    assert table.lookup('10.0.1.5') == 'L_2'
+    old_index = table.index
+    other = NetworkTable(redis_client, networks_file, subscribe=False)
+    other.publish([{'Network ID': 'L_3', 'subnet': '10.0.1.0/24'}])
+    assert wait_for(lambda: table.index is not old_index)
+    assert table.lookup('10.0.1.5') == 'L_3'
+    assert table.version == redis_client.get('networks.version')
+
+    # Lookups don't wait for a rebuild, they answer from the previous index meanwhile
+    with table._lock:
+        table._stale = True
+        assert table.lookup('10.0.1.5') == 'L_3'
+
+
+def test_changed_file_is_reloaded(redis_client, networks_file):
+    table = NetworkTable(redis_client, networks_file, check_interval=0)
+    try:
+        assert table.lookup('10.0.1.5') == 'L_2'
+        version = table.version
+        with open(networks_file, 'w') as csv_file:
+            csv_file.write('Network ID,subnet\nL_4,10.0.0.0/16\n')
+        assert wait_for(lambda: table.lookup('10.0.1.5') == 'L_4' and table.version != version)
+        assert table.version == redis_client.get('networks.version')
+        assert json.loads(redis_client.get('networks')) == [{'Network ID': 'L_4', 'subnet': '10.0.0.0/16'}]
+    finally:
+        table.close()
+        assert wait_for(lambda: not table._refresh_lock.locked())
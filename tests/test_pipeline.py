@@ -0,0 +1,182 @@
+import asyncio
+
+from pipeline import PipelineConfig, SessionCoalescer, SessionPipeline
+
+
+class FakeMapper:
+    """
+    Maps each session to a (network_id, mac, name, group) tuple. Messages with 'fail' set raise, and mapping waits
+    while `blocked` is cleared.
+    """
+
+    def __init__(self):
+        self.blocked = asyncio.Event()
+        self.blocked.set()
+        self.mapped = []
+
+    async def map_async(self, message: dict) -> list:
+        await self.blocked.wait()
+        if message.get('fail'):
+            raise ValueError('Broken message')
+        self.mapped.append(message)
+        return [('L_1', session['macAddress'], 'user', '100') for session in message['sessions']]
+
+
+class FakeRateLimiter:
+    def usage(self) -> dict:
+        return {}
+
+
+class FakeProvisioner:
+    def __init__(self, failing_macs=()):
+        self.failing_macs = set(failing_macs)
+        self.provisioned = []
+        self.closed = False
+        self.rate_limiter = FakeRateLimiter()
+
+    def provision(self, network_id, mac, name, group) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if mac in self.failing_macs:
+            future.set_exception(RuntimeError('Dashboard error'))
+        else:
+            self.provisioned.append(mac)
+            future.set_result(None)
+        return future
+
+    async def close(self):
+        self.closed = True
+
+
+def pipeline(provisioner: FakeProvisioner = None, **config) -> SessionPipeline:
+    config = dict({'pipeline_coalesce_window': 0, 'pipeline_stats_interval': 0}, **config)
+    return SessionPipeline(FakeMapper(), provisioner or FakeProvisioner(), PipelineConfig(config))
+
+
+def message(*macs: str, **fields) -> dict:
+    return dict({'sessions': [{'macAddress': mac} for mac in macs]}, **fields)
+
+
+def session(mac: str, state: str = 'STARTED') -> dict:
+    return {'macAddress': mac, 'state': state}
+
+
+def test_updates_for_the_same_mac_are_collapsed():
+    async def run():
+        coalescer = SessionCoalescer(60, 100)
+        added = [coalescer.add(session('a')), coalescer.add(session('b')),
+                 coalescer.add(session('a', 'AUTHENTICATED'))]
+        return coalescer, added, coalescer.pop_due(flush_all=True)
+
+    coalescer, added, messages = asyncio.run(run())
+    assert added == [True, True, False]
+    # The latest state, in the order the MACs were first seen
+    assert messages == [{'sessions': [session('a', 'AUTHENTICATED'), session('b')]}]
+    assert coalescer.counters == {'sessions': 3, 'collapsed': 1}
+    assert len(coalescer) == 0
+
+
+def test_sessions_are_due_once_their_window_passed():
+    async def run():
+        coalescer = SessionCoalescer(0.1, 100)
+        coalescer.add(session('a'))
+        await asyncio.sleep(0.06)
+        coalescer.add(session('b'))
+        # Later updates don't extend the window
+        coalescer.add(session('a', 'AUTHENTICATED'))
+        early = coalescer.pop_due()
+        await asyncio.sleep(0.06)
+        first = coalescer.pop_due()
+        await asyncio.sleep(0.06)
+        return early, first, coalescer.pop_due()
+
+    early, first, second = asyncio.run(run())
+    assert early == []
+    assert first == [{'sessions': [session('a', 'AUTHENTICATED')]}]
+    assert second == [{'sessions': [session('b')]}]
+
+
+def test_wait_due_waits_for_the_oldest_window():
+    async def run():
+        coalescer = SessionCoalescer(0.1, 100)
+        loop = asyncio.get_running_loop()
+        waiter = asyncio.ensure_future(coalescer.wait_due())
+        await asyncio.sleep(0.05)
+        # Still waiting for a first session
+        assert not waiter.done()
+        started = loop.time()
+        coalescer.add(session('a'))
+        await asyncio.wait_for(waiter, 1)
+        return loop.time() - started, coalescer.pop_due()
+
+    waited, messages = asyncio.run(run())
+    assert waited >= 0.09
+    assert messages == [{'sessions': [session('a')]}]
+
+
+def test_full_coalescer_and_batches():
+    async def run():
+        coalescer = SessionCoalescer(60, 5, batch_size=2)
+        for mac in 'abcd':
+            coalescer.add(session(mac))
+        full_before = coalescer.is_full()
+        coalescer.add(session('a', 'AUTHENTICATED'))
+        coalescer.add(session('e'))
+        return full_before, coalescer.is_full(), coalescer.pop_due(flush_all=True)
+
+    full_before, full, messages = asyncio.run(run())
+    assert not full_before and full
+    assert [[s['macAddress'] for s in message['sessions']] for message in messages] == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+def test_put_blocks_while_the_message_queue_is_full():
+    async def run():
+        session_pipeline = pipeline(pipeline_queue_size=2)
+        session_pipeline.mapper.blocked.clear()
+        session_pipeline.start()
+        # One message is taken by the map worker, two fill the queue
+        for mac in ('a', 'b', 'c'):
+            await asyncio.wait_for(session_pipeline.put(message(mac)), 1)
+            await asyncio.sleep(0)
+        blocked = asyncio.ensure_future(session_pipeline.put(message('d')))
+        await asyncio.sleep(0.05)
+        was_blocked = not blocked.done()
+        session_pipeline.mapper.blocked.set()
+        await asyncio.wait_for(blocked, 1)
+        await session_pipeline.close()
+        return was_blocked, session_pipeline
+
+    was_blocked, session_pipeline = asyncio.run(run())
+    assert was_blocked
+    assert session_pipeline.provisioner.provisioned == ['a', 'b', 'c', 'd']
+
+
+def test_close_drains_the_queues():
+    async def run():
+        session_pipeline = pipeline(pipeline_coalesce_window=60)
+        session_pipeline.start()
+        for index in range(20):
+            await session_pipeline.put(message(f"mac{index}", f"other{index}"))
+        # Coalesced sessions are flushed too, without waiting for their window
+        await asyncio.wait_for(session_pipeline.close(), 5)
+        return session_pipeline
+
+    session_pipeline = asyncio.run(run())
+    assert len(session_pipeline.provisioner.provisioned) == 40
+    assert session_pipeline.provisioner.closed
+    assert session_pipeline.counters == {'messages': 20, 'mapped': 40, 'provisioned': 40, 'failed': 0}
+    assert all(task.done() for task in session_pipeline._tasks)
+
+
+def test_errors_are_isolated_to_their_message_and_client():
+    async def run():
+        session_pipeline = pipeline(FakeProvisioner(failing_macs={'b'}))
+        session_pipeline.start()
+        await session_pipeline.put(message('a'))
+        await session_pipeline.put(message('x', fail=True))
+        await session_pipeline.put(message('b', 'c'))
+        await session_pipeline.close()
+        return session_pipeline
+
+    session_pipeline = asyncio.run(run())
+    assert session_pipeline.provisioner.provisioned == ['a', 'c']
+    assert session_pipeline.counters == {'messages': 3, 'mapped': 3, 'provisioned': 2, 'failed': 1}
@@ -0,0 +1,63 @@
+import pytest
+
+from profile_map import ProfileMap, ReloadingProfileMap
+
+PROFILE_MAP = {
+    'Employee': 100,
+    'Contractor': 101,
+    'Guest-*': 102,
+    're:^lab-[0-9]+$': 103,
+    'Guest-VIP': 104,
+}
+
+
+def test_exact_names_are_case_insensitive():
+    profile_map = ProfileMap(PROFILE_MAP)
+    assert profile_map.lookup('employee') == '100'
+    assert profile_map.lookup('CONTRACTOR') == '101'
+    assert profile_map.lookup('Visitor') is None
+
+
+def test_patterns():
+    profile_map = ProfileMap(PROFILE_MAP)
+    assert profile_map.lookup('guest-wifi') == '102'
+    assert profile_map.lookup('Lab-42') == '103'
+    assert profile_map.lookup('lab-42x') is None
+    # An exact name wins over a pattern that comes first
+    assert profile_map.lookup('guest-vip') == '104'
+    # Memoized results don't change the outcome
+    assert profile_map.lookup('GUEST-WIFI') == '102'
+
+
+def test_session_priority_takes_the_first_mapped_profile():
+    profile_map = ProfileMap(PROFILE_MAP)
+    assert profile_map.match(['Unknown', 'Contractor', 'Employee']) == '101'
+    assert profile_map.match(['Unknown']) is None
+    assert profile_map.match([]) is None
+
+
+def test_config_priority_takes_the_first_configured_profile():
+    profile_map = ProfileMap(PROFILE_MAP, priority='config')
+    assert profile_map.match(['Unknown', 'Contractor', 'Employee']) == '100'
+    assert profile_map.match(['lab-1', 'guest-wifi']) == '102'
+
+
+def test_unknown_priority():
+    with pytest.raises(ValueError):
+        ProfileMap(PROFILE_MAP, priority='newest')
+
+
+def test_reload_picks_up_the_new_map(tmp_path):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text('profile_map:\n  Employee: 100\n')
+    reloading = ReloadingProfileMap({'config_file_path': str(config_file), 'profile_map': {'Employee': 100}})
+    changes = []
+    reloading.add_listener(lambda previous, config: changes.append((previous, config)))
+    old = reloading.get()
+
+    config_file.write_text('profile_map:\n  Employee: 200\nprofile_map_priority: config\n')
+    reloading.reload()
+    assert old.lookup('Employee') == '100'
+    assert reloading.get().lookup('Employee') == '200' and reloading.get().priority == 'config'
+    assert changes == [({'profile_map': {'Employee': 100}},
+                        {'profile_map': {'Employee': 200}, 'profile_map_priority': 'config'})]
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+
+import httpx
+import meraki.exceptions
+import pytest
+
+import provisioner
+from provisioner import MerakiConfig, ProvisioningQueue
+
+
+def api_error(status: int = 400) -> meraki.exceptions.APIError:
+    return meraki.exceptions.APIError({'tags': ['networks'], 'operation': 'provisionNetworkClients'},
+                                      httpx.Response(status, json={'errors': ['Invalid client']}))
+
+
+class FakeDashboard:
+    """
+    Records provisionNetworkClients calls as (network_id, [mac, ...], group).
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.failing_macs = set()
+        # Calls for these groups wait until the event is set
+        self.blocked_groups = {}
+
+    def provision_clients(self, dashboard, network_id, clients, mapped_group):
+        event = self.blocked_groups.get(mapped_group)
+        if event is not None:
+            event.wait(5)
+        self.calls.append((network_id, [client['mac'] for client in clients], mapped_group))
+        if self.failing_macs.intersection(client['mac'] for client in clients):
+            raise api_error()
+        return {'mac': clients[0]['mac']}
+
+
+@pytest.fixture
+def dashboard(monkeypatch):
+    fake = FakeDashboard()
+    monkeypatch.setattr(provisioner, 'provision_clients', fake.provision_clients)
+    monkeypatch.setattr(provisioner, 'get_dashboard', lambda meraki_config: None)
+    return fake
+
+
+def queue(**config) -> ProvisioningQueue:
+    return ProvisioningQueue(MerakiConfig(dict({'meraki_api_key': 'key', 'meraki_rate_limit_shared': False,
+                                                'meraki_rate_limit': 1000, 'meraki_rate_burst': 1000,
+                                                'provision_batch_window': 0.05}, **config)))
+
+
+def test_clients_are_batched_by_network_and_group(dashboard):
+    async def run():
+        provisioning_queue = queue()
+        await asyncio.gather(provisioning_queue.provision('L_1', 'mac1', 'user1', 100),
+                             provisioning_queue.provision('L_1', 'mac2', 'user2', '100'),
+                             provisioning_queue.provision('L_1', 'mac3', 'user3', 101),
+                             provisioning_queue.provision('L_2', 'mac4', 'user4', 100))
+        await provisioning_queue.close()
+
+    asyncio.run(run())
+    assert sorted(dashboard.calls) == [('L_1', ['mac1', 'mac2'], '100'), ('L_1', ['mac3'], '101'),
+                                       ('L_2', ['mac4'], '100')]
+
+
+def test_full_batches_are_sent_right_away(dashboard):
+    async def run():
+        provisioning_queue = queue(provision_batch_size=2, provision_batch_window=60)
+        first = provisioning_queue.provision('L_1', 'mac1', 'user1', 100)
+        second = provisioning_queue.provision('L_1', 'mac2', 'user2', 100)
+        third = provisioning_queue.provision('L_1', 'mac3', 'user3', 100)
+        await asyncio.wait_for(asyncio.gather(first, second), 5)
+        assert not third.done()
+        await provisioning_queue.close()
+        return third.done()
+
+    assert asyncio.run(run())
+    assert dashboard.calls == [('L_1', ['mac1', 'mac2'], '100'), ('L_1', ['mac3'], '100')]
+
+
+def test_batches_are_sent_after_the_window(dashboard):
+    async def run():
+        provisioning_queue = queue(provision_batch_window=0.2)
+        future = provisioning_queue.provision('L_1', 'mac1', 'user1', 100)
+        await asyncio.sleep(0.1)
+        assert dashboard.calls == []
+        await asyncio.wait_for(future, 5)
+        await provisioning_queue.close()
+
+    asyncio.run(run())
+    assert dashboard.calls == [('L_1', ['mac1'], '100')]
+
+
+def test_failed_bulk_calls_are_retried_per_client(dashboard):
+    dashboard.failing_macs.add('mac2')
+
+    async def run():
+        provisioning_queue = queue()
+        results = await asyncio.gather(*(provisioning_queue.provision('L_1', mac, 'user', 100)
+                                         for mac in ('mac1', 'mac2', 'mac3')), return_exceptions=True)
+        await provisioning_queue.close()
+        return results
+
+    results = asyncio.run(run())
+    assert results[0] == {'mac': 'mac1'} and results[2] == {'mac': 'mac3'}
+    assert isinstance(results[1], meraki.exceptions.APIError) and results[1].status == 400
+    assert dashboard.calls[0] == ('L_1', ['mac1', 'mac2', 'mac3'], '100')
+    assert sorted(dashboard.calls[1:]) == [('L_1', ['mac1'], '100'), ('L_1', ['mac2'], '100'),
+                                           ('L_1', ['mac3'], '100')]
+
+
+def test_newer_update_replaces_a_queued_one(dashboard):
+    async def run():
+        provisioning_queue = queue()
+        old = provisioning_queue.provision('L_1', 'mac1', 'user1', 100)
+        other = provisioning_queue.provision('L_1', 'mac2', 'user2', 100)
+        new = provisioning_queue.provision('L_1', 'mac1', 'user1', 101)
+        results = await asyncio.gather(old, other, new)
+        await provisioning_queue.close()
+        return results
+
+    results = asyncio.run(run())
+    assert sorted(dashboard.calls) == [('L_1', ['mac1'], '101'), ('L_1', ['mac2'], '100')]
+    # The replaced update resolves with the outcome of the newer one
+    assert results[0] == results[2] == {'mac': 'mac1'}
+
+
+def test_update_waits_for_the_call_in_flight(dashboard):
+    release = threading.Event()
+    dashboard.blocked_groups['100'] = release
+
+    async def run():
+        provisioning_queue = queue(provision_batch_window=0.01)
+        first = provisioning_queue.provision('L_1', 'mac1', 'user1', 100)
+        # Let the first batch go out
+        await asyncio.sleep(0.1)
+        second = provisioning_queue.provision('L_2', 'mac1', 'user1', 101)
+        third = provisioning_queue.provision('L_2', 'mac1', 'user1', 102)
+        await asyncio.sleep(0.1)
+        # Nothing overtakes the call in flight
+        assert dashboard.calls == []
+        release.set()
+        await asyncio.wait_for(asyncio.gather(first, second, third), 5)
+        await provisioning_queue.close()
+
+    asyncio.run(run())
+    assert dashboard.calls == [('L_1', ['mac1'], '100'), ('L_2', ['mac1'], '102')]
@@ -0,0 +1,317 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+import requests
+from websockets.exceptions import ConnectionClosed, InvalidStatusCode
+
+import ws_stomp
+from pxgrid import PxgridCache, PxgridConfig, PxgridService, PxgridSessionPubsub, PxgridSessionService, \
+    iter_json_array
+from stomp import StompFrame
+
+CONFIG = {'pxgrid_host': 'ise-pan', 'pxgrid_nodename': 'meraki', 'pxgrid_password': 'secret',
+          'pxgrid_description': None, 'pxgrid_client_cert': None, 'pxgrid_client_key': None,
+          'pxgrid_ca_cert': None, 'pxgrid_ca_verify': False}
+
+
+def node(name: str) -> dict:
+    return {'name': 'com.cisco.ise.session', 'nodeName': name,
+            'properties': {'restBaseUrl': f"https://{name}:8910/pxgrid/ise/session",
+                           'wsPubsubService': 'com.cisco.ise.pubsub', 'sessionTopic': '/topic/com.cisco.ise.session'}}
+
+
+def session_service(nodes=('ise-1', 'ise-2'), cache: PxgridCache = None) -> PxgridSessionService:
+    """
+    A session service whose ServiceLookup is answered from the cache, starting with the first node.
+    """
+    cache = cache if cache is not None else PxgridCache()
+    cache.set('meraki.lookup.com.cisco.ise.session', [node(name) for name in nodes], 60)
+    service = PxgridSessionService(PxgridConfig(CONFIG), cache)
+    service.account_active = True
+    service._index = service._first_index = 0
+    service._use(service.services[0])
+    return service
+
+
+SESSIONS = [{'macAddress': 'AA:00:00:00:00:01', 'userName': 'jürgen', 'ipAddresses': ['10.0.0.1']},
+            {'macAddress': 'AA:00:00:00:00:02', 'userName': '[not] "the" end]', 'ipAddresses': []}]
+
+
+def chunked(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 4096])
+def test_elements_split_across_chunks(size):
+    document = json.dumps({'before': {'sessions': 'nested'}, 'sessions': SESSIONS + [123, True, None],
+                           'after': [1]}).encode()
+    assert list(iter_json_array(chunked(document, size), 'sessions')) == SESSIONS + [123, True, None]
+
+
+def test_empty_and_missing_array():
+    assert list(iter_json_array([b'{"sessions": [ ]}'], 'sessions')) == []
+    assert list(iter_json_array([b'{"other": [1, 2]}'], 'sessions')) == []
+
+
+def test_key_split_across_chunks_after_a_long_prefix():
+    document = json.dumps({'padding': 'x' * 1000, 'sessions': SESSIONS}).encode()
+    split = document.index(b'sessions') + 4
+    assert list(iter_json_array([document[:split], document[split:]], 'sessions')) == SESSIONS
+
+
+def test_truncated_document():
+    document = json.dumps({'sessions': SESSIONS}).encode()
+    elements = iter_json_array(chunked(document[:-10], 16), 'sessions')
+    assert next(elements) == SESSIONS[0]
+    with pytest.raises(ValueError):
+        list(elements)
+
+
+def test_async_requests_fail_over_to_the_next_node():
+    service = session_service()
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(str(request.url))
+        if request.url.host == 'ise-1':
+            raise httpx.ConnectError('Connection refused', request=request)
+        return httpx.Response(200, json={'groups': [{'name': 'Employee'}]})
+
+    async def run():
+        service._aio_session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await service.get_user_groups_by_username_async('user')
+        finally:
+            await service.close_async()
+
+    assert asyncio.run(run()) == [{'name': 'Employee'}]
+    assert requests == ['https://ise-1:8910/pxgrid/ise/session/getUserGroupByUserName',
+                        'https://ise-2:8910/pxgrid/ise/session/getUserGroupByUserName']
+    assert service.node_name == 'ise-2'
+
+
+def test_async_requests_give_up_once_every_node_failed():
+    service = session_service()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectTimeout('Timed out', request=request)
+
+    async def run():
+        service._aio_session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await service.get_sessions_async()
+        finally:
+            await service.close_async()
+
+    with pytest.raises(httpx.ConnectTimeout):
+        asyncio.run(run())
+
+
+class FakeWebSocket:
+    """
+    Delivers session messages as STOMP frames, then behaves like a dropped connection.
+    """
+
+    def __init__(self, *messages: dict):
+        self.messages = list(messages)
+        self.sent = []
+
+    async def send(self, data: bytes):
+        self.sent.append(StompFrame.decode_all(data)[0].get_command())
+
+    async def recv(self) -> bytes:
+        if not self.messages:
+            raise ConnectionClosed(None, None)
+        frame = StompFrame()
+        frame.set_command('MESSAGE')
+        frame.set_header('destination', '/topic/com.cisco.ise.session')
+        frame.set_content(json.dumps(self.messages.pop(0)))
+        return frame.encode()
+
+    async def close(self):
+        pass
+
+
+def sessions(*seconds: int) -> list:
+    return [{'macAddress': f"AA:00:00:00:00:{second:02}", 'timestamp': f"2024-01-01T10:00:{second:02}.000Z"}
+            for second in seconds]
+
+
+@pytest.fixture
+def pubsub(monkeypatch):
+    """
+    A session topic subscription on top of fake websockets: append FakeWebSockets (or exceptions) to
+    pubsub.connections, one per connection attempt. The secrets used are in pubsub.passwords.
+    """
+    cache = PxgridCache()
+    cache.set('meraki.lookup.com.cisco.ise.pubsub',
+              [{'name': 'com.cisco.ise.pubsub', 'nodeName': name,
+                'properties': {'wsUrl': f"wss://{name}:8910/pxgrid/ise/pubsub"}} for name in ('ise-1', 'ise-2')], 60)
+    for name in ('ise-1', 'ise-2'):
+        cache.set(f"meraki.secret.{name}", f"secret-{name}", 60)
+    service = session_service(cache=cache)
+    service.config.bootstrap_chunk_size = 2
+    monkeypatch.setattr(PxgridSessionPubsub, '_create_ssl_context', lambda self: None)
+    subscription = PxgridSessionPubsub(service)
+    subscription.connections = []
+    subscription.passwords = []
+
+    async def connect(uri, extra_headers, ssl):
+        subscription.passwords.append(subscription.password)
+        connection = subscription.connections.pop(0)
+        if isinstance(connection, Exception):
+            raise connection
+        return connection
+
+    monkeypatch.setattr(ws_stomp.websockets, 'connect', connect)
+    return subscription
+
+
+def test_reconnects_and_catches_up_on_missed_sessions(pubsub):
+    requested = []
+
+    def iter_sessions(start_timestamp=None, chunk_size=100):
+        requested.append((start_timestamp, chunk_size))
+        missed = sessions(2, 3, 4)
+        for i in range(0, len(missed), chunk_size):
+            yield missed[i:i + chunk_size]
+
+    pubsub._PxgridSessionPubsub__session_service.iter_sessions = iter_sessions
+    first, second = FakeWebSocket({'sessions': sessions(1)}), FakeWebSocket({'sessions': sessions(5)})
+    pubsub.connections += [first, second]
+
+    async def run():
+        await pubsub.reconnect()
+        return [await pubsub.read_message() for _ in range(4)]
+
+    assert asyncio.run(run()) == [{'sessions': sessions(1)}, {'sessions': sessions(2, 3)},
+                                  {'sessions': sessions(4)}, {'sessions': sessions(5)}]
+    # Caught up from the last event seen before the connection dropped, in chunks
+    assert requested == [('2024-01-01T10:00:01.000Z', 2)]
+    assert second.sent == ['CONNECT', 'SUBSCRIBE']
+    assert pubsub.reconnects == 1
+    assert pubsub.last_timestamp == '2024-01-01T10:00:05.000Z'
+    # The cached secret is reused while connecting works
+    assert len(set(pubsub.passwords)) == 1
+
+
+def test_failed_catch_up_carries_on_with_the_topic(pubsub):
+    def iter_sessions(start_timestamp=None, chunk_size=100):
+        yield sessions(2, 3)
+        raise requests.ConnectionError('Connection reset')
+
+    pubsub._PxgridSessionPubsub__session_service.iter_sessions = iter_sessions
+    pubsub.connections += [FakeWebSocket({'sessions': sessions(1)}), FakeWebSocket({'sessions': sessions(5)})]
+
+    async def run():
+        await pubsub.reconnect()
+        return [await pubsub.read_message() for _ in range(3)]
+
+    assert asyncio.run(run()) == [{'sessions': sessions(1)}, {'sessions': sessions(2, 3)}, {'sessions': sessions(5)}]
+
+
+def test_no_catch_up_before_the_first_event(pubsub):
+    def iter_sessions(start_timestamp=None, chunk_size=100):
+        raise AssertionError('Nothing to catch up on')
+
+    pubsub._PxgridSessionPubsub__session_service.iter_sessions = iter_sessions
+    pubsub.connections += [FakeWebSocket(), FakeWebSocket({'sessions': sessions(1)})]
+
+    async def run():
+        await pubsub.reconnect()
+        return await pubsub.read_message()
+
+    assert asyncio.run(run()) == {'sessions': sessions(1)}
+    assert pubsub.reconnects == 1
+
+
+def pubsub_service(cache: PxgridCache) -> PxgridService:
+    """
+    A pubsub service that answers AccessSecret requests with a new secret each time, counted in service.secrets.
+    """
+    lookup = {'name': 'com.cisco.ise.pubsub', 'nodeName': 'ise-1',
+              'properties': {'wsUrl': 'wss://ise-1:8910/pxgrid/ise/pubsub'}}
+    cache.set('meraki.lookup.com.cisco.ise.pubsub', [lookup], 60)
+    service = PxgridService(PxgridConfig(CONFIG), 'com.cisco.ise.pubsub', cache)
+    service.secrets = 0
+
+    def request(endpoint, payload, require_active_account=True, base_url=None):
+        assert (endpoint, payload) == ('AccessSecret', {'peerNodeName': 'ise-1'})
+        service.secrets += 1
+        return {'secret': f"secret-{service.secrets}"}
+
+    service.request = request
+    return service
+
+
+def test_cached_secret_is_reused_across_restarts(redis_client):
+    cache = PxgridCache(redis_client)
+    assert pubsub_service(cache).get_access_secret() == 'secret-1'
+    # Another process (or a restart) with the same Redis skips the AccessSecret call
+    restarted = pubsub_service(cache)
+    assert restarted.get_access_secret() == 'secret-1'
+    assert restarted.secrets == 0
+    assert 0 < redis_client.ttl('pxgrid.meraki.secret.ise-1') <= 3600
+    restarted.get_access_secret(refresh=True)
+    assert restarted.secrets == 1
+
+
+def test_secret_rejected_with_401_is_invalidated(pubsub):
+    cache = pubsub._PxgridSessionPubsub__session_service.cache
+    service = pubsub._PxgridSessionPubsub__session_pubsub_service
+    service.request = lambda endpoint, payload, require_active_account=True, base_url=None: {
+        'secret': f"fresh-{payload['peerNodeName']}"}
+    rejecting_node = service.node_name
+    other_node = 'ise-2' if rejecting_node == 'ise-1' else 'ise-1'
+    pubsub.connections += [FakeWebSocket(), InvalidStatusCode(401, {}), FakeWebSocket({'sessions': sessions(1)})]
+
+    async def run():
+        await pubsub.reconnect()
+        return await pubsub.read_message()
+
+    assert asyncio.run(run()) == {'sessions': sessions(1)}
+    assert pubsub.passwords == [f"secret-{rejecting_node}", f"secret-{rejecting_node}", f"fresh-{other_node}"]
+    assert cache.get(f"meraki.secret.{rejecting_node}") is None
+    assert cache.get(f"meraki.secret.{other_node}") == f"fresh-{other_node}"
+    assert pubsub.ws_url == f"wss://{other_node}:8910/pxgrid/ise/pubsub"
+
+
+class FakeResponse:
+    def __init__(self, body: dict):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeHttpSession:
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.urls = []
+
+    def post(self, url, json, stream, timeout):
+        self.urls.append(url)
+        if any(url.startswith(f"https://{node}:") for node in self.down):
+            raise requests.ConnectionError('Connection refused')
+        return FakeResponse({'groups': [{'name': 'Employee'}]})
+
+
+def test_requests_fail_over_to_the_next_node():
+    service = session_service()
+    service.http = FakeHttpSession(down={'ise-1'})
+    assert service.get_user_groups_by_username('user') == [{'name': 'Employee'}]
+    assert service.http.urls == ['https://ise-1:8910/pxgrid/ise/session/getUserGroupByUserName',
+                                 'https://ise-2:8910/pxgrid/ise/session/getUserGroupByUserName']
+    # Stays on the node that works
+    assert service.get_user_groups_by_username('user') == [{'name': 'Employee'}]
+    assert service.http.urls[-1] == 'https://ise-2:8910/pxgrid/ise/session/getUserGroupByUserName'
+
+
+def test_requests_give_up_once_every_node_failed():
+    service = session_service()
+    service.http = FakeHttpSession(down={'ise-1', 'ise-2'})
+    with pytest.raises(requests.ConnectionError):
+        service.get_user_groups_by_username('user')
+    assert len(service.http.urls) == 2
@@ -0,0 +1,65 @@
+import time
+
+import fakeredis
+import pytest
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from rate_limiter import BULK, INTERACTIVE, DashboardRateLimiter, SharedRateLimiter
+
+
+@pytest.fixture
+def limiters():
+    # Two processes sharing one Redis
+    server = fakeredis.FakeServer()
+    return [SharedRateLimiter(fakeredis.FakeRedis(server=server), rate=10, burst=2) for _ in range(2)]
+
+
+def test_local_bucket_refills_at_rate():
+    limiter = DashboardRateLimiter(rate=10, burst=2)
+    assert limiter._try_acquire(INTERACTIVE) == 0
+    assert limiter._try_acquire(INTERACTIVE) == 0
+    assert limiter._try_acquire(INTERACTIVE) == pytest.approx(0.1, abs=0.01)
+    time.sleep(0.1)
+    assert limiter._try_acquire(INTERACTIVE) == 0
+
+
+def test_budget_is_shared(limiters):
+    first, second = limiters
+    assert first._try_acquire(INTERACTIVE) == 0
+    assert second._try_acquire(INTERACTIVE) == 0
+    assert 0 < first._try_acquire(INTERACTIVE) <= 0.1
+    assert 0 < second._try_acquire(INTERACTIVE) <= 0.1
+    assert first.counters['calls'] + second.counters['calls'] == 2
+
+
+def test_backoff_pauses_every_process(limiters):
+    first, second = limiters
+    first.backoff(0.5)
+    assert second._try_acquire(INTERACTIVE) == pytest.approx(0.5, abs=0.05)
+    time.sleep(0.5)
+    # The bucket refills from empty after the pause
+    assert second._try_acquire(INTERACTIVE) > 0
+    time.sleep(0.1)
+    assert second._try_acquire(INTERACTIVE) == 0
+
+
+def test_bulk_yields_to_interactive_in_another_process(limiters):
+    first, second = limiters
+    first._try_acquire(INTERACTIVE)
+    first._try_acquire(INTERACTIVE)
+    assert first._try_acquire(INTERACTIVE) > 0
+    time.sleep(0.1)
+    # A token is available again, but an interactive caller is waiting for it
+    assert second._try_acquire(BULK) == pytest.approx(0.1)
+    assert first._try_acquire(INTERACTIVE) == 0
+
+
+def test_falls_back_to_local_bucket_without_redis():
+    limiter = SharedRateLimiter(redis.Redis(port=1, socket_connect_timeout=0.1, retry=Retry(NoBackoff(), 0)),
+                                rate=10, burst=2)
+    assert limiter._try_acquire(INTERACTIVE) == 0
+    limiter.backoff(0.2)
+    assert limiter._try_acquire(INTERACTIVE) == pytest.approx(0.2, abs=0.05)
+    assert limiter.usage()['shared'] is False
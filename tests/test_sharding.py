@@ -0,0 +1,116 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+
+import pytest
+
+from sharding import ShardedDispatcher, shard_for
+
+
+def echo_worker(shard: int, worker_queue, results):
+    """
+    Sends every session back with the shard that got it, and exits on a session with 'exit' set (after that many
+    seconds).
+    """
+    while True:
+        message = worker_queue.get()
+        if message is None:
+            return
+        for session in message['sessions']:
+            if 'exit' in session:
+                time.sleep(session['exit'])
+                os._exit(3)
+            results.put((shard, session['macAddress']))
+
+
+def collect(results, count: int) -> list:
+    return [results.get(timeout=5) for _ in range(count)]
+
+
+def message(*macs: str) -> dict:
+    return {'sessions': [{'macAddress': mac} for mac in macs]}
+
+
+def test_shard_for_is_stable_across_mac_formats():
+    shard = shard_for('00:11:22:AA:BB:CC', 8)
+    assert 0 <= shard < 8
+    assert shard_for('00-11-22-aa-bb-cc', 8) == shard
+    assert shard_for('001122aabbcc', 8) == shard
+    # Doesn't depend on hash randomization, so every process and every restart agrees
+    assert shard_for('00:11:22:AA:BB:CC', 1000) == 631
+    assert len({shard_for(f"00:11:22:33:44:{i:02X}", 4) for i in range(256)}) == 4
+
+
+def test_put_splits_messages_by_shard_in_order():
+    results = multiprocessing.Queue()
+    dispatcher = ShardedDispatcher(echo_worker, 3, worker_args=(results,))
+    macs = [f"00:11:22:33:44:{i:02X}" for i in range(30)]
+
+    async def run():
+        dispatcher.start()
+        await dispatcher.put(message(*macs[:15]))
+        await dispatcher.put(message(*macs[15:]))
+        await dispatcher.close(timeout=5)
+
+    asyncio.run(run())
+    received = collect(results, 30)
+    assert all(shard == shard_for(mac, 3) for shard, mac in received)
+    for shard in range(3):
+        assert [mac for s, mac in received if s == shard] == [mac for mac in macs if shard_for(mac, 3) == shard]
+    assert dispatcher.counters == {'messages': 2, 'sessions': 30, 'restarts': 0}
+
+
+def test_dead_worker_is_restarted_with_its_queued_messages():
+    results = multiprocessing.Queue()
+    dispatcher = ShardedDispatcher(echo_worker, 1, queue_size=5, worker_args=(results,), put_timeout=0.1)
+
+    async def run():
+        dispatcher.start()
+        await dispatcher.put({'sessions': [{'macAddress': 'a', 'exit': 0}]})
+        await asyncio.get_running_loop().run_in_executor(None, dispatcher.processes[0].join, 5)
+        # Waiting on the dead worker's queue
+        dispatcher.queues[0].put_nowait(message('b'))
+        await dispatcher.put(message('c'))
+        await dispatcher.close(timeout=5)
+
+    asyncio.run(run())
+    assert collect(results, 2) == [(0, 'b'), (0, 'c')]
+    assert dispatcher.counters['restarts'] == 1
+
+
+def test_put_restarts_a_worker_that_dies_while_its_queue_is_full():
+    results = multiprocessing.Queue()
+    dispatcher = ShardedDispatcher(echo_worker, 1, queue_size=1, worker_args=(results,), put_timeout=0.1)
+
+    async def run():
+        dispatcher.start()
+        await dispatcher.put({'sessions': [{'macAddress': 'a', 'exit': 0.5}]})
+        while not dispatcher.queues[0].empty():
+            await asyncio.sleep(0.01)
+        await dispatcher.put(message('b'))
+        # Blocks on the full queue until the worker died and was restarted
+        await asyncio.wait_for(dispatcher.put(message('c')), 5)
+        await dispatcher.close(timeout=5)
+
+    asyncio.run(run())
+    assert collect(results, 2) == [(0, 'b'), (0, 'c')]
+    assert dispatcher.counters['restarts'] == 1
+
+
+def test_close_does_not_hang_on_a_dead_worker():
+    results = multiprocessing.Queue()
+    dispatcher = ShardedDispatcher(echo_worker, 2, queue_size=1, worker_args=(results,))
+
+    async def run():
+        dispatcher.start()
+        dispatcher.processes[0].kill()
+        await asyncio.get_running_loop().run_in_executor(None, dispatcher.processes[0].join, 5)
+        dispatcher.queues[0].put_nowait(message('lost'))
+        await asyncio.wait_for(dispatcher.close(timeout=5), 10)
+
+    asyncio.run(run())
+    assert not any(process.is_alive() for process in dispatcher.processes)
+    with pytest.raises(queue.Empty):
+        results.get(timeout=0.1)
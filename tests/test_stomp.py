@@ -0,0 +1,56 @@
+import pytest
+
+from stomp import StompFrame
+
+
+def frame(command: str, headers: dict, content=None) -> StompFrame:
+    result = StompFrame()
+    result.set_command(command)
+    for key, value in headers.items():
+        result.set_header(key, value)
+    result.set_content(content)
+    return result
+
+
+def test_concatenated_frames_and_heart_beats():
+    data = (b'\n' + frame('MESSAGE', {'destination': '/topic/a'}, '{"a": 1}').encode() + b'\r\n\n' +
+            b'RECEIPT\r\nreceipt-id:42\r\n\r\n\0' + b'\n')
+    frames = StompFrame.decode_all(data)
+    assert [f.command for f in frames] == ['MESSAGE', 'RECEIPT']
+    assert frames[0].headers == {'destination': '/topic/a', 'content-length': '8'}
+    assert frames[0].content == b'{"a": 1}'
+    assert frames[1].headers == {'receipt-id': '42'} and frames[1].content == b''
+    assert StompFrame.decode_all(b'\n\r\n') == []
+
+
+def test_round_trip_with_escapes_and_nul_in_body():
+    original = frame('SEND', {'destination': '/a:b\nc\\d', 'x': 'y'}, b'one\0two')
+    # The body holds a NUL, so it needs an explicit content-length
+    original.set_header('content-length', '7')
+    (decoded,) = StompFrame.decode_all(original.encode())
+    assert decoded.headers == {'destination': '/a:b\nc\\d', 'x': 'y', 'content-length': '7'}
+    assert decoded.content == b'one\0two'
+
+
+def test_first_repeated_header_wins():
+    (decoded,) = StompFrame.decode_all(b'MESSAGE\nfoo:1\nfoo:2\n\nbody\0')
+    assert decoded.get_header('foo') == '1' and decoded.content == b'body'
+
+
+def test_connect_headers_are_not_unescaped():
+    (decoded,) = StompFrame.decode_all(b'CONNECT\nlogin:a\\c\n\n\0')
+    assert decoded.get_header('login') == 'a\\c'
+
+
+@pytest.mark.parametrize('data', [
+    b'MESSAGE\ndestination:/topic/a\n',
+    b'MESSAGE\ndestination:/topic/a\n\n{"a": 1}',
+    b'MESSAGE\ncontent-length:10\n\n{"a": 1}\0',
+    # A complete frame followed by the start of the next one
+    b'RECEIPT\nreceipt-id:1\n\n\0MESSAGE\n',
+    b'MESSAGE\nno separator\n\n\0',
+    b'MESSAGE\nbad:\\x\n\n\0',
+])
+def test_partial_or_malformed_frames(data):
+    with pytest.raises(ValueError):
+        StompFrame.decode_all(data)
@@ -0,0 +1,26 @@
+import pytest
+
+from table_mapper import TableMapper
+
+
+@pytest.fixture
+def mapper(redis_client, networks_file, tmp_path):
+    table_mapper = TableMapper(redis_client, {'networks_file_path': networks_file,
+                                              'config_file_path': str(tmp_path / 'missing.yaml')})
+    yield table_mapper
+    table_mapper.networks.close()
+
+
+def test_map_to_networkid(mapper):
+    assert mapper.map_to_networkid('10.0.1.5') == 'L_2'
+    assert mapper.map_to_networkid('10.0.7.1') == 'L_1'
+    assert mapper.map_to_networkid('192.168.0.1') is None
+
+
+def test_reload_carries_on_after_a_failure(mapper, networks_file):
+    assert mapper.map_to_networkid('10.1.0.1') is None
+    with open(networks_file, 'a') as networks:
+        networks.write('L_3,10.1.0.0/16\n')
+    # The profile map can't be read, the network table is reloaded anyway
+    mapper.reload()
+    assert mapper.map_to_networkid('10.1.0.1') == 'L_3'
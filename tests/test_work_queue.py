@@ -0,0 +1,190 @@
+import asyncio
+
+import fakeredis
+import pytest
+import redis.exceptions
+
+import client_record
+from group_mapper import GroupMapper
+from work_queue import ProvisioningStream, WorkQueueConfig
+
+
+class FakeProvisioner:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.calls = []
+
+    async def provision(self, network_id, mac, name, group):
+        self.calls.append((network_id, mac, name, group))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Dashboard unavailable')
+
+
+class StaticMapper(GroupMapper):
+    def map_to_networkid(self, ip: str) -> str:
+        return 'L_1'
+
+    def map_to_groupid(self, session: dict) -> str:
+        return session[self._profile_key]
+
+
+def message(group: str) -> dict:
+    return {'sessions': [{'state': 'STARTED', 'userName': 'user', 'macAddress': 'AA:00:00:00:00:01',
+                          'ipAddresses': ['10.0.0.1'], 'endpointProfile': group}]}
+
+
+def changed(mac: str, group: str = '100') -> tuple:
+    mapping = {'network_id': 'L_1', 'mac': mac, 'ip': '10.0.0.1', 'name': 'user', 'group': group}
+    return f"client.{mac.replace(':', '')}", client_record.pack(mapping), tuple(mapping.values())
+
+
+@pytest.fixture
+def aredis():
+    return fakeredis.FakeAsyncRedis()
+
+
+def stream(aredis, **config) -> ProvisioningStream:
+    return ProvisioningStream(aredis, WorkQueueConfig(dict({'durable_retry_base': 0.05}, **config)), 60)
+
+
+async def consume(work_queue: ProvisioningStream, provisioner: FakeProvisioner, reclaim: bool = False):
+    """
+    One pass of the consumer: provision new entries, or retry pending ones, and wait for the outcome.
+    """
+    in_flight = asyncio.Semaphore(10)
+    if reclaim:
+        await work_queue._reclaim_pending(provisioner, in_flight)
+    else:
+        await work_queue._read(provisioner, in_flight)
+    await asyncio.gather(*work_queue._tasks)
+
+
+def test_repeated_updates_are_queued_once(aredis):
+    async def run():
+        work_queue = stream(aredis)
+        await work_queue.setup()
+        await work_queue.enqueue([changed('AA:00:00:00:00:01'), changed('AA:00:00:00:00:02')])
+        await work_queue.enqueue([changed('AA:00:00:00:00:01')])
+        await work_queue.enqueue([changed('AA:00:00:00:00:01', group='101')])
+        return work_queue, await aredis.xlen('provision.stream')
+
+    work_queue, length = asyncio.run(run())
+    assert length == 3
+    assert work_queue.counters['enqueued'] == 3 and work_queue.counters['duplicates'] == 1
+
+
+def test_superseded_entries_are_skipped(aredis):
+    provisioner = FakeProvisioner()
+
+    async def run():
+        work_queue = stream(aredis)
+        await work_queue.setup()
+        await work_queue.enqueue([changed('AA:00:00:00:00:01', group='100')])
+        await work_queue.enqueue([changed('AA:00:00:00:00:01', group='101')])
+        await consume(work_queue, provisioner)
+        return work_queue, await aredis.get('client.AA0000000001'), await aredis.xlen('provision.stream')
+
+    work_queue, record, length = asyncio.run(run())
+    assert provisioner.calls == [('L_1', 'AA:00:00:00:00:01', 'user', '101')]
+    assert work_queue.counters['superseded'] == 1
+    assert client_record.unpack(record)['group'] == '101'
+    assert length == 0
+
+
+def test_failed_entries_are_reclaimed_and_retried(aredis):
+    provisioner = FakeProvisioner(failures=1)
+
+    async def run():
+        work_queue = stream(aredis)
+        await work_queue.setup()
+        await work_queue.enqueue([changed('AA:00:00:00:00:01')])
+        await consume(work_queue, provisioner)
+        assert await aredis.get('client.AA0000000001') is None
+        # Retried once the entry has been idle for durable_retry_base
+        await consume(work_queue, provisioner, reclaim=True)
+        assert work_queue.counters['retried'] == 0
+        await asyncio.sleep(0.06)
+        await consume(work_queue, provisioner, reclaim=True)
+        return work_queue, await aredis.get('client.AA0000000001')
+
+    work_queue, record = asyncio.run(run())
+    assert len(provisioner.calls) == 2
+    assert work_queue.counters['failed'] == 1 and work_queue.counters['retried'] == 1
+    assert work_queue.counters['provisioned'] == 1 and record is not None
+
+
+def test_entries_are_dead_lettered_after_max_attempts(aredis):
+    provisioner = FakeProvisioner(failures=100)
+
+    async def run():
+        work_queue = stream(aredis, durable_max_attempts=2)
+        await work_queue.setup()
+        await work_queue.enqueue([changed('AA:00:00:00:00:01')])
+        await consume(work_queue, provisioner)
+        for _ in range(2):
+            await asyncio.sleep(0.06)
+            await consume(work_queue, provisioner, reclaim=True)
+        assert work_queue.counters['dead_lettered'] == 1
+        dead = await aredis.xrange('provision.dead')
+        # The client can be queued again by the next session update
+        await work_queue.enqueue([changed('AA:00:00:00:00:01')])
+        return dead, await aredis.get('client.AA0000000001'), await aredis.xlen('provision.stream')
+
+    dead, record, length = asyncio.run(run())
+    assert len(provisioner.calls) == 2
+    assert len(dead) == 1 and dead[0][1][b'attempts'] == b'2' and dead[0][1][b'key'] == b'client.AA0000000001'
+    assert record is None
+    assert length == 1
+
+
+def test_changing_back_while_another_mapping_is_queued(aredis):
+    provisioner = FakeProvisioner()
+    mapper = StaticMapper({})
+    mapper.aredis = aredis
+
+    async def run():
+        work_queue = stream(aredis)
+        await work_queue.setup()
+
+        async def update(group: str):
+            await work_queue.enqueue(await mapper.map_uncommitted_async(message(group),
+                                                                        queued_key=work_queue.queued_key))
+
+        await update('100')
+        await consume(work_queue, provisioner)
+        # Committed, so the marker is gone and an identical update is compared against the cache
+        assert await aredis.get('queued.client.AA0000000001') is None
+        await update('100')
+        assert await aredis.xlen('provision.stream') == 0
+
+        await update('101')
+        await update('100')
+        await consume(work_queue, provisioner)
+        return work_queue, await aredis.get('client.AA0000000001')
+
+    work_queue, record = asyncio.run(run())
+    assert [call[3] for call in provisioner.calls] == ['100', '100']
+    assert work_queue.counters['superseded'] == 1
+    assert client_record.unpack(record)['group'] == '100'
+
+
+def test_redis_errors_leave_the_entry_pending(aredis):
+    provisioner = FakeProvisioner()
+
+    async def fail(**kwargs):
+        raise redis.exceptions.ConnectionError('Connection reset')
+
+    async def run():
+        work_queue = stream(aredis)
+        await work_queue.setup()
+        await work_queue.enqueue([changed('AA:00:00:00:00:01')])
+        work_queue._commit_script = fail
+        # Nothing escapes from the task
+        await consume(work_queue, provisioner)
+        return work_queue, (await aredis.xpending('provision.stream', 'provisioners'))['pending']
+
+    work_queue, pending = asyncio.run(run())
+    assert len(provisioner.calls) == 1
+    assert work_queue.counters['failed'] == 1 and work_queue.counters['provisioned'] == 0
+    assert pending == 1
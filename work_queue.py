@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import List, Optional, Tuple
+
+import redis.exceptions
+
+import client_record
+import metrics
+
+logger = logging.getLogger("meraki_ise.work_queue")
+
+# Add an entry unless the same record is already queued for the client. KEYS: queued marker, stream.
+# ARGV: record digest, marker expiry, cache key, record.
+ENQUEUE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('XADD', KEYS[2], '*', 'key', ARGV[3], 'record', ARGV[4])
+return 1
+"""
+
+# Commit a provisioned record and clear its queued marker, unless a newer record was queued for the client
+# meanwhile, and acknowledge its entry. KEYS: queued marker, cache key, stream.
+# ARGV: record digest, record, cache expiry, group, entry ID.
+COMMIT_SCRIPT = """
+local queued = redis.call('GET', KEYS[1])
+local current = not queued or queued == ARGV[1]
+if current then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    redis.call('DEL', KEYS[1])
+end
+redis.call('XACK', KEYS[3], ARGV[4], ARGV[5])
+redis.call('XDEL', KEYS[3], ARGV[5])
+return current and 1 or 0
+"""
+
+# Forget the queued marker if it still belongs to this record. KEYS: queued marker. ARGV: record digest.
+FORGET_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class WorkQueueConfig:
+    def __init__(self, config):
+        self.enabled = bool(config.get('durable_queue', False))
+        self.stream = config.get('durable_stream', 'provision.stream')
+        self.dead_letter_stream = config.get('durable_dead_letter_stream', 'provision.dead')
+        self.group = config.get('durable_group', 'provisioners')
+        self.retry_base = float(config.get('durable_retry_base', 30))
+        self.retry_max = float(config.get('durable_retry_max', 600))
+        self.max_attempts = int(config.get('durable_max_attempts', 5))
+
+
+class ProvisioningStream:
+    """
+    Durable provisioning work queue on a Redis Stream with a consumer group.
+
+    Changed mappings are added to the stream instead of being committed to the client.<mac> cache right away. A
+    consumer provisions each entry and only then writes the cache record and acknowledges the entry, in one
+    transaction. Entries that fail, or whose consumer died, stay pending and are claimed again (by any replica in
+    the group) once they have been idle for an exponential backoff of retry_base * 2^(attempts - 1) seconds, up to
+    retry_max. After max_attempts deliveries they are moved to the dead-letter stream. This gives at-least-once
+    provisioning and lets several provisioner replicas share the load.
+
+    The digest of the last record queued for a client is kept in queued.<cache key> until it is committed, and
+    session updates are compared against it before the cache (see GroupMapper.map_uncommitted_async()). Repeated
+    updates with the same mapping therefore don't add more entries while the first one waits to be provisioned, and
+    a client that changes back to its cached mapping while another one is queued is queued again. Entries are
+    consumed by whichever replica is free, so updates of the same client are not ordered between replicas: an entry
+    whose record was superseded by a newer one is skipped, and only the newest record is committed to the cache, but
+    two updates queued within one provisioning round trip may still reach the Dashboard out of order.
+    """
+
+    def __init__(self, aredis, config: WorkQueueConfig, cache_expire: int = 28800):
+        self.redis = aredis
+        self.config = config
+        self.cache_expire = cache_expire
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._tasks = set()
+        # Entries delivered but not yet acknowledged, refreshed by the reclaimer
+        self.pending = None
+        self.counters = {'enqueued': 0, 'duplicates': 0, 'provisioned': 0, 'superseded': 0, 'failed': 0,
+                         'retried': 0, 'dead_lettered': 0}
+        self._enqueue_script = aredis.register_script(ENQUEUE_SCRIPT)
+        self._commit_script = aredis.register_script(COMMIT_SCRIPT)
+        self._forget_script = aredis.register_script(FORGET_SCRIPT)
+        metrics.track_queue('stream_pending', self, lambda stream: stream.pending or 0)
+
+    async def setup(self):
+        try:
+            await self.redis.xgroup_create(self.config.stream, self.config.group, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            # The group already exists
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def enqueue(self, changed: List[Tuple[str, bytes, tuple]]):
+        """
+        Add changed mappings to the stream.
+
+        :param changed: List of tuples of (cache key, cache record, mapping) as returned by map_uncommitted_async()
+        """
+        if not changed:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, record, _ in changed:
+                await self._enqueue_script(keys=[self.queued_key(key), self.config.stream],
+                                           args=[client_record.record_digest(record), self.cache_expire, key, record],
+                                           client=pipe)
+            added = sum(await pipe.execute())
+        self.counters['enqueued'] += added
+        self.counters['duplicates'] += len(changed) - added
+
+    @staticmethod
+    def queued_key(key) -> str:
+        return f"queued.{key.decode() if isinstance(key, bytes) else key}"
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.config.retry_max, self.config.retry_base * 2 ** max(0, attempts - 1))
+
+    async def run(self, provisioner, in_flight: asyncio.Semaphore):
+        """
+        Consume the stream until cancelled, with at most as many entries in flight as the semaphore allows.
+        """
+        await self.setup()
+        reclaimer = asyncio.ensure_future(self._reclaim(provisioner, in_flight))
+        try:
+            while True:
+                try:
+                    await self._read(provisioner, in_flight, block=1000)
+                except redis.exceptions.RedisError as e:
+                    logger.error(f"Error while reading provisioning work: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            reclaimer.cancel()
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _read(self, provisioner, in_flight: asyncio.Semaphore, block: Optional[int] = None):
+        """
+        Start provisioning the next batch of new entries, waiting at most block milliseconds for one.
+        """
+        response = await self.redis.xreadgroup(self.config.group, self.consumer, {self.config.stream: '>'},
+                                               count=100, block=block)
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                await self._spawn(entry_id, fields, provisioner, in_flight)
+
+    async def _spawn(self, entry_id, fields: dict, provisioner, in_flight: asyncio.Semaphore):
+        await in_flight.acquire()
+        task = asyncio.ensure_future(self._handle(entry_id, fields, provisioner))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: in_flight.release())
+
+    async def _handle(self, entry_id, fields: dict, provisioner):
+        try:
+            await self._process(entry_id, fields, provisioner)
+        except redis.exceptions.RedisError as e:
+            # The entry stays pending and will be retried
+            logger.error(f"Error while handling provisioning work {entry_id}: {e}")
+            self.counters['failed'] += 1
+
+    async def _process(self, entry_id, fields: dict, provisioner):
+        key, record = fields[b'key'], fields[b'record']
+        digest = client_record.record_digest(record)
+        queued = await self.redis.get(self.queued_key(key))
+        if queued is not None and queued != digest:
+            # A newer mapping was queued for this client after this one, that one wins
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.xack(self.config.stream, self.config.group, entry_id)
+                pipe.xdel(self.config.stream, entry_id)
+                await pipe.execute()
+            self.counters['superseded'] += 1
+            return
+
+        mapping = client_record.unpack(record)
+        try:
+            await provisioner.provision(mapping['network_id'], mapping['mac'], mapping['name'], mapping['group'])
+        except Exception:
+            # Already logged by the provisioner. The entry stays pending and will be retried.
+            self.counters['failed'] += 1
+            return
+
+        await self._commit_script(keys=[self.queued_key(key), key, self.config.stream],
+                                  args=[digest, record, self.cache_expire, self.config.group, entry_id])
+        self.counters['provisioned'] += 1
+
+    async def _reclaim(self, provisioner, in_flight: asyncio.Semaphore):
+        while True:
+            await asyncio.sleep(self.config.retry_base / 2)
+            try:
+                await self._reclaim_pending(provisioner, in_flight)
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Error while reclaiming pending provisioning work: {e}")
+
+    async def _reclaim_pending(self, provisioner, in_flight: asyncio.Semaphore):
+        """
+        Retry the pending entries whose backoff is over and dead-letter those out of attempts.
+        """
+        self.pending = (await self.redis.xpending(self.config.stream, self.config.group))['pending']
+        pending = await self.redis.xpending_range(self.config.stream, self.config.group, min='-', max='+',
+                                                  count=100, idle=int(self.config.retry_base * 1000))
+        for entry in pending:
+            entry_id, attempts = entry['message_id'], entry['times_delivered']
+            if attempts >= self.config.max_attempts:
+                await self._dead_letter(entry_id, attempts)
+                continue
+            backoff = int(self._backoff(attempts) * 1000)
+            if entry['time_since_delivered'] < backoff:
+                continue
+            # XCLAIM only succeeds if no other replica claimed the entry in the meantime
+            for claimed_id, fields in await self.redis.xclaim(self.config.stream, self.config.group,
+                                                              self.consumer, backoff, [entry_id]):
+                if fields:
+                    self.counters['retried'] += 1
+                    await self._spawn(claimed_id, fields, provisioner, in_flight)
+
+    async def _dead_letter(self, entry_id, attempts: int):
+        entries = await self.redis.xrange(self.config.stream, entry_id, entry_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for _, fields in entries:
+                mapping = client_record.unpack(fields[b'record'])
+                logger.error(f"Giving up on provisioning client {mapping['name']} ({mapping['mac']}) into network "
+                             f"{mapping['network_id']} after {attempts} attempts")
+                pipe.xadd(self.config.dead_letter_stream, {**fields, b'attempts': attempts},
+                          maxlen=10000, approximate=True)
+            pipe.xack(self.config.stream, self.config.group, entry_id)
+            pipe.xdel(self.config.stream, entry_id)
+            await pipe.execute()
+        for _, fields in entries:
+            # Let the next session update for the client queue it again
+            await self._forget_script(keys=[self.queued_key(fields[b'key'])],
+                                      args=[client_record.record_digest(fields[b'record'])])
+        self.counters['dead_lettered'] += 1
+
+    def stats(self) -> dict:
+        return {'stream_pending': self.pending, **self.counters}
@@ -1,10 +1,11 @@
 import asyncio
 import base64
 import logging
-from io import StringIO
+from collections import deque
 
 import websockets
 
+import metrics
 from stomp import StompFrame
 
 
@@ -15,6 +16,8 @@ class WebSocketStomp:
         self.password = password
         self.ssl_ctx = ssl_ctx
         self.ws = None
+        # Frames received in the same websocket message as one already returned
+        self._pending = deque()
         self.log = logging.getLogger('ws_stomp')
 
     async def connect(self):
@@ -32,9 +35,7 @@ class WebSocketStomp:
         frame.set_command("CONNECT")
         frame.set_header('accept-version', '1.2')
         frame.set_header('host', hostname)
-        out = StringIO()
-        frame.write(out)
-        await self.ws.send(out.getvalue().encode('utf-8'))
+        await self.ws.send(frame.encode())
 
     async def stomp_subscribe(self, topic):
         self.log.debug('STOMP SUBSCRIBE topic=' + topic)
@@ -42,27 +43,33 @@ class WebSocketStomp:
         frame.set_command("SUBSCRIBE")
         frame.set_header('destination', topic)
         frame.set_header('id', 'my-id')
-        out = StringIO()
-        frame.write(out)
-        await self.ws.send(out.getvalue().encode('utf-8'))
+        await self.ws.send(frame.encode())
 
     async def stomp_send(self, topic, message):
         self.log.debug('STOMP SEND topic=' + topic)
         frame = StompFrame()
         frame.set_command("SEND")
         frame.set_header('destination', topic)
-        frame.set_header('content-length', str(len(message)))
         frame.set_content(message)
-        out = StringIO()
-        frame.write(out)
-        await self.ws.send(out.getvalue().encode('utf-8'))
+        await self.ws.send(frame.encode())
 
-    # only returns for MESSAGE
-    async def stomp_read_message(self):
-        while True:
+    async def stomp_read_frame(self) -> StompFrame:
+        """
+        Return the next frame. A websocket message may carry several frames, the extra ones are kept for the
+        following calls.
+        """
+        while not self._pending:
             message = await self.ws.recv()
-            s_in = StringIO(message.decode('utf-8'))
-            stomp = StompFrame.parse(s_in)
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            with metrics.STOMP_DECODE.time():
+                self._pending.extend(StompFrame.decode_all(message))
+        return self._pending.popleft()
+
+    # only returns for MESSAGE, with the body as bytes
+    async def stomp_read_message(self) -> bytes:
+        while True:
+            stomp = await self.stomp_read_frame()
             if stomp.get_command() == 'MESSAGE':
                 return stomp.get_content()
             elif stomp.get_command() == 'CONNECTED':
@@ -72,7 +79,7 @@ class WebSocketStomp:
                 receipt = stomp.get_header('receipt-id')
                 self.log.debug('STOMP RECEIPT id=' + receipt)
             elif stomp.get_command() == 'ERROR':
-                self.log.error('STOMP ERROR content=' + stomp.get_content())
+                self.log.error('STOMP ERROR content=' + stomp.get_content().decode('utf-8', errors='replace'))
 
     async def stomp_disconnect(self, receipt=None):
         self.log.info('STOMP DISCONNECT receipt=' + receipt)
@@ -80,9 +87,7 @@ class WebSocketStomp:
         frame.set_command("DISCONNECT")
         if receipt is not None:
             frame.set_header('receipt', receipt)
-        out = StringIO()
-        frame.write(out)
-        await self.ws.send(out.getvalue().encode('utf-8'))
+        await self.ws.send(frame.encode())
 
     async def disconnect(self):
         await self.ws.close()